@@ -1,65 +1,279 @@
-import json
 import sys
 import time
 
 from PyQt5 import QtCore
-from PyQt5.QtCore import QThread, pyqtSignal, pyqtSlot, QObject, QRegExp
+from PyQt5.QtCore import (QThread, pyqtSignal, pyqtSlot, QObject, QRegExp, Qt, QAbstractTableModel, QModelIndex,
+                          QSortFilterProxyModel)
 from PyQt5.QtGui import QFont, QIntValidator, QRegExpValidator
 from PyQt5.QtWidgets import (QWidget, QPushButton,
                              QHBoxLayout, QVBoxLayout, QApplication, QLabel, QMainWindow, QToolButton,
-                             QToolBar, QStackedLayout, QProgressBar, QLineEdit, QMessageBox, QInputDialog, QFrame,
-                             QScrollArea, QGroupBox, QFormLayout, QAction)
+                             QToolBar, QStackedLayout, QProgressBar, QLineEdit, QMessageBox, QInputDialog,
+                             QGroupBox, QAction, QFileDialog, QTableView, QHeaderView, QAbstractItemView)
 
-from pySIMlib import pySIMlib
+from pySIMcache import CardCache
+from pySIMlib import pySIMlib, writeJSON
+from pySIMphonebook import readContacts
+from pySIMsms import SMSIndex, assembleSMS
+
+# item data role of the values the panels sort by
+SortRole = Qt.UserRole + 1
+
+MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+
+def timestampKey(text):
+    """ "Wed Mar 15 14:00:21 2017" (time.asctime of the SMS time stamps) as "2017-03-15 14:00:21",
+        which sorts by time. time.strptime is not used, it reads the month names of the locale.
+    """
+    parts = text.split()
+    if len(parts) != 5 or parts[1] not in MONTHS or not parts[2].isdigit():
+        return text
+    return "%s-%02d-%02d %s" % (parts[4], MONTHS.index(parts[1]) + 1, int(parts[2]), parts[3])
 
 
 class Worker(QObject):
     finished = pyqtSignal(object)
+    # partial results while a file is being read, same keys as finished
+    records = pyqtSignal(object)
+    # progress events of pySIMlib, see pySIMlib.addProgressListener
+    progress = pyqtSignal(object)
+
+    # a batch is emitted after this many records or seconds, the first record right away
+    BATCH_SIZE = 10
+    BATCH_INTERVAL = 0.25
 
     def __init__(self, sim):
         QObject.__init__(self)
         self.sim = sim
+        self._batch = []
+        self._lastEmit = 0
+        # file written by saveImage
+        self.imageFilename = None
+        # CSV or vCard file read by importContacts, and its importContacts mode
+        self.importFilename = None
+        self.importReplace = False
+        # (name, number) written to ADN by addContact
+        self.contact = None
+
+    def _addRecord(self, key, record):
+        self._batch.append(record)
+        if self._lastEmit == 0 or len(self._batch) >= self.BATCH_SIZE or \
+                time.time() - self._lastEmit >= self.BATCH_INTERVAL:
+            self._flushRecords(key)
+
+    def _flushRecords(self, key):
+        if self._batch:
+            self.records.emit({key: self._batch})
+            self._batch = []
+            self._lastEmit = time.time()
 
     @pyqtSlot()
     def loadMetadata(self):
+        self.sim.addProgressListener(self.progress.emit)
         try:
-            metadata = {"ICCID": self.sim.getICCID(), "LP": self.sim.getLP(), "IMSI": self.sim.getIMSI(),
-                        "KC": self.sim.getKC(), "HPLMN": self.sim.getHPLMN(), "SST": self.sim.getSST(),
-                        "BCCH": self.sim.getBCCH(), "ACC": self.sim.getACC(), "FPLMN": self.sim.getFPLMN(),
-                        "LOCI": self.sim.getLOCI(), "AD": self.sim.getAD(), "Phase": self.sim.getPhase()}
+            metadata = self.sim.getMetadata()
             self.finished.emit(dict(metadata=metadata))
         except Exception as e:
             self.finished.emit(dict(error=True, detail=str(e)))
+        finally:
+            self.sim.removeProgressListener(self.progress.emit)
 
     @pyqtSlot()
     def loadContacts(self):
+        self.sim.addProgressListener(self.progress.emit)
         try:
-            nums1 = self.sim.getNums(self.sim.FILE_EF_ADN)
-            nums2 = self.sim.getNums(self.sim.FILE_EF_FDN)
-            nums3 = self.sim.getNums(self.sim.FILE_EF_LND)
-            numbers = nums1[0].values() + nums2[0].values() + nums3[0].values()
-            self.finished.emit(dict(contacts=numbers, free_slots=nums1[1]))
+            numbers = []
+            free_slots = []
+            for numFile in (self.sim.FILE_EF_ADN, self.sim.FILE_EF_FDN, self.sim.FILE_EF_LND):
+                slots = free_slots if numFile == self.sim.FILE_EF_ADN else None
+                for recNum, contact in self.sim.iterNums(numFile, slots):
+                    numbers.append(contact)
+                    self._addRecord("contacts", contact)
+            self._flushRecords("contacts")
+            self.finished.emit(dict(contacts=numbers, free_slots=free_slots))
         except Exception as e:
             self.finished.emit(dict(error=True, detail=str(e)))
+        finally:
+            self.sim.removeProgressListener(self.progress.emit)
 
     @pyqtSlot()
     def loadSMSs(self):
+        self.sim.addProgressListener(self.progress.emit)
         try:
-            smss = self.sim.getSMSs()
+            smss = {}
+            # the panel gets whole messages, the parts of concatenated ones joined
+            index = SMSIndex()
+            for recNum, sms in self.sim.iterSMS():
+                smss[recNum] = sms
+                for message in index.add(recNum, sms):
+                    self._addRecord("smss", message)
+            for message in index.flush():
+                self._addRecord("smss", message)
+            self._flushRecords("smss")
             self.finished.emit(dict(smss=smss))
         except Exception as e:
             self.finished.emit(dict(error=True, detail=str(e)))
+        finally:
+            self.sim.removeProgressListener(self.progress.emit)
+
+
+    @pyqtSlot()
+    def importContacts(self):
+        self.sim.addProgressListener(self.progress.emit)
+        try:
+            contacts = readContacts(self.importFilename)
+            result = self.sim.importContacts(self.sim.FILE_EF_ADN, contacts, self.importReplace)
+            self.finished.emit(dict(imported=result, count=len(contacts)))
+        except Exception as e:
+            self.finished.emit(dict(error=True, detail=str(e)))
+        finally:
+            self.sim.removeProgressListener(self.progress.emit)
+
+    @pyqtSlot()
+    def addContact(self):
+        try:
+            name, number = self.contact
+            slot = self.sim.addContact(self.sim.FILE_EF_ADN, name, number)
+            self.finished.emit(dict(contact=self.contact, slot=slot))
+        except Exception as e:
+            self.finished.emit(dict(error=True, detail=str(e)))
+
+    @pyqtSlot()
+    def saveImage(self):
+        self.sim.addProgressListener(self.progress.emit)
+        try:
+            files = self.sim.saveImage(self.imageFilename)
+            self.finished.emit(dict(image=self.imageFilename, files=files))
+        except Exception as e:
+            self.finished.emit(dict(error=True, detail=str(e)))
+        finally:
+            self.sim.removeProgressListener(self.progress.emit)
+
+
+class RecordModel(QAbstractTableModel):
+    """ table of records for a QTableView, the view asks only for the cells of the visible rows
+
+        Records are appended in batches as they are read (appendRecords), each batch is one
+        row insertion. Subclasses set HEADERS and convert a record with row().
+    """
+    HEADERS = ()
+
+    def __init__(self, parent=None):
+        QAbstractTableModel.__init__(self, parent)
+        # tuple(column texts, sort keys) of every row
+        self.rows = []
+
+    def row(self, record):
+        """ result : tuple(column texts, sort keys) of the record, None leaves it out """
+        return tuple(record), tuple(record)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == Qt.DisplayRole:
+            return self.rows[index.row()][0][index.column()]
+        if role == SortRole:
+            return self.rows[index.row()][1][index.column()]
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.HEADERS[section]
+        return None
+
+    def appendRecords(self, records):
+        rows = [row for row in [self.row(record) for record in records] if row is not None]
+        if not rows:
+            return
+        first = len(self.rows)
+        self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+        self.rows.extend(rows)
+        self.endInsertRows()
+
+
+def recordView(model):
+    """recordView(model)
+
+        result : tuple(QTableView, QSortFilterProxyModel) showing a RecordModel. The rows have a fixed
+                 height, so only the visible ones are laid out. Clicking a header sorts by the SortRole
+                 keys of the column, rows appended later are sorted in. Until then the order is the
+                 order the records were read in.
+    """
+    view = QTableView()
+    proxy = QSortFilterProxyModel(view)
+    proxy.setSourceModel(model)
+    proxy.setSortRole(SortRole)
+    proxy.setDynamicSortFilter(True)
+    view.setModel(proxy)
+    view.setSelectionBehavior(QAbstractItemView.SelectRows)
+    view.setSelectionMode(QAbstractItemView.SingleSelection)
+    view.setEditTriggers(QAbstractItemView.NoEditTriggers)
+    view.setWordWrap(False)
+    view.setShowGrid(False)
+    view.verticalHeader().hide()
+    view.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+    view.horizontalHeader().setStretchLastSection(True)
+    view.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
+    view.setSortingEnabled(True)
+    return view, proxy
+
+
+class ContactsModel(RecordModel):
+    HEADERS = ("Name", "Number")
+
+    def __init__(self, parent=None):
+        RecordModel.__init__(self, parent)
+        self.bold = QFont()
+        self.bold.setBold(True)
+
+    def row(self, contact):
+        name, number = contact[0], contact[1]
+        if len(name) > 0 and len(number) > 0:
+            return (name, number), (name.lower(), number)
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.FontRole and index.isValid() and index.column() == 1:
+            return self.bold
+        return RecordModel.data(self, index, role)
+
+
+class SMSModel(RecordModel):
+    HEADERS = ("Date", "From", "Message")
+
+    def row(self, item):
+        # item is (recNum, sms), sms is 0 status, 1 date, 2 from, 3 msg
+        recNum, sms = item
+        if len(sms) > 3:
+            date = timestampKey(sms[1])
+            # the cell shows one line, the whole text is in the tool tip and below the table
+            return (date, sms[2], " ".join(sms[3].split())), (date, sms[2], sms[3])
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.ToolTipRole and index.isValid() and index.column() == 2:
+            return self.rows[index.row()][1][2]
+        return RecordModel.data(self, index, role)
 
 
 class ContactsPanel(QWidget):
-    def __init__(self, sim, data):
+    def __init__(self, sim, data, writeContact=None):
         QWidget.__init__(self)
-        self.contacts_form = QFormLayout()
+        self.model = ContactsModel(self)
         self.new_contact_grp = QGroupBox('New contact')
         self.new_name = QLineEdit()
         self.new_number = QLineEdit()
         self.sim = sim
         self.data = data
+        # function(name, number) that has the contact written by the card's worker thread and
+        # calls contactSaved when it is done, None writes it from here
+        self.writeContact = writeContact
         self.initGUI()
 
     def initGUI(self):
@@ -83,20 +297,17 @@ class ContactsPanel(QWidget):
         self.new_contact_grp.setLayout(form)
 
         groupbox = QGroupBox('Contacts')
-        contacts = self.data["contacts"]
-        for idx, contact in enumerate(contacts):
-            self.addContactItem(contact[0], contact[1])
-
-        groupbox.setLayout(self.contacts_form)
-        scroll = QScrollArea()
-        scroll.setWidget(groupbox)
-        scroll.setWidgetResizable(True)
-        scroll.setFrameShape(QFrame.NoFrame)
+        self.view, self.proxy = recordView(self.model)
+        self.view.setColumnWidth(0, 240)
+        self.appendContacts(self.data["contacts"])
+
+        box = QVBoxLayout()
+        box.addWidget(self.view)
+        groupbox.setLayout(box)
         layout = QVBoxLayout(self)
         layout.addWidget(add_new)
         layout.addWidget(self.new_contact_grp)
-        layout.addWidget(scroll)
-        layout.addStretch()
+        layout.addWidget(groupbox)
 
     def hideAddNewContact(self):
         self.new_contact_grp.setHidden(True)
@@ -106,86 +317,74 @@ class ContactsPanel(QWidget):
     def showAddNewContact(self):
         self.new_contact_grp.setHidden(False)
 
+    def appendContacts(self, contacts):
+        self.model.appendRecords(contacts)
+
     def addContactItem(self, name, number):
-        if len(name) > 0 and len(number) > 0:
-            numberField = QLabel(number)
-            bold = QFont()
-            bold.setBold(True)
-            numberField.setFont(bold)
-            self.contacts_form.addRow(QLabel(name), numberField)
+        self.model.appendRecords([(name, number)])
 
     def addNewContact(self):
         name = self.new_name.text()
         number = self.new_number.text()
         if len(name) > 0 and len(number) > 0:
-            self.addContactItem(name, number)
-            self.saveContactToSim(name, number)
+            if self.writeContact is not None:
+                self.writeContact(name, number)
+            else:
+                self.contactSaved(name, number, self.saveContactToSim(name, number))
             self.new_name.setText("")
             self.new_number.setText("")
             self.new_contact_grp.setHidden(True)
 
     def saveContactToSim(self, name, number):
-        free = self.data["free_slots"]
-        slot = free[0]
-        self.data["free_slots"].remove(slot)
+        """ writes the contact to a free ADN record, result : the record, None if none was free """
         sim = self.sim
-        recNum, recLen, nameLen = sim.getNumInfo(sim.FILE_EF_ADN)
-        sim.setNum(sim.FILE_EF_ADN, slot, recLen, nameLen, name, number)
+        return sim.addContact(sim.FILE_EF_ADN, name, number)
+
+    def contactSaved(self, name, number, slot):
+        if not slot:
+            QMessageBox.warning(self, "New contact", "There is no free record for %s on the SIM card." % name)
+            return
+        if slot in self.data["free_slots"]:
+            self.data["free_slots"].remove(slot)
+        self.addContactItem(name, number)
 
 
 class SMSPanel(QWidget):
     def __init__(self, data):
         smss = data["smss"]
         QWidget.__init__(self)
-        vbox = QVBoxLayout()
+        self.model = SMSModel(self)
         groupbox = QGroupBox('SMS')
-        for idx, sms in enumerate(dict(smss).values()):
-            # 0 id, 1 date, 2 from, 3 msg
-            if len(sms) > 3:
-                # TODO fix time parsing on linux
-                # time_val = sms[1]
-                # time_parsed = time.strptime(time_val)
-                # timeF = time.strftime('%Y-%m-%d %H:%M:%S', time_parsed)
-                vbox.addLayout(self.generateSMSitem(sms[1], sms[2], sms[3]))
-
-                line = QFrame()
-                line.setFrameShape(QFrame.HLine)
-                line.setFrameShadow(QFrame.Sunken)
-                vbox.addWidget(line)
-        groupbox.setLayout(vbox)
-        scroll = QScrollArea()
-        scroll.setWidget(groupbox)
-        scroll.setWidgetResizable(True)
-        scroll.setFrameShape(QFrame.NoFrame)
+        self.view, self.proxy = recordView(self.model)
+        self.view.setColumnWidth(0, 150)
+        self.view.setColumnWidth(1, 130)
+        self.view.selectionModel().currentRowChanged.connect(self.showMessage)
+        # whole text of the selected message
+        self.message = QLabel()
+        self.message.setStyleSheet("background: #fff;padding:5px;")
+        self.message.setWordWrap(True)
+        self.message.setTextInteractionFlags(Qt.TextSelectableByMouse)
+        self.message.setHidden(True)
+        self.appendSMSs(assembleSMS(smss))
+
+        box = QVBoxLayout()
+        box.addWidget(self.view)
+        box.addWidget(self.message)
+        groupbox.setLayout(box)
         layout = QVBoxLayout(self)
-        layout.addWidget(scroll)
-        layout.addStretch()
-
-    def generateSMSitem(self, time_str, from_str, msg):
-        hbox = QHBoxLayout()
-        vbox = QVBoxLayout()
-
-        date_label = QLabel()
-        date_label.setText(time_str)
-        hbox.addWidget(date_label)
-
-        from_label = QLabel()
-        from_label.setText(from_str)
-        font = QFont()
-        font.setBold(True)
-        font.setWeight(75)
-        from_label.setFont(font)
-        hbox.addWidget(from_label)
-        hbox.addStretch()
+        layout.addWidget(groupbox)
 
-        msg_field = QLabel()
-        msg_field.setStyleSheet("background: #fff;padding:5px;")
-        msg_field.setText(msg)
+    def appendSMSs(self, smss):
+        """ smss : dict or list of (recNum, sms) pairs """
+        self.model.appendRecords(sorted(smss.items()) if isinstance(smss, dict) else smss)
 
-        vbox.addLayout(hbox)
-        vbox.addWidget(msg_field)
-        vbox.addStretch()
-        return vbox
+    def showMessage(self, current, previous):
+        if not current.isValid():
+            self.message.setHidden(True)
+            return
+        row = self.proxy.mapToSource(current).row()
+        self.message.setText(self.model.rows[row][1][2])
+        self.message.setHidden(False)
 
 
 class MetadataPanel(QWidget):
@@ -221,14 +420,30 @@ class MetadataPanel(QWidget):
 
 
 class SimReader(QMainWindow):
-    def __init__(self, port="\\.\COM6"):
+    # seconds without a progress event before the reader is reported as not answering
+    STALL_TIMEOUT = 3
+    # datasets read in the background after the PIN, in the order they are usually looked at
+    PREFETCH_ORDER = ("metadata", "contacts", "smss")
+
+    def __init__(self, port="\\.\COM6", baudrate=None):
         QMainWindow.__init__(self)
         self.sim = pySIMlib(False)
+        self.sim.cache = CardCache()
         self.backgroundWorker = Worker(self.sim)
         self.data = {}
-        self._metaIdx = None
-        self._contactsIdx = None
-        self._smsIdx = None
+        # stacked layout index of the panel of every dataset shown so far
+        self._panelIdx = {}
+        # the dataset the user asked for last, its panel is brought up as soon as it is there
+        self.wanted = None
+        # card jobs, see queueJob: the waiting ones, the key of the running one and the worker thread
+        self.jobs = []
+        self.runningJob = None
+        self.thread = None
+        self._previousWorker = None
+        self._saveWhenLoaded = False
+        self._contactsPanel = None
+        self._smsPanel = None
+        self._lastProgress = 0
         self.window = QWidget()
         self._blankIdx = 1
         self.body_layout = None
@@ -237,12 +452,14 @@ class SimReader(QMainWindow):
         self.setCentralWidget(self.window)
         self.initUI()
         self.port = port
+        self.baudrate = baudrate
         self.initLib()
 
     def initLib(self):
         try:
-            self.sim.openSession(self.port)
-            self.statusBar().showMessage("Successfully connected to serial port.", 2000)
+            self.sim.openSession(self.port, self.baudrate)
+            self.statusBar().showMessage("Successfully connected to %s (%s baud)." % (self.port, self.sim.baudrate or "-"),
+                                         2000)
         except Exception as e:
             print(e)
             self.choosePort(self.port)
@@ -265,40 +482,40 @@ class SimReader(QMainWindow):
     def handleShowMetadata(self):
         self.silentlyUncheck(self.contactsBtn)
         self.silentlyUncheck(self.smsBtn)
-        if "metadata" not in self.data.keys():
-            self.progressSpeed = 25
-            self.backgroundWorker = Worker(self.sim)
-            self.loadData(self.backgroundWorker.loadMetadata, self.prepareMetadataPanel)
-        elif self._metaIdx is None:
-            self._metaIdx = self.stackedLayout.count()
-            self.prepareMetadataPanel(self.data)
-        else:
-            self.stackedLayout.setCurrentIndex(self._metaIdx)
+        self.showDataset("metadata")
 
     def handleShowContacts(self):
         self.silentlyUncheck(self.metaBtn)
         self.silentlyUncheck(self.smsBtn)
-
-        if "contacts" not in self.data.keys():
-            self.progressSpeed = 10
-            self.backgroundWorker = Worker(self.sim)
-            self.loadData(self.backgroundWorker.loadContacts, self.prepareContactsPanel)
-        elif self._contactsIdx is None:
-            self.prepareContactsPanel(self.data)
-        else:
-            self.stackedLayout.setCurrentIndex(self._contactsIdx)
+        self.showDataset("contacts")
 
     def handleShowSMS(self):
         self.silentlyUncheck(self.metaBtn)
         self.silentlyUncheck(self.contactsBtn)
-        if "smss" not in self.data.keys():
-            self.progressSpeed = 1.5
-            self.backgroundWorker = Worker(self.sim)
-            self.loadData(self.backgroundWorker.loadSMSs, self.prepareSMSsPanel)
-        elif self._smsIdx is None:
-            self.prepareSMSsPanel(self.data)
+        self.showDataset("smss")
+
+    def showDataset(self, key):
+        """ shows the panel of a dataset, right away if it was prefetched (or is being read and
+            already has a panel), else its reading is moved to the front of the queue
+        """
+        self.wanted = key
+        idx = self._panelIdx.get(key)
+        if idx is not None:
+            self.progress.hide()
+            self.stackedLayout.setCurrentIndex(idx)
         else:
-            self.stackedLayout.setCurrentIndex(self._smsIdx)
+            self.fetch(key, front=True)
+            self._showWaiting()
+
+    def fetch(self, key, front=False):
+        """ queues the reading of a dataset ("metadata", "contacts" or "smss") unless it is read or being read """
+        if key in self.data or key == self.runningJob:
+            return
+        loadName, finishCallback, recordsCallback = {
+            "metadata": ("loadMetadata", self.prepareMetadataPanel, None),
+            "contacts": ("loadContacts", self.prepareContactsPanel, self.streamContacts),
+            "smss": ("loadSMSs", self.prepareSMSsPanel, self.streamSMSs)}[key]
+        self.queueJob(key, loadName, finishCallback, recordsCallback, front)
 
     def createMenuBar(self):
         mainMenu = self.menuBar()
@@ -315,6 +532,16 @@ class SimReader(QMainWindow):
         self.saveToFileBtn.setEnabled(False)
         toolsMenu.addAction(self.saveToFileBtn)
 
+        self.saveImageBtn = QAction("Save card image", self)
+        self.saveImageBtn.triggered.connect(self.saveImage)
+        self.saveImageBtn.setEnabled(False)
+        toolsMenu.addAction(self.saveImageBtn)
+
+        self.importBtn = QAction("Import contacts...", self)
+        self.importBtn.triggered.connect(self.importContacts)
+        self.importBtn.setEnabled(False)
+        toolsMenu.addAction(self.importBtn)
+
         helpMenu = mainMenu.addMenu('Help')
         about = QAction("About", self)
         about.triggered.connect(self.showAboutDialog)
@@ -332,51 +559,90 @@ class SimReader(QMainWindow):
         msg.exec_()
 
     def saveToFile(self):
-        self.prevIndex = self.stackedLayout.currentIndex()
-        if "contacts" not in self.data and "smss" not in self.data:
-            self.progressSpeed = 1.3
-            self.backgroundWorker = Worker(self.sim)
-            self.loadData(self.backgroundWorker.loadContacts, self._processAndLoadAnother)
-
-        elif "contacts" not in self.data:
-            self.progressSpeed = 10
-            self.backgroundWorker = Worker(self.sim)
-            self.loadData(self.backgroundWorker.loadContacts, self._finishAndSaveToFile)
-        elif "smss" not in self.data:
-            self.progressSpeed = 1.5
-            self.backgroundWorker = Worker(self.sim)
-            self.loadData(self.backgroundWorker.loadSMSs, self._finishAndSaveToFile)
-        else:
+        missing = [key for key in ("contacts", "smss") if key not in self.data]
+        if not missing:
             self._saveToFile()
+            return
+        # saved by _jobFinished once the prefetch has them
+        self._saveWhenLoaded = True
+        for key in reversed(missing):
+            self.fetch(key, front=True)
+        self.statusBar().showMessage("The data is saved as soon as it is read from the SIM card...", 2000)
+
+    def saveImage(self):
+        self.prevIndex = self.stackedLayout.currentIndex()
+        self.queueJob("image", "saveImage", self._finishSavingImage, front=True,
+                      attributes=dict(imageFilename='card.simg'))
+        self._showWaiting()
+
+    def importContacts(self):
+        filename, _ = QFileDialog.getOpenFileName(self, "Import contacts", "",
+                                                  "Contacts (*.csv *.vcf *.vcard);;All files (*)")
+        if not filename:
+            return
+        answer = QMessageBox.question(self, "Import contacts",
+                                      "Replace the phonebook on the card with the contacts of the file?\n"
+                                      "Yes writes them to the first records and deletes the other contacts, "
+                                      "No adds the ones the card does not have yet.",
+                                      QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel, QMessageBox.No)
+        if answer == QMessageBox.Cancel:
+            return
+        self.prevIndex = self.stackedLayout.currentIndex()
+        self.queueJob("import", "importContacts", self._finishImport, front=True,
+                      attributes=dict(importFilename=filename, importReplace=answer == QMessageBox.Yes))
+        self._showWaiting()
 
-    def _processData(self, data):
+    def _finishImport(self, data):
         if "error" in data:
             self.showException(data["detail"])
-            return False
-        else:
-            for key, value in data.items():
-                self.data[key] = value
-            return True
-
-    def _processAndLoadAnother(self, data):
-        if self._processData(data):
-            self.backgroundWorker = Worker(self.sim)
-            self.loadData(self.backgroundWorker.loadSMSs, self._finishAndSaveToFile, resetLoader=False)
-
-    def _finishAndSaveToFile(self, data):
+            return
+        self.progress.hide()
+        result = data["imported"]
+        self.statusBar().showMessage("Imported %d contacts: %d records written, %d unchanged, %d already on the card, "
+                                     "%d without a free record, %d invalid" %
+                                     (data["count"], result["written"], result["unchanged"], result["duplicates"],
+                                      len(result["noSlot"]), len(result["invalid"])), 5000)
+        if result["written"]:
+            # the contacts are read again the next time they are shown, the old panel stays
+            # in the stacked layout so that the indexes of the other panels do not move
+            showing = self._panelIdx.get("contacts") is not None and self.prevIndex == self._panelIdx["contacts"]
+            self.data.pop("contacts", None)
+            self._contactsPanel = None
+            self._panelIdx.pop("contacts", None)
+            if showing:
+                self.handleShowContacts()
+                return
+            self.fetch("contacts")
+        self.stackedLayout.setCurrentIndex(self.prevIndex)
+
+    def writeContact(self, name, number):
+        """ has the contact of the contacts panel written to the card by the worker thread """
+        self.queueJob("contact %s %s" % (name, number), "addContact", self._contactSaved, front=True,
+                      attributes=dict(contact=(name, number)))
+        self.statusBar().showMessage("Saving %s to the SIM card..." % name)
+
+    def _contactSaved(self, data):
+        if "error" in data:
+            self.showException(data["detail"])
+            return
+        self.statusBar().showMessage("Saved %s to the SIM card" % data["contact"][0], 2000)
+        if self._contactsPanel is not None:
+            self._contactsPanel.contactSaved(data["contact"][0], data["contact"][1], data["slot"])
 
-        if self._processData(data):
-            self.timer.stop()
-            self.progress.hide()
-            self._saveToFile()
+    def _finishSavingImage(self, data):
+        if "error" in data:
+            self.showException(data["detail"])
+            return
+        self.progress.hide()
+        self.statusBar().showMessage("Saved %d files to %s, open it with image://%s" %
+                                     (data["files"], data["image"], data["image"]), 5000)
+        self.stackedLayout.setCurrentIndex(self.prevIndex)
 
     def _saveToFile(self):
         filename = 'export.json'
-        with open(filename, 'w') as outfile:
-            print(self.data.keys())
-            json.dump(self.data, outfile, ensure_ascii=False)
-            self.statusBar().showMessage("Saved data to file %s" % filename, 2000)
-            self.stackedLayout.setCurrentIndex(self.prevIndex)
+        print(self.data.keys())
+        writeJSON(self.data, filename)
+        self.statusBar().showMessage("Saved data to file %s" % filename, 2000)
 
     def createToolbar(self):
         self.formatbar = QToolBar(self)
@@ -450,40 +716,114 @@ class SimReader(QMainWindow):
             return False
         print("Pin OK")
         self.statusBar().showMessage("Pin OK", 2000)
+        self.saveImageBtn.setEnabled(True)
+        self.importBtn.setEnabled(True)
 
         self.createToolbar()
         self.stackedLayout.addWidget(QWidget())
         self.progress = QProgressBar(self)
+        self.progress.hide()
+        # the timer only watches for a reader that stopped answering, the bar follows the progress events
+        self.timer = QtCore.QTimer()
+        self.timer.setInterval(500)
+        self.timer.timeout.connect(self.checkStalled)
+        # one thread runs all card jobs, the card answers one APDU at a time anyway
+        self.thread = QThread()
+        self.thread.start()
+        # the card would be idle while the user looks at a panel, so everything is read now
+        for key in self.PREFETCH_ORDER:
+            self.fetch(key)
         self.metaBtn.setChecked(True)
 
-    def loadData(self, loadFunction, finishCallback, resetLoader=True):
+    def _showWaiting(self):
+        """ shows the progress bar in place of a panel until the job the user waits for is done """
         self.stackedLayout.setCurrentIndex(self._blankIdx)
         self.progress.setAlignment(QtCore.Qt.AlignCenter)
-        self.progress.setFormat(u'Loading data from SIM card: %p%')
-        self.progress.setGeometry(200, 150, 250, 20)
+        self.progress.setFormat(u'Connecting to SIM card...')
+        self.progress.setGeometry(150, 150, 350, 20)
+        self.progress.setRange(0, 0)
         self.progress.show()
 
-        self.thread = QThread()
+    def queueJob(self, key, loadName, finishCallback, recordsCallback=None, front=False, attributes=None):
+        """queueJob(key, loadName, finishCallback, recordsCallback, front, attributes)
+
+            runs the Worker slot loadName on the worker thread after the jobs queued before it,
+            front=True puts it before the waiting ones (the running job is not interrupted).
+            A job with the same key that is still waiting is replaced.
+            attributes : dict of Worker attributes set before it runs (ex. imageFilename)
+        """
+        if key == self.runningJob:
+            return
+        self.jobs = [job for job in self.jobs if job[0] != key]
+        job = (key, loadName, finishCallback, recordsCallback, attributes or {})
+        if front:
+            self.jobs.insert(0, job)
+        else:
+            self.jobs.append(job)
+        self._startNextJob()
+
+    def _startNextJob(self):
+        if self.runningJob is not None or not self.jobs:
+            return
+        key, loadName, finishCallback, recordsCallback, attributes = self.jobs.pop(0)
+        self.runningJob = key
+        # the worker before is kept until now: it may still be returning from its slot on the worker
+        # thread, the one before it is done for sure because the jobs run one after the other
+        self._previousWorker = self.backgroundWorker
+        self.backgroundWorker = Worker(self.sim)
+        for name, value in attributes.items():
+            setattr(self.backgroundWorker, name, value)
         self.backgroundWorker.moveToThread(self.thread)
-        self.backgroundWorker.finished.connect(self.thread.quit)
         self.backgroundWorker.finished.connect(finishCallback)
-        self.thread.started.connect(loadFunction)
-        self.thread.start()
+        self.backgroundWorker.finished.connect(self._jobFinished)
+        if recordsCallback:
+            self.backgroundWorker.records.connect(recordsCallback)
+        self.backgroundWorker.progress.connect(self.updateProgress)
+        QtCore.QMetaObject.invokeMethod(self.backgroundWorker, loadName, QtCore.Qt.QueuedConnection)
 
-        self.progressVal = 0 if resetLoader else self.progressVal
-        self.progress.setValue(self.progressVal)
-        self.timer = QtCore.QTimer()
-        self.timer.setInterval(250)
-        self.timer.timeout.connect(self.updateLoader)
+        self._lastProgress = time.time()
         self.timer.start()
 
+    def _jobFinished(self, data):
+        self.runningJob = None
+        if self._saveWhenLoaded and "contacts" in self.data and "smss" in self.data:
+            self._saveWhenLoaded = False
+            self._saveToFile()
+        self._startNextJob()
+        if self.runningJob is None:
+            self.timer.stop()
+
     def killThread(self):
         self.thread.quit()
 
-    def updateLoader(self):
-        if self.progressVal < 100:
-            self.progressVal += self.progressSpeed
-            self.progress.setValue(self.progressVal)
+    def closeEvent(self, event):
+        if self.thread is not None:
+            # lets the running job finish, the card is not left in the middle of a command
+            self.thread.quit()
+            self.thread.wait()
+        QMainWindow.closeEvent(self, event)
+
+    def updateProgress(self, event):
+        self._lastProgress = time.time()
+        names = {self.sim.FILE_EF_ADN: "contacts", self.sim.FILE_EF_FDN: "fixed dialing numbers",
+                 self.sim.FILE_EF_LND: "last dialed numbers", "SMS": "messages", "image": "card image",
+                 "import": "imported contacts"}
+        name = names.get(event["operation"], event["operation"])
+        if event["eta"] is None:
+            eta = "..."
+        else:
+            eta = "%.1f s left" % event["eta"]
+        text = "Reading %s: %d/%d, %d APDUs, %d bytes, %s" % (name, event["done"], event["total"], event["apdus"],
+                                                             event["bytes"], eta)
+        self.progress.setRange(0, max(event["total"], 1))
+        self.progress.setValue(event["done"])
+        self.progress.setFormat(text)
+        self.statusBar().showMessage(text)
+
+    def checkStalled(self):
+        stalled = time.time() - self._lastProgress
+        if stalled >= self.STALL_TIMEOUT:
+            self.statusBar().showMessage("No answer from the reader for %d s" % stalled)
 
     def showException(self, e):
         msg = QMessageBox()
@@ -504,39 +844,64 @@ class SimReader(QMainWindow):
             self.showException(data["detail"])
             return False
         else:
-            self.statusBar().showMessage("Data loaded successfully.", 1500)
+            stats = self.sim.cache.stats()
+            self.statusBar().showMessage("Data loaded successfully (cache: %d hits, %d misses)." %
+                                         (stats["hits"], stats["misses"]), 1500)
             for key, value in data.items():
                 self.data[key] = value
-            self.timer.stop()
-            self.progress.hide()
             self.saveToFileBtn.setEnabled(True)
             return True
 
     def prepareMetadataPanel(self, data):
         if self._finishLoading(data):
-            self._metaIdx = self.stackedLayout.count()
-            self.stackedLayout.addWidget(MetadataPanel(data))
-            self.stackedLayout.setCurrentIndex(self._metaIdx)
+            self._showPanel(MetadataPanel(data), "metadata")
         print("loaded metadata")
 
     def prepareContactsPanel(self, data):
         if self._finishLoading(data):
-            self._contactsIdx = self.stackedLayout.count()
-            self.stackedLayout.addWidget(ContactsPanel(self.sim, data))
-            self.stackedLayout.setCurrentIndex(self._contactsIdx)
+            if self._contactsPanel is None:
+                self._contactsPanel = ContactsPanel(self.sim, data, self.writeContact)
+                self._showPanel(self._contactsPanel, "contacts")
+            else:
+                # the panel was filled while reading, it only needs the free slots
+                self._contactsPanel.data = data
         print("loaded contacts")
 
     def prepareSMSsPanel(self, data):
         if self._finishLoading(data):
-            self._smsIdx = self.stackedLayout.count()
-            self.stackedLayout.addWidget(SMSPanel(data))
-            self.stackedLayout.setCurrentIndex(self._smsIdx)
+            if self._smsPanel is None:
+                self._smsPanel = SMSPanel(data)
+                self._showPanel(self._smsPanel, "smss")
         print("loaded smss")
 
+    def streamContacts(self, data):
+        if self._contactsPanel is None:
+            self._contactsPanel = ContactsPanel(self.sim, dict(contacts=[], free_slots=[]), self.writeContact)
+            self._showPanel(self._contactsPanel, "contacts")
+        self._contactsPanel.appendContacts(data["contacts"])
+
+    def streamSMSs(self, data):
+        if self._smsPanel is None:
+            self._smsPanel = SMSPanel(dict(smss=[]))
+            self._showPanel(self._smsPanel, "smss")
+        self._smsPanel.appendSMSs(data["smss"])
+
+    def _showPanel(self, panel, key):
+        """ adds the panel of a dataset, it is brought up only if the user is waiting for it """
+        idx = self.stackedLayout.count()
+        self.stackedLayout.addWidget(panel)
+        self._panelIdx[key] = idx
+        if self.wanted == key and self.stackedLayout.currentIndex() == self._blankIdx:
+            self.progress.hide()
+            self.stackedLayout.setCurrentIndex(idx)
+        return idx
+
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
-    if len(sys.argv) > 1:
+    if len(sys.argv) > 2:
+        ex = SimReader(port=sys.argv[1], baudrate=int(sys.argv[2]))
+    elif len(sys.argv) > 1:
         ex = SimReader(port=sys.argv[1])
     else:
         ex = SimReader()
@@ -0,0 +1,412 @@
+""" asyncio facade of pySIMlib, needs Python 3.7 or newer
+
+    One event loop drives any number of readers, every await is a point where a
+    session can be cancelled, and every APDU has a timeout:
+
+        sim = AsyncSIM(openAsyncTransport("tcp://localhost:7816"))
+        await sim.open_session()
+        await sim.verify_pin("1234")
+        async for recNum, sms in sim.iter_sms():
+            ...
+
+    The records are decoded with the pySIMlib helpers, the I/O is done here.
+"""
+import asyncio
+import sys
+from binascii import hexlify, unhexlify
+
+from pySIMlib import pySIMlib, parseFCI, SW_OK
+from pySIMtransport import ACK_NULL, DEFAULT_BAUDRATE, parseATR, remoteError
+
+
+def _hex(data):
+    return hexlify(data).decode("ascii").upper()
+
+
+def _atr(raw):
+    try:
+        return parseATR(raw.decode("latin-1"))
+    except ValueError:
+        return None
+
+
+class AsyncTransport:
+    """ non-blocking reader interface used by AsyncSIM
+
+        open()            : coroutine, resets the card, result : if(0) OK else error
+        close()           : releases the reader
+        transmit(command) : coroutine, command as a string of hexadecimal characters,
+                            result tuple(data, sw) like pySIMlib.sendAPDU
+        abort()           : called when a transmit was cancelled or timed out,
+                            the reader has to drop whatever the card still sends
+    """
+
+    atr = None
+    baudrate = None
+
+    async def open(self):
+        return 0
+
+    def close(self):
+        pass
+
+    async def transmit(self, command):
+        raise NotImplementedError
+
+    def abort(self):
+        pass
+
+
+class AsyncTCPTransport(AsyncTransport):
+    """ client of a pySIMtransport.TransportServer reader daemon, same line protocol as TCPTransport """
+
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self.reader = None
+        self.writer = None
+
+    async def _request(self, line):
+        if self.writer is None:
+            raise IOError("the connection was aborted, open the session again")
+        self.writer.write((line + "\n").encode("ascii"))
+        await self.writer.drain()
+        answer = (await self.reader.readline()).decode("ascii").rstrip("\r\n")
+        if not answer:
+            raise IOError("remote reader closed the connection")
+        return answer.split(" ")
+
+    async def open(self):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(*self.address)
+        answer = await self._request("RESET")
+        if answer[0] != "OK":
+            return remoteError(answer)
+        self.atr = _atr(unhexlify(answer[1])) if answer[1] != "-" else None
+        self.baudrate = int(answer[2]) if answer[2] != "-" else None
+        return 0
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+    async def transmit(self, command):
+        answer = await self._request("APDU " + command)
+        if answer[0] != "OK":
+            raise IOError("remote reader: " + " ".join(answer[1:]))
+        return answer[2], "" if answer[1] == "-" else answer[1]
+
+    def abort(self):
+        # the answer of the cancelled request would be taken for the next one
+        self.close()
+
+
+class AsyncSerialTransport(AsyncTransport):
+    """ Phoenix-style reader on a serial port (see SerialTransport), read without blocking
+        through the event loop. POSIX only, the session stays at 9600 baud (no PPS).
+
+        timeout : seconds the card may stay silent before a read gives up
+    """
+
+    def __init__(self, port, timeout=1.0):
+        self.port = port
+        self.timeout = timeout
+        self.serialport = None
+        self.loop = None
+        self.buffer = bytearray()
+        # created by _read, before Python 3.10 an Event binds to the loop current at creation
+        self.event = None
+        self.baudrate = DEFAULT_BAUDRATE
+
+    def _readable(self):
+        data = self.serialport.read(self.serialport.in_waiting or 1)
+        if data:
+            self.buffer += data
+            if self.event is not None:
+                self.event.set()
+
+    async def _read(self, n):
+        """ returns n bytes, fewer if the card is silent for self.timeout """
+        if self.event is None:
+            self.event = asyncio.Event()
+        while len(self.buffer) < n:
+            self.event.clear()
+            try:
+                await asyncio.wait_for(self.event.wait(), self.timeout)
+            except asyncio.TimeoutError:
+                break
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    async def _write(self, data):
+        self.serialport.write(data)
+        # rx and tx are tied together, the echo comes back
+        return await self._read(len(data)) == data
+
+    async def open(self):
+        import serial
+
+        if self.serialport is None:
+            self.serialport = serial.Serial(port=self.port, parity=serial.PARITY_EVEN, bytesize=serial.EIGHTBITS,
+                                            stopbits=serial.STOPBITS_TWO, timeout=0, baudrate=DEFAULT_BAUDRATE)
+            self.loop = asyncio.get_running_loop()
+            self.loop.add_reader(self.serialport.fileno(), self._readable)
+
+        self.serialport.setRTS(1)
+        self.serialport.setDTR(1)
+        await asyncio.sleep(0.01)
+        self.serialport.reset_input_buffer()
+        del self.buffer[:]
+        self.serialport.setRTS(0)
+        self.serialport.setDTR(0)
+
+        ts = await self._read(1)
+        if not ts:
+            return 2  # no card?
+        if ts != b"\x3B":
+            return 3  # bad ATR byte
+        # the ATR is complete when it parses, or when the card stops sending
+        raw = ts
+        while True:
+            self.atr = _atr(raw)
+            if self.atr is not None:
+                return 0
+            more = await self._read(1)
+            if not more:
+                return 2
+            raw += more
+
+    def close(self):
+        if self.serialport is not None:
+            self.loop.remove_reader(self.serialport.fileno())
+            self.serialport.close()
+        self.serialport = None
+        self.event = None
+
+    async def transmit(self, command):
+        """ T=0 exchange, the same steps as SerialTransport._sendAPDUframed """
+        header = unhexlify(command[:10])
+        if not await self._write(header):
+            return "", ""
+        ins = header[1]
+        while True:
+            rep = await self._read(1)
+            if not rep:
+                return "", ""
+            rep = rep[0]
+            if rep == ins:
+                break
+            if (rep & 0xF0) in (0x60, 0x90) and rep != ACK_NULL:
+                # the card refused the command and sent SW1 instead of the INS
+                sw2 = await self._read(1)
+                return ("", "%02x%02x" % (rep, sw2[0])) if sw2 else ("", "")
+            if rep != ACK_NULL:
+                return "", ""
+
+        data = ""
+        if len(command) == 10:
+            data = _hex(await self._read(header[4]))
+        else:
+            await self._write(unhexlify(command[10:10 + header[4] * 2]))
+
+        while True:
+            sw1 = await self._read(1)
+            if not sw1 or sw1[0] != ACK_NULL:
+                break
+        sw2 = await self._read(1)
+        if not sw1 or not sw2:
+            return data, ""
+        return data, "%02x%02x" % (sw1[0], sw2[0])
+
+    def abort(self):
+        del self.buffer[:]
+        if self.serialport is not None:
+            self.serialport.reset_input_buffer()
+
+
+def openAsyncTransport(portname, timeout=1.0):
+    """openAsyncTransport(portname)
+
+        portname : "tcp://host:port" of a reader daemon (see pySIMtransport.py),
+                   anything else is a serial port name
+    """
+    if portname.startswith("tcp://"):
+        host, port = portname[6:].rsplit(":", 1)
+        return AsyncTCPTransport(host, int(port))
+    return AsyncSerialTransport(portname, timeout)
+
+
+class AsyncSIM:
+    """ coroutine version of the pySIMlib readers
+
+        transport : AsyncTransport, see openAsyncTransport
+        timeout   : seconds an APDU may take before send_apdu raises asyncio.TimeoutError
+    """
+
+    def __init__(self, transport, timeout=5.0):
+        self.transport = transport
+        self.timeout = timeout
+        # file ids, path tracking and record decoders of the blocking library
+        self.lib = pySIMlib()
+        self.atr = None
+        self.apduCount = 0
+        self.chv1_enabled = 0
+        self.chv1_tries_left = 0
+
+    async def open_session(self):
+        """ resets the card, result : if(0) OK else error """
+        self.lib.currentPath = None
+        self.lib.fciCache = {}
+        err = await asyncio.wait_for(self.transport.open(), self.timeout)
+        if err:
+            return err
+        self.atr = self.transport.atr
+        await self.check_chv()
+        return 0
+
+    def close_session(self):
+        self.transport.close()
+        self.lib.currentPath = None
+        self.lib.fciCache = {}
+
+    async def send_apdu(self, command, timeout=None):
+        """ result : tuple(data, sw) like pySIMlib.sendAPDU """
+        self.apduCount += 1
+        path, self.lib.currentPath = self.lib.currentPath, None
+        try:
+            data, sw = await asyncio.wait_for(self.transport.transmit(command), timeout or self.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            self.transport.abort()
+            raise
+        if sw[:2].upper() in ("90", "91", "9F"):
+            self.lib.currentPath = path
+        return data, sw
+
+    async def set_file(self, dirList, force=False):
+        """ selects dirList with the SELECTs pySIMlib.setFile would send, result : SW of the last one """
+        start = self.lib._selectStart(dirList)
+        if force and start == len(dirList):
+            start -= 1
+        sw = None
+        for i in range(start, len(dirList)):
+            data, sw = await self.send_apdu("A0A4000002" + dirList[i])
+            if sw[:2].upper() not in ("90", "9F"):
+                self.lib.currentPath = None
+                return sw
+            self.lib.currentPath = dirList[:i + 1]
+        return sw
+
+    async def check_chv(self):
+        await self.set_file([self.lib.FILE_MF])
+        data, sw = await self.send_apdu("A0F200000D")
+        if sw != SW_OK:
+            return
+        data, sw = await self.send_apdu("A0F20000%02X" % (0x0D + int(data[24:26], 16)))
+        s = bytearray(unhexlify(data))
+        if len(s) > 18:
+            self.chv1_enabled = 0 if s[13] & 0x80 else 1
+            self.chv1_tries_left = s[18] & 0x0F
+
+    async def verify_pin(self, pin):
+        data, sw = await self.send_apdu("A020000108" + self.lib._ASCII2PIN(pin))
+        return sw == SW_OK
+
+    async def read_binary(self, path, length):
+        await self.set_file(path)
+        data, sw = await self.send_apdu("A0B00000%02X" % length)
+        return data
+
+    async def get_metadata(self):
+        lib = self.lib
+        gsm = [lib.FILE_MF, lib.FILE_DF_GSM]
+        files = [("ICCID", [lib.FILE_MF, lib.FILE_EF_ICCID], 10), ("LP", gsm + [lib.FILE_EF_LP], 1),
+                 ("IMSI", gsm + [lib.FILE_EF_IMSI], 9), ("KC", gsm + [lib.FILE_EF_KC], 9),
+                 ("HPLMN", gsm + [lib.FILE_EF_HPLMN], 1), ("SST", gsm + [lib.FILE_EF_SST], 2),
+                 ("BCCH", gsm + [lib.FILE_EF_BCCH], 16), ("ACC", gsm + [lib.FILE_EF_ACC], 2),
+                 ("FPLMN", gsm + [lib.FILE_EF_FPLMN], 12), ("LOCI", gsm + [lib.FILE_EF_LOCI], 11),
+                 ("AD", gsm + [lib.FILE_EF_AD], 3), ("Phase", gsm + [lib.FILE_EF_PHASE], 1)]
+        metadata = {}
+        for key, path, length in files:
+            metadata[key] = await self.read_binary(path, length)
+        return metadata
+
+    async def _recordInfo(self, fileId):
+        """ (recNum, recLen) from the FCI cache of self.lib, see pySIMlib.getFileInfo """
+        path = (self.lib.FILE_MF, self.lib.FILE_DF_TELECOM, fileId)
+        info = self.lib.fciCache.get(path)
+        if info is None:
+            sw = await self.set_file(list(path), force=True)
+            if sw is None or sw[:2].upper() != "9F":
+                raise IOError("%s is not a record file on this card" % fileId)
+            data, sw = await self.send_apdu("A0C00000" + sw[2:])
+            info = self.lib.fciCache[path] = parseFCI(data)
+        if not info.get("recLen"):
+            raise IOError("%s is not a record file on this card" % fileId)
+        return info["recNum"], info["recLen"]
+
+    async def _readRecord(self, fileId, recNum, length):
+        await self.set_file([self.lib.FILE_MF, self.lib.FILE_DF_TELECOM, fileId])
+        return await self.send_apdu("A0B2%02X04%02X" % (recNum, length))
+
+    async def iter_nums(self, numFile):
+        """ async generator of tuple(recNum, (name, number)) for the used records, the whole file is read
+            like pySIMlib.iterNums
+        """
+        recNum, recLen = await self._recordInfo(numFile)
+        for i in range(1, recNum + 1):
+            data, sw = await self._readRecord(numFile, i, recLen)
+            name, number = self.lib.decodeNum(data, recLen - 14)
+            if name and number:
+                yield i, (name, number)
+
+    async def iter_sms(self):
+        """ async generator of tuple(recNum, sms) for the used SMS records, found with a status pre-scan """
+        recNum, recLen = await self._recordInfo(self.lib.FILE_EF_SMS)
+        for i in range(1, recNum + 1):
+            data, sw = await self._readRecord(self.lib.FILE_EF_SMS, i, 2)
+            if sw == SW_OK and not (int(data[0:2], 16) & 1) and data[2:4] == 'FF':
+                continue
+            data, sw = await self._readRecord(self.lib.FILE_EF_SMS, i, recLen)
+            sms = self.lib.decodeSMS(data)
+            if sms:
+                yield i, sms
+
+
+async def dump(portname, pin=None, timeout=5.0):
+    """ reads metadata, contacts and messages of the card in one reader """
+    sim = AsyncSIM(openAsyncTransport(portname), timeout)
+    err = await sim.open_session()
+    if err:
+        raise IOError("could not open %s (error %d)" % (portname, err))
+    try:
+        if sim.chv1_enabled and not (pin and await sim.verify_pin(pin)):
+            raise IOError("%s: PIN needed or wrong" % portname)
+        data = {"metadata": await sim.get_metadata()}
+        data["contacts"] = [contact async for recNum, contact in sim.iter_nums(sim.lib.FILE_EF_ADN)]
+        data["smss"] = dict([sms async for sms in sim.iter_sms()])
+        return data
+    finally:
+        sim.close_session()
+
+
+async def main(portnames, pin=None):
+    results = await asyncio.gather(*[dump(name, pin) for name in portnames], return_exceptions=True)
+    for name, result in zip(portnames, results):
+        if isinstance(result, Exception):
+            print("%s: %s" % (name, result))
+        else:
+            print("%s: ICCID %s, %d contacts, %d SMS" % (name, result["metadata"]["ICCID"], len(result["contacts"]),
+                                                          len(result["smss"])))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("usage: python3 pySIMasync.py [--pin <pin>] <port> [<port> ...]")
+        sys.exit(1)
+    args = sys.argv[1:]
+    pin = None
+    if args[0] == "--pin":
+        pin, args = args[1], args[2:]
+    asyncio.run(main(args, pin))
@@ -0,0 +1,270 @@
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+from pySIMlib import pySIMlib, dumpCard, writeJSON
+from pySIMtransport import Transport, openTransport
+
+
+class PINError(Exception):
+    pass
+
+
+def acquireCard(sim, pin=None):
+    """acquireCard(sim, pin)
+
+        reads metadata, contacts and messages of the card in an open session
+        pin    : CHV1, needed when it is enabled on the card
+        result : dict with the keys of the GUI export (metadata, contacts, free_slots, smss)
+    """
+    if sim.chv1_enabled:
+        if pin is None:
+            raise PINError("the card needs a PIN")
+        if not sim.verPIN(pin):
+            # never try twice, the card would be blocked after three attempts
+            raise PINError("wrong PIN, %d tries left" % sim.chv1_tries_left)
+
+    return dumpCard(sim)
+
+
+class ReaderWorker(threading.Thread):
+    """ drives one reader: waits for a card, acquires it, waits until it is removed
+
+        transport    : pySIMtransport.Transport of the reader
+        engine       : BatchEngine the results and events go to
+        pollInterval : seconds between checks for an inserted or removed card
+    """
+
+    def __init__(self, name, transport, engine, pollInterval=1.0):
+        threading.Thread.__init__(self, name="reader %s" % name)
+        self.daemon = True
+        self.port = name
+        self.transport = transport
+        self.engine = engine
+        self.pollInterval = pollInterval
+        self.sim = pySIMlib()
+        self.state = "waiting"
+        self.cards = 0
+        self.errors = 0
+        self.lastError = None
+        self._stopEvent = threading.Event()
+
+    def stop(self):
+        self._stopEvent.set()
+
+    def stopped(self):
+        return self._stopEvent.is_set()
+
+    def run(self):
+        while not self.stopped():
+            try:
+                self._waitForCard()
+                if self.stopped():
+                    break
+                self._acquire()
+                self._waitForRemoval()
+            except Exception as e:
+                # errors stay with this reader, the others keep going
+                self.errors += 1
+                self.lastError = str(e)
+                self.state = "error"
+                self.engine._event(self, "error", detail=str(e))
+                if self.sim.state:
+                    self._waitForRemoval()
+                else:
+                    self._stopEvent.wait(self.pollInterval)
+            finally:
+                self._close()
+
+    def _close(self):
+        if self.sim.state:
+            try:
+                self.sim.closeSession()
+            except Exception:
+                self.sim.state = False
+                self.sim.transport = None
+
+    def _waitForCard(self):
+        self.state = "waiting"
+        while not self.stopped():
+            if not self.sim.openSession(self.transport):
+                return
+            self._stopEvent.wait(self.pollInterval)
+
+    def _acquire(self):
+        self.state = "reading"
+        self.engine._event(self, "inserted")
+        start = time.time()
+        apdus = self.sim.apduCount
+        data = acquireCard(self.sim, self.engine.pin)
+        data["reader"] = self.port
+        data["seconds"] = time.time() - start
+        data["apdus"] = self.sim.apduCount - apdus
+        self.engine._saveResult(self, data)
+        self.cards += 1
+        self.state = "done"
+        self.engine._event(self, "done", iccid=data["metadata"]["ICCID"], seconds=data["seconds"])
+
+    def _waitForRemoval(self):
+        """ polls the card with STATUS until it stops answering """
+        if not self.sim.state:
+            return
+        while not self.stopped():
+            self._stopEvent.wait(self.pollInterval)
+            try:
+                data, sw = self.sim._STATUS("0D")
+            except Exception:
+                sw = ""
+            if not sw:
+                break
+        self.engine._event(self, "removed")
+
+
+class BatchEngine:
+    """ headless acquisition on many readers at once, one thread per reader
+
+        ports        : list of port names (see pySIMtransport.openTransport) or Transport objects
+        outdir       : directory the results are written to, one <ICCID>.json per card
+        pin          : CHV1 tried once on cards that have it enabled
+        timeout      : seconds before a read from a reader gives up
+        pollInterval : seconds between checks for inserted and removed cards
+        images       : also save a card image (<ICCID>.simg) of every card
+    """
+
+    def __init__(self, ports, outdir, pin=None, timeout=1, pollInterval=1.0, images=False):
+        self.outdir = outdir
+        self.pin = pin
+        self.images = images
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.started = None
+        self.workers = []
+        for i, port in enumerate(ports):
+            if isinstance(port, Transport):
+                name, transport = str(i), port
+            else:
+                name, transport = str(port), openTransport(port, timeout=timeout)
+            self.workers.append(ReaderWorker(name, transport, self, pollInterval))
+
+    def addListener(self, listener):
+        """addListener(listener)
+
+            listener : function called with (worker, event, info) from the reader threads,
+                       event is one of "inserted", "done", "error", "removed"
+        """
+        self.listeners.append(listener)
+
+    def _event(self, worker, event, **info):
+        for listener in list(self.listeners):
+            listener(worker, event, info)
+
+    def _saveResult(self, worker, data):
+        iccid = data["metadata"]["ICCID"] or "unknown-%s" % time.time()
+        filename = os.path.join(self.outdir, "%s.json" % iccid)
+        with self.lock:
+            if not os.path.isdir(self.outdir):
+                os.makedirs(self.outdir)
+        writeJSON(data, filename)
+        if self.images:
+            worker.sim.saveImage(os.path.join(self.outdir, "%s.simg" % iccid))
+
+    def start(self):
+        self.started = time.time()
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self, wait=True):
+        for worker in self.workers:
+            worker.stop()
+        if wait:
+            for worker in self.workers:
+                worker.join()
+
+    def stats(self):
+        elapsed = time.time() - self.started if self.started else 0.0
+        cards = sum([w.cards for w in self.workers])
+        return {"elapsed": elapsed, "cards": cards, "errors": sum([w.errors for w in self.workers]),
+                "cardsPerHour": cards * 3600.0 / elapsed if elapsed else 0.0,
+                "readers": [{"port": w.port, "state": w.state, "cards": w.cards, "errors": w.errors,
+                             "lastError": w.lastError} for w in self.workers]}
+
+    def report(self):
+        stats = self.stats()
+        lines = ["%-20s %-8s %6s %6s" % ("reader", "state", "cards", "errors")]
+        for r in stats["readers"]:
+            lines.append("%-20s %-8s %6d %6d" % (r["port"], r["state"], r["cards"], r["errors"]))
+        lines.append("%d cards, %d errors in %.1f s, %.0f cards per hour" % (stats["cards"], stats["errors"],
+                                                                            stats["elapsed"], stats["cardsPerHour"]))
+        return "\n".join(lines)
+
+
+def virtualReaders(readers, cards, latency):
+    """ VirtualTransports fed by an operator thread: each finished card is pulled and the next one inserted
+
+        result : tuple(list of transports, listener for BatchEngine.addListener)
+    """
+    from pySIMvirtual import VirtualTransport, createCard
+
+    queue = [createCard(contacts=[("Contact %d" % j, "+386401%05d" % j) for j in range(i % 50)],
+                        iccid="981032%014d" % i, pinEnabled=False) for i in range(cards)]
+    lock = threading.Lock()
+    transports = [VirtualTransport(None, latency=latency, byteTime=12.0 / 115200) for i in range(readers)]
+
+    def nextCard(transport):
+        with lock:
+            transport.insert(queue.pop(0) if queue else None)
+
+    def operator(worker, event, info):
+        if event in ("done", "error"):
+            worker.transport.remove()
+        elif event == "removed":
+            nextCard(worker.transport)
+
+    for transport in transports:
+        nextCard(transport)
+    return transports, operator
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Reads every card inserted into any of the readers.")
+    parser.add_argument("ports", nargs="*", help="serial ports, tcp://host:port or pcsc://reader")
+    parser.add_argument("--out", default="cards", help="directory for the <ICCID>.json results")
+    parser.add_argument("--pin", help="PIN tried once on cards that have it enabled")
+    parser.add_argument("--timeout", type=float, default=1, help="seconds before a reader read gives up")
+    parser.add_argument("--poll", type=float, default=1.0, help="seconds between card presence checks")
+    parser.add_argument("--images", action="store_true", help="also save a card image of every card")
+    parser.add_argument("--report", type=float, default=10, help="seconds between progress reports")
+    parser.add_argument("--virtual", type=int, metavar="N", help="use N virtual readers instead of ports")
+    parser.add_argument("--cards", type=int, default=20, help="cards fed to the virtual readers")
+    args = parser.parse_args(argv[1:])
+
+    ports, operator = args.ports, None
+    if args.virtual:
+        ports, operator = virtualReaders(args.virtual, args.cards, latency=0.001)
+    if not ports:
+        parser.error("no readers given")
+
+    engine = BatchEngine(ports, args.out, args.pin, args.timeout, args.poll, args.images)
+    if operator:
+        engine.addListener(operator)
+    engine.addListener(lambda worker, event, info: event in ("done", "error") and
+                       print("%s: %s %s" % (worker.port, event, info.get("iccid") or info.get("detail"))))
+    engine.start()
+    try:
+        while True:
+            time.sleep(args.report)
+            print(engine.report())
+            if args.virtual and engine.stats()["cards"] + engine.stats()["errors"] >= args.cards:
+                break
+    except KeyboardInterrupt:
+        pass
+    engine.stop()
+    print(engine.report())
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,375 @@
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from binascii import hexlify, unhexlify
+
+from pySIMlib import pySIMlib, writeJSON
+from pySIMtransport import ACK_NULL, DEFAULT_BAUDRATE, SerialTransport
+from pySIMsms import assembleSMS, decodePDU
+from pySIMvirtual import VirtualSerial, VirtualTransport, concatSMS, createCard, encodeSMS
+
+# INS codes of commands where the card sends the data body (case 2)
+OUTGOING_INS = (0xB0, 0xB2, 0xC0, 0xF2, 0x12)
+
+
+class LoopbackSerial:
+    """ Stand-in for serial.Serial with tied RX/TX lines.
+
+        Every write is echoed back, the card answers each header with
+        'nulls' ACK_NULL procedure bytes followed by the INS, a body of
+        0xFF bytes for outgoing commands and 9000. Every read/write call
+        is counted and costs 'latency' seconds, every byte on the wire
+        costs 12 bit times at 'baudrate' (start, 8 data, parity, 2 stop).
+    """
+
+    def __init__(self, latency=0.001, baudrate=9600, nulls=1):
+        self.latency = latency
+        self.baudrate = baudrate
+        self.nulls = nulls
+        self.calls = 0
+        self.rx = ""
+        self.header = ""
+        self.pending = 0
+
+    def _wait(self, nbytes):
+        self.calls += 1
+        delay = self.latency + nbytes * 12.0 / self.baudrate
+        if delay:
+            time.sleep(delay)
+
+    def write(self, data):
+        self._wait(0)
+        self.rx += data
+        for c in data:
+            if self.pending:
+                self.pending -= 1
+                if not self.pending:
+                    self.rx += "\x90\x00"
+                continue
+            self.header += c
+            if len(self.header) == 5:
+                self._answer(self.header)
+                self.header = ""
+
+    def _answer(self, header):
+        ins, p3 = ord(header[1]), ord(header[4])
+        self.rx += chr(ACK_NULL) * self.nulls + chr(ins)
+        if ins in OUTGOING_INS or not p3:
+            self.rx += "\xFF" * p3 + "\x90\x00"
+        else:
+            self.pending = p3
+
+    def read(self, size=1):
+        data, self.rx = self.rx[:size], self.rx[size:]
+        self._wait(len(data))
+        return data
+
+    def close(self):
+        pass
+
+
+def benchAPDU(command, framed, count, latency, baudrate):
+    sim = pySIMlib()
+    port = LoopbackSerial(latency, baudrate)
+    sim.transport = SerialTransport(port, framed=framed)
+    start = time.time()
+    for i in range(count):
+        sim.sendAPDU(command)
+    elapsed = time.time() - start
+    return float(port.calls) / count, elapsed * 1000.0 / count
+
+
+def benchFrames(count, latency, baudrate):
+    """ prints calls and time per APDU for the framed and the byte-at-a-time transport """
+    commands = [("SELECT", "A0A40000026F3C"),
+                ("GET RESPONSE", "A0C000000F"),
+                ("READ RECORD 176", "A0B20104B0"),
+                ("UPDATE RECORD 28", "A0DC01041C" + "FF" * 28)]
+
+    print("%d APDUs each, %.1f ms per call, %d baud" % (count, latency * 1000, baudrate))
+    print("%-18s %12s %12s %12s %12s" % ("APDU", "calls/old", "calls/new", "ms/old", "ms/new"))
+    for name, command in commands:
+        oldCalls, oldTime = benchAPDU(command, False, count, latency, baudrate)
+        newCalls, newTime = benchAPDU(command, True, count, latency, baudrate)
+        print("%-18s %12.1f %12.1f %12.2f %12.2f" % (name, oldCalls, newCalls, oldTime, newTime))
+
+
+def unpackSeptetsLoop(sim, data):
+    """ GSM7bit_2_Ascii as it was before the table driven unpacking, one septet per loop pass """
+    i = 0
+    mask = 0x7F
+    last = 0
+    res = []
+    for c in bytearray(unhexlify(data)):
+        res.append(((c & mask) << i) + (last >> (8 - i)))
+        i += 1
+        mask >>= 1
+        last = c
+        if i % 7 == 0:
+            res.append(last >> 1)
+            i = 0
+            mask = 0x7F
+            last = 0
+    return sim.GSM3_38_2_ASCII(bytearray(res))
+
+
+def benchSeptets(count, repeat):
+    """ prints the time to unpack 'count' random 7-bit messages of 0..140 bytes with both decoders """
+    sim = pySIMlib()
+    rand = random.Random(count)
+    messages = [hexlify(bytearray([rand.randint(0, 255) for j in range(rand.randint(0, 140))])).decode("ascii")
+                for i in range(count)]
+    for data in messages:
+        if sim.GSM7bit_2_Ascii(data) != unpackSeptetsLoop(sim, data):
+            raise AssertionError("decoders differ on %s" % data)
+
+    septets = sum([len(data) // 2 + len(data) // 14 for data in messages])
+    print("%d messages, %d septets" % (count, septets))
+    print("%-18s %12s %12s" % ("decoder", "ms", "Msept/s"))
+    for name, decode in (("loop", lambda: [unpackSeptetsLoop(sim, data) for data in messages]),
+                         ("table", lambda: sim.GSM7bit_2_AsciiBatch(messages))):
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            decode()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print("%-18s %12.2f %12.2f" % (name, best * 1000, septets / best / 1e6 if best else 0.0))
+
+
+def smsCorpus(count):
+    """ 'count' EF_SMS records: 7-bit, UCS2 and 8-bit messages and parts of concatenated ones """
+    rand = random.Random(count)
+    records = []
+    while len(records) < count:
+        kind = rand.randint(0, 3)
+        number = "+386402%05d" % rand.randint(0, 99999)
+        if kind == 0:
+            records.append(encodeSMS(number, "Message %d " % len(records) * rand.randint(1, 10)))
+        elif kind == 1:
+            records.append(encodeSMS(number, u"Sporo\u010dilo %d \u20ac" % len(records) * rand.randint(1, 4),
+                                     alphabet="ucs2"))
+        elif kind == 2:
+            records.append(encodeSMS(number, bytes(bytearray([rand.randint(0, 255) for i in range(120)])),
+                                     alphabet="8bit"))
+        else:
+            parts = concatSMS(number, "Long message %d " % len(records) * 30, reference=len(records) % 256)
+            records.extend([encodeSMS(*part) for part in parts])
+    return records[:count]
+
+
+def checkExport(records):
+    """ writes the decoded records with writeJSON, as the dump command does, and compares what is read back """
+    smss = dict(enumerate([decodePDU(record) for record in records]))
+    # a latin-1 name next to the unicode texts of the messages
+    name = "Jos" + chr(0xE9)
+    fd, filename = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    try:
+        writeJSON({"contacts": [(name, "+38640123456")], "smss": smss}, filename)
+        with io.open(filename, encoding="utf-8") as infile:
+            loaded = json.load(infile)
+    finally:
+        os.remove(filename)
+    if loaded["contacts"][0][0] != u"Jos\xe9":
+        raise AssertionError("contact name %r after the export" % loaded["contacts"][0][0])
+    for recNum, sms in smss.items():
+        if loaded["smss"][str(recNum)][3] != sms[3]:
+            raise AssertionError("SMS %d differs after the export: %r" % (recNum, sms[3]))
+
+
+def benchPDUs(count, repeat):
+    """ prints the time to decode and reassemble 'count' SMS records """
+    sim = pySIMlib()
+    records = smsCorpus(count)
+    checkExport(records)
+    hexRecords = [hexlify(record).decode("ascii").upper() for record in records]
+    print("%d records, %d bytes" % (count, sum([len(record) for record in records])))
+    print("%-18s %12s %12s" % ("step", "ms", "records/s"))
+    for name, run in (("decodePDU", lambda: [decodePDU(record) for record in records]),
+                      ("smsFromData (hex)", lambda: [sim.smsFromData(data) for data in hexRecords]),
+                      ("assembleSMS", lambda: assembleSMS(enumerate([decodePDU(r) for r in records])))):
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            run()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print("%-18s %12.2f %12.0f" % (name, best * 1000, count / best if best else 0.0))
+
+
+# card fill levels: (contacts, SMS) out of 250 ADN and 250 SMS records
+SCENARIOS = [("empty", 0, 0),
+             ("half-full", 125, 125),
+             ("250 SMS", 0, 250),
+             ("250 contacts", 250, 0)]
+
+OPERATIONS = [("checkCHV", lambda sim: sim.checkCHV()),
+              ("getNums(ADN)", lambda sim: sim.getNums(sim.FILE_EF_ADN)),
+              ("getSMSs", lambda sim: sim.getSMSs()),
+              ("loadMetadata", lambda sim: sim.getMetadata()),
+              # time to the first used record of the streaming readers
+              ("first contact", lambda sim: next(sim.iterNums(sim.FILE_EF_ADN), None)),
+              ("first SMS", lambda sim: next((sms for sms in sim.iterSMS() if sms[1]), None))]
+
+
+def scanFirstFree(sim, numFile):
+    """ the ADN read before the scan engine: by record number, up to the first free record """
+    recNum, recLen, nameLen = sim.getNumInfo(numFile)
+    for i in range(1, recNum + 1):
+        name, number = sim.getNum(numFile, i, recLen, nameLen)
+        if not name or not number:
+            break
+
+
+def scanAbsolute(sim, numFile):
+    """ the whole file by record number """
+    recNum, recLen, nameLen = sim.getNumInfo(numFile)
+    for i in range(1, recNum + 1):
+        sim.getNum(numFile, i, recLen, nameLen)
+
+
+# ways of reading EF_ADN compared by --scan
+SCAN_OPERATIONS = [("first free", lambda sim: scanFirstFree(sim, sim.FILE_EF_ADN)),
+                   ("absolute", lambda sim: scanAbsolute(sim, sim.FILE_EF_ADN)),
+                   ("next (getNums)", lambda sim: sim.getNums(sim.FILE_EF_ADN))]
+
+
+# one contact lookup ("Contact 12" matches 12 and 120 - 129) with SEEK on the card and on the host
+LOOKUP_OPERATIONS = [("find (SEEK)", lambda sim: sim.findContact(sim.FILE_EF_ADN, "Contact 12")),
+                     ("find (SEEK 1)", lambda sim: sim.findContact(sim.FILE_EF_ADN, "Contact 12", seekType=1)),
+                     ("find (scan)", lambda sim: sim.findContact(sim.FILE_EF_ADN, "Contact 12", seek=False))]
+
+
+def fillCard(contacts, smss):
+    contacts = [("Contact %d" % i, "+386401%05d" % i) for i in range(contacts)]
+    smss = [("+386402%05d" % i, "Message number %d sent to the virtual card" % i, "17031514%02d2100" % (i % 60))
+            for i in range(smss)]
+    return createCard(contacts=contacts, smss=smss, adnRecords=250, smsRecords=250)
+
+
+def runOperation(scenario, operation, args):
+    name, contacts, smss = scenario
+    sleep = time.sleep if args.realtime else None
+    if args.transport == "apdu":
+        port = VirtualTransport(fillCard(contacts, smss), latency=args.latency,
+                                byteTime=12.0 / (args.baudrate or 115200), sleep=sleep)
+    else:
+        port = VirtualSerial(fillCard(contacts, smss), latency=args.latency, nulls=args.nulls, sleep=sleep)
+    sim = pySIMlib()
+    if sim.openSession(port, args.baudrate):
+        raise RuntimeError("could not open the virtual card")
+    sim.verPIN("1234")
+
+    apdus, ioTime, elapsed = sim.apduCount, sim.ioTime, port.elapsed
+    written, read = port.bytesWritten, port.bytesRead
+    start = time.time()
+    operation[1](sim)
+    wall = time.time() - start
+    io = sim.ioTime - ioTime
+    if not args.realtime:
+        # the port only modelled the transfer time, add it to the measured time
+        io += port.elapsed - elapsed
+        wall += port.elapsed - elapsed
+    sim.closeSession()
+
+    return {"scenario": name, "operation": operation[0],
+            "apdus": sim.apduCount - apdus,
+            "bytesOut": port.bytesWritten - written,
+            "bytesIn": port.bytesRead - read - (port.bytesWritten - written if args.transport == "serial" else 0),
+            "wall": wall, "io": io, "decode": wall - io}
+
+
+def runSuite(args, operations=OPERATIONS):
+    results = []
+    for scenario in SCENARIOS:
+        for operation in operations:
+            runs = [runOperation(scenario, operation, args) for i in range(args.repeat)]
+            # keep the fastest run, the counters are the same for all of them
+            results.append(min(runs, key=lambda r: r["wall"]))
+    return results
+
+
+def printResults(results, baseline=None):
+    base = {}
+    for r in (baseline or []):
+        base[(r["scenario"], r["operation"])] = r
+
+    print("%-14s %-14s %7s %9s %9s %10s %10s %10s" % ("scenario", "operation", "APDUs", "bytes out", "bytes in",
+                                                       "wall [s]", "io [s]", "decode [s]"))
+    for r in results:
+        line = "%-14s %-14s %7d %9d %9d %10.3f %10.3f %10.4f" % (r["scenario"], r["operation"], r["apdus"],
+                                                                 r["bytesOut"], r["bytesIn"], r["wall"], r["io"],
+                                                                 r["decode"])
+        old = base.get((r["scenario"], r["operation"]))
+        if old:
+            line += "   %+6.1f%% APDUs %+6.1f%% wall" % (change(old["apdus"], r["apdus"]),
+                                                        change(old["wall"], r["wall"]))
+        print(line)
+
+
+def change(old, new):
+    return (new - old) * 100.0 / old if old else 0.0
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks pySIMlib against a virtual card.")
+    parser.add_argument("--latency", type=float, default=0.001, help="seconds per read/write call")
+    parser.add_argument("--baudrate", type=int, default=None, help="highest baud rate to negotiate")
+    parser.add_argument("--nulls", type=int, default=0, help="NULL procedure bytes before every INS")
+    parser.add_argument("--transport", choices=("serial", "apdu"), default="serial",
+                        help="byte-level serial reader or APDU-level reader without echo")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per operation, the fastest is kept")
+    parser.add_argument("--realtime", action="store_true", help="sleep instead of modelling the port time")
+    parser.add_argument("--json", help="save the results to this file")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare with")
+    parser.add_argument("--frames", type=int, metavar="N",
+                        help="only compare framed and byte-at-a-time transport over N APDUs")
+    parser.add_argument("--septets", type=int, metavar="N",
+                        help="only compare the GSM 7-bit decoders on N random messages")
+    parser.add_argument("--scan", action="store_true",
+                        help="only compare the ADN reads by record number and in NEXT mode")
+    parser.add_argument("--lookup", action="store_true",
+                        help="only compare findContact with SEEK and with a host side scan")
+    parser.add_argument("--pdus", type=int, metavar="N",
+                        help="only time the SMS decoder on a corpus of N synthetic records")
+    args = parser.parse_args(argv[1:])
+
+    if args.frames:
+        benchFrames(args.frames, args.latency, args.baudrate or DEFAULT_BAUDRATE)
+        return
+    if args.septets:
+        benchSeptets(args.septets, max(3, args.repeat))
+        return
+    if args.pdus:
+        benchPDUs(args.pdus, max(3, args.repeat))
+        return
+
+    operations = OPERATIONS
+    if args.scan:
+        operations = SCAN_OPERATIONS
+    elif args.lookup:
+        operations = LOOKUP_OPERATIONS
+    results = runSuite(args, operations)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as infile:
+            baseline = json.load(infile)["results"]
+    printResults(results, baseline)
+
+    if args.json:
+        config = {"latency": args.latency, "baudrate": args.baudrate, "nulls": args.nulls, "transport": args.transport,
+                  "repeat": args.repeat, "realtime": args.realtime}
+        with open(args.json, "w") as outfile:
+            json.dump({"config": config, "results": results}, outfile, indent=1)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
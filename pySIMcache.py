@@ -0,0 +1,132 @@
+from __future__ import print_function
+
+import os
+import pickle
+
+# size of the cache directory before the least recently used cards are removed
+DEFAULT_MAX_BYTES = 8 * 1024 * 1024
+
+
+class CardCache:
+    """ on-disk cache of decoded records, one file per card keyed by its ICCID
+
+        Every record is stored with a fingerprint, the hex string of the first
+        bytes of the raw record. pySIMlib reads only the fingerprint of records
+        that are in the cache and the whole record only if it changed.
+
+        directory : where the card files are kept (default ~/.pySIMcache)
+        maxBytes  : size bound of the directory, the least recently used cards are evicted
+    """
+
+    def __init__(self, directory=None, maxBytes=DEFAULT_MAX_BYTES):
+        self.directory = directory or os.path.join(os.path.expanduser("~"), ".pySIMcache")
+        self.maxBytes = maxBytes
+        self.cards = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def _filename(self, iccid):
+        return os.path.join(self.directory, "%s.cache" % iccid)
+
+    def _card(self, iccid):
+        """ returns the cache entry of a card: {"records": {fileId: {recNum: (fingerprint, value)}},
+            "fingerprintLen": {fileId: bytes}}, loaded from disk the first time
+        """
+        card = self.cards.get(iccid)
+        if card is None:
+            card = {"records": {}, "fingerprintLen": {}}
+            try:
+                with open(self._filename(iccid), "rb") as infile:
+                    card = pickle.load(infile)
+                # a read marks the card as recently used
+                os.utime(self._filename(iccid), None)
+            except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+                pass
+            self.cards[iccid] = card
+        return card
+
+    def fingerprintLength(self, iccid, fileId, default):
+        return self._card(iccid)["fingerprintLen"].get(fileId, default)
+
+    def setFingerprintLength(self, iccid, fileId, length):
+        """ called when the card refuses to read part of a record, the old fingerprints are dropped """
+        card = self._card(iccid)
+        card["fingerprintLen"][fileId] = length
+        card["records"].pop(fileId, None)
+
+    def fingerprint(self, iccid, fileId, recNum):
+        """ returns the stored fingerprint of a record, None if it is not cached """
+        entry = self._card(iccid)["records"].get(fileId, {}).get(recNum)
+        return entry[0] if entry is not None else None
+
+    def lookup(self, iccid, fileId, recNum, fingerprint):
+        """lookup(iccid, fileId, recNum, fingerprint)
+
+            result : the cached value if the record has the same fingerprint (a hit), else None
+        """
+        entry = self._card(iccid)["records"].get(fileId, {}).get(recNum)
+        if entry is not None and entry[0] == fingerprint:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def store(self, iccid, fileId, recNum, fingerprint, value):
+        self._card(iccid)["records"].setdefault(fileId, {})[recNum] = (fingerprint, value)
+
+    def invalidate(self, iccid, fileId, recNum=None):
+        """ forgets one record, or the whole file if recNum is None (ex. after writing a cyclic file) """
+        records = self._card(iccid)["records"]
+        if recNum is None:
+            records.pop(fileId, None)
+        elif fileId in records:
+            records[fileId].pop(recNum, None)
+        self.invalidations += 1
+
+    def save(self, iccid):
+        """ writes the card to disk and evicts the least recently used cards over maxBytes """
+        if iccid not in self.cards:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        filename = self._filename(iccid)
+        with open(filename + ".tmp", "wb") as outfile:
+            pickle.dump(self.cards[iccid], outfile, 2)
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(filename + ".tmp", filename)
+        self.evict(keep=filename)
+
+    def evict(self, keep=None):
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".cache"):
+                path = os.path.join(self.directory, name)
+                files.append((os.path.getmtime(path), os.path.getsize(path), path))
+        files.sort()
+        total = sum([f[1] for f in files])
+        for mtime, size, path in files:
+            if total <= self.maxBytes:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            self.cards.pop(os.path.basename(path)[:-len(".cache")], None)
+            total -= size
+            self.evictions += 1
+
+    def clear(self):
+        for iccid in list(self.cards):
+            del self.cards[iccid]
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith(".cache"):
+                    os.remove(os.path.join(self.directory, name))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hitRate": float(self.hits) / lookups if lookups else 0.0,
+                "invalidations": self.invalidations, "evictions": self.evictions}
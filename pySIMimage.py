@@ -0,0 +1,305 @@
+from __future__ import print_function
+
+import mmap
+import struct
+from binascii import hexlify, unhexlify
+
+from pySIMtransport import parseATR
+from pySIMvirtual import VirtualCard, VirtualDF, VirtualEF, VirtualTransport, EF_TRANSPARENT
+
+IMAGE_MAGIC = b"PYSIMIMG"
+IMAGE_VERSION = 1
+
+# magic, version, ATR length, number of files
+HEADER = struct.Struct(">8sHHH")
+# FCI length, structure, flags, record length, number of records, data offset, data length
+ENTRY = struct.Struct(">BBBBHII")
+
+FLAG_READABLE = 0x01
+
+# files probed when a card is acquired, files missing on the card are skipped
+IMAGE_FILES = [
+    ("3F00",),
+    ("3F00", "2FE2"),  # ICCID
+    ("3F00", "7F10"),  # DF_TELECOM
+    ("3F00", "7F10", "6F3A"),  # ADN
+    ("3F00", "7F10", "6F3B"),  # FDN
+    ("3F00", "7F10", "6F3C"),  # SMS
+    ("3F00", "7F10", "6F3D"),  # CCP
+    ("3F00", "7F10", "6F40"),  # MSISDN
+    ("3F00", "7F10", "6F42"),  # SMSP
+    ("3F00", "7F10", "6F43"),  # SMSS
+    ("3F00", "7F10", "6F44"),  # LND
+    ("3F00", "7F10", "6F47"),  # SMSR
+    ("3F00", "7F10", "6F49"),  # SDN
+    ("3F00", "7F10", "6F4A"),  # EXT1
+    ("3F00", "7F10", "6F4B"),  # EXT2
+    ("3F00", "7F10", "6F4C"),  # EXT3
+    ("3F00", "7F20"),  # DF_GSM
+    ("3F00", "7F20", "6F05"),  # LP
+    ("3F00", "7F20", "6F07"),  # IMSI
+    ("3F00", "7F20", "6F20"),  # Kc
+    ("3F00", "7F20", "6F30"),  # PLMNsel
+    ("3F00", "7F20", "6F31"),  # HPLMN
+    ("3F00", "7F20", "6F37"),  # ACMmax
+    ("3F00", "7F20", "6F38"),  # SST
+    ("3F00", "7F20", "6F39"),  # ACM
+    ("3F00", "7F20", "6F3E"),  # GID1
+    ("3F00", "7F20", "6F3F"),  # GID2
+    ("3F00", "7F20", "6F41"),  # PUCT
+    ("3F00", "7F20", "6F45"),  # CBMI
+    ("3F00", "7F20", "6F46"),  # SPN
+    ("3F00", "7F20", "6F74"),  # BCCH
+    ("3F00", "7F20", "6F78"),  # ACC
+    ("3F00", "7F20", "6F7B"),  # FPLMN
+    ("3F00", "7F20", "6F7E"),  # LOCI
+    ("3F00", "7F20", "6FAD"),  # AD
+    ("3F00", "7F20", "6FAE"),  # Phase
+]
+
+
+class ImageFile:
+    """ index entry of one file of a SIMImage """
+
+    def __init__(self, path, fci, structure, readable, recLen, recCount, offset, length):
+        self.path = path
+        self.fci = fci
+        self.structure = structure
+        self.readable = readable
+        self.recLen = recLen
+        self.recCount = recCount
+        self.offset = offset
+        self.length = length
+
+    def isDF(self):
+        return len(self.fci) > 6 and ord(self.fci[6:7]) in (0x01, 0x02)
+
+
+def acquireImage(sim, filename, files=IMAGE_FILES):
+    """acquireImage(sim, filename)
+
+        sim      : pySIMlib with an open session (and CHV1 verified, files behind it are not readable otherwise)
+        filename : image file to write
+        files    : paths of the files to copy, as tuples of file ids
+        result   : number of files saved
+    """
+    entries = []
+    sim._startProgress("image", len(files))
+    for i, path in enumerate(files):
+        entry = _acquireFile(sim, list(path))
+        if entry is not None:
+            entries.append(entry)
+        sim._progress(i + 1)
+
+    atr = sim.atr.raw if sim.atr is not None else b""
+    writeImage(filename, atr, entries)
+    return len(entries)
+
+
+def _acquireFile(sim, path):
+    """ returns (path, fci, structure, readable, recLen, recCount, data) or None if the file does not exist """
+    info = sim.getFileInfo(path)
+    if info is None:
+        return None
+    sim.setFile(path)
+    fci = unhexlify(info["fci"])
+    if len(fci) < 7 or ord(fci[6:7]) != 0x04:
+        return tuple(path), fci, 0, False, 0, 0, b""
+
+    size = (ord(fci[2:3]) << 8) | ord(fci[3:4])
+    structure = ord(fci[13:14]) if len(fci) > 13 else EF_TRANSPARENT
+    recLen = ord(fci[14:15]) if len(fci) > 14 else 0
+    chunks = []
+    if structure == EF_TRANSPARENT:
+        recLen, recCount = 0, 0
+        for off in range(0, size, 0xFF):
+            data, sw = sim._READ_BINARY("%04X" % off, "%02X" % min(0xFF, size - off))
+            if sw != "9000":
+                return tuple(path), fci, structure, False, 0, 0, b""
+            chunks.append(unhexlify(data))
+    else:
+        recCount = size // recLen if recLen else 0
+        for rec in range(1, recCount + 1):
+            data, sw = sim._READ_RECORD("%02X" % rec, "04", "%02X" % recLen)
+            if sw != "9000":
+                return tuple(path), fci, structure, False, recLen, recCount, b""
+            chunks.append(unhexlify(data))
+    return tuple(path), fci, structure, True, recLen, recCount, b"".join(chunks)
+
+
+def writeImage(filename, atr, entries):
+    """writeImage(filename, atr, entries)
+
+        Layout: header, ATR, index of all files, bodies. An index entry is the
+        path (number of file ids and the ids), the ENTRY struct and the FCI.
+        Record i of a file is at data offset + (i - 1) * record length.
+    """
+    indexLen = sum([1 + 2 * len(e[0]) + ENTRY.size + len(e[1]) for e in entries])
+    offset = HEADER.size + len(atr) + indexLen
+
+    with open(filename, "wb") as outfile:
+        outfile.write(HEADER.pack(IMAGE_MAGIC, IMAGE_VERSION, len(atr), len(entries)))
+        outfile.write(atr)
+        for path, fci, structure, readable, recLen, recCount, data in entries:
+            outfile.write(struct.pack(">B", len(path)) + unhexlify("".join(path)))
+            flags = FLAG_READABLE if readable else 0
+            outfile.write(ENTRY.pack(len(fci), structure, flags, recLen, recCount, offset, len(data)))
+            outfile.write(fci)
+            offset += len(data)
+        for entry in entries:
+            outfile.write(entry[-1])
+
+
+class SIMImage:
+    """ card image written by acquireImage
+
+        Only the header and the index are read, the file bodies are
+        sliced out of a read-only mmap of the image when they are needed.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.files = {}
+        with open(filename, "rb") as infile:
+            magic, version, atrLen, count = HEADER.unpack(infile.read(HEADER.size))
+            if magic != IMAGE_MAGIC or version != IMAGE_VERSION:
+                raise ValueError("%s is not a card image" % filename)
+            self.atr = infile.read(atrLen)
+            for i in range(count):
+                pathLen = ord(infile.read(1))
+                path = hexlify(infile.read(2 * pathLen)).upper()
+                if not isinstance(path, str):
+                    path = path.decode("ascii")
+                path = tuple([path[j:j + 4] for j in range(0, len(path), 4)])
+                fciLen, structure, flags, recLen, recCount, offset, length = ENTRY.unpack(infile.read(ENTRY.size))
+                fci = infile.read(fciLen)
+                self.files[path] = ImageFile(path, fci, structure, bool(flags & FLAG_READABLE), recLen, recCount,
+                                             offset, length)
+            self.map = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        self.map.close()
+
+    def readBinary(self, path, offset=0, length=None):
+        f = self.files[tuple(path)]
+        if length is None:
+            length = f.length - offset
+        offset = min(offset, f.length)
+        return self.map[f.offset + offset:f.offset + min(f.length, offset + length)]
+
+    def readRecord(self, path, recNum):
+        f = self.files[tuple(path)]
+        start = f.offset + (recNum - 1) * f.recLen
+        return self.map[start:start + f.recLen]
+
+
+class _MappedData:
+    """ body of a transparent file, sliced from the mmap on access """
+
+    def __init__(self, image, path, length):
+        self.image = image
+        self.path = path
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, s):
+        start, stop, step = s.indices(self.length)
+        return self.image.readBinary(self.path, start, stop - start)
+
+
+class _MappedRecords:
+    """ records of a record file, sliced from the mmap on access """
+
+    def __init__(self, image, path, count):
+        self.image = image
+        self.path = path
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError(i)
+        return self.image.readRecord(self.path, i + 1)
+
+
+class ImageCard(VirtualCard):
+    """ read-only VirtualCard answering from a SIMImage
+
+        The FCIs are the ones saved from the card. CHV1 was verified when the
+        image was taken, so every PIN is accepted, and files that could not be
+        read then answer 9804. Updates answer 9804 too.
+    """
+
+    def __init__(self, image):
+        self.image = image
+        nodes = {}
+        root = None
+        for path in sorted(image.files, key=len):
+            f = image.files[path]
+            if f.isDF():
+                node = VirtualDF(path[-1])
+            elif f.structure == EF_TRANSPARENT:
+                node = VirtualEF(path[-1], data=_MappedData(image, path, f.length), chv=False)
+            else:
+                node = VirtualEF(path[-1], records=_MappedRecords(image, path, f.recCount if f.readable else 0),
+                                 recLen=f.recLen, structure=f.structure, chv=False)
+            node.fci = f.fci
+            node.readable = f.readable
+            nodes[path] = node
+            if len(path) == 1:
+                root = node
+            elif path[:-1] in nodes:
+                nodes[path[:-1]].add(node)
+        if root is None:
+            raise ValueError("%s has no MF" % image.filename)
+        VirtualCard.__init__(self, root, atr=image.atr, pin="", pinEnabled=False)
+
+    def _fileResponse(self, f):
+        return f.fci
+
+    def _checkEF(self, structures):
+        sw = VirtualCard._checkEF(self, structures)
+        if not sw and not self.currentEF.readable:
+            return 0x9804
+        return sw
+
+    def _checkPIN(self, data):
+        self.pinVerified = True
+        return 0x9000
+
+    def _updateBinary(self, p1, p2, p3, body):
+        return "", 0x9804
+
+    def _updateRecord(self, p1, p2, p3, body):
+        return "", 0x9804
+
+
+class ImageTransport(VirtualTransport):
+    """ opens a card image like a reader, see pySIMlib.openSession("image://<file>") """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.image = None
+        VirtualTransport.__init__(self, None, latency=0.0, byteTime=0.0, sleep=None)
+
+    def open(self):
+        self.image = SIMImage(self.filename)
+        self.card = ImageCard(self.image)
+        self.card.reset()
+        try:
+            self.atr = parseATR(self.card.atr)
+        except ValueError:
+            self.atr = None
+        return 0
+
+    def close(self):
+        if self.image is not None:
+            self.image.close()
+        self.image = None
+        self.card = None
@@ -4,24 +4,23 @@ from __future__ import print_function
 from __future__ import print_function
 from __future__ import print_function
 import time
+
+# start of the import of pySIMlib, the --timing option of the command line measures from here
+IMPORT_START = time.time()
+
 import calendar
+import io
 import os
 from binascii import hexlify, unhexlify
 
+from pySIMtransport import (ACK_NULL, DEFAULT_BAUDRATE, FI_TABLE, DI_TABLE, ATR, readATR, parseATR,
+                            Transport, SerialTransport, openTransport)
+
 
 def print_exc():
     print("Error")
 
 
-try:
-    SerialError = 0
-    import serial
-except ImportError:
-    SerialError = 1
-    import traceback
-
-    traceback.print_exc()
-
 SCARD_PROTOCOL_T0 = 1
 SCARD_PROTOCOL_T1 = 2
 
@@ -37,16 +36,198 @@ ATTRIBUTE_ATR = 0x90303
 ATTRIBUTE_VENDOR_NAME = 0x10100
 ATTRIBUTE_VENDOR_SERIAL_NO = 0x10103
 
-ACK_NULL = 0x60
 ACK_OK = 0x90
 
+# file types and EF structures of the GET RESPONSE of a SELECT (GSM 11.11 9.2.1)
+FILE_TYPE_MF = 0x01
+FILE_TYPE_DF = 0x02
+FILE_TYPE_EF = 0x04
+EF_STRUCTURE_TRANSPARENT = 0x00
+EF_STRUCTURE_LINEAR_FIXED = 0x01
+EF_STRUCTURE_CYCLIC = 0x03
+
+# access condition levels, 4 - E are ADM
+ACCESS_ALW = 0x0
+ACCESS_CHV1 = 0x1
+ACCESS_CHV2 = 0x2
+ACCESS_NEV = 0xF
+
+
+# GSM 3.38 default alphabet characters that differ from ASCII
+GSM_3_38_TO_ASCII = {0x00: '@',  # @ At symbol
+                     0x01: '',  #  Britain pound symbol
+                     0x02: '$',  # $ Dollar symbol
+                     0x03: chr(0xA5),  #  Yen symbol
+                     0x04: '',  #  e accent grave
+                     0x05: '',  #  e accent aigu
+                     0x06: '',  #  u accent grave
+                     0x07: chr(0xEC),  #  i accent grave
+                     0x08: chr(0xF2),  #  o accent grave
+                     0x09: chr(0xC7),  #  C majuscule cedille
+                     0x0A: chr(0x0A),  # LF Line Feed
+                     0x0B: chr(0xD8),  #  O majuscule barr
+                     0x0C: chr(0xF8),  #  o minuscule barr
+                     0x0D: chr(0x0D),  # CR Carriage Return
+                     0x0E: chr(0xC5),  #  Angstroem majuscule
+                     0x0F: chr(0xE5),  #  Angstroem minuscule
+                     0x11: '_',  # underscore
+                     0x1C: chr(0xC6),  #  majuscule ae
+                     0x1D: chr(0xE6),  #  minuscule ae
+                     0x1E: chr(0xDF),  #  s dur allemand
+                     0x1F: chr(0xC9),  #  majuscule 
+
+                     0x20: ' ',
+                     0x21: '!',
+                     0x22: '\"',  # guillemet
+                     0x23: '#',
+                     0x24: '',  #  carr
+
+                     0x40: chr(0xA1),  #  point d'exclamation renvers
+                     0x5B: chr(0xC4),  #  majuscule A trema
+                     0x5C: chr(0xD6),  #  majuscule O trema
+                     0x5D: chr(0xD1),  #  majuscule N tilda espagnol
+                     0x5E: chr(0xDC),  #  majuscule U trema
+                     0x5F: chr(0xA7),  #  signe paragraphe
+                     0x60: chr(0xBF),  #  point interrogation renvers
+                     0x7B: chr(0xE4),  #  minuscule a trema
+                     0x7C: chr(0xF6),  #  minuscule o trema
+                     0x7D: chr(0xF1),  #  minuscule n tilda espagnol
+                     0x7E: chr(0xFC),  #  minuscule u trema
+                     0x7F: ''  # a accent grave
+                     }
+
+# septet -> character as a translate table (septets are 7-bit, the upper half is never used)
+_GSM7_TABLE = "".join([GSM_3_38_TO_ASCII.get(c, chr(c)) for c in range(256)])
+if bytes is not str:
+    _GSM7_TABLE = _GSM7_TABLE.encode("latin-1")
+
+# GSM7bit_2_Ascii unpacks up to 224 bytes (256 septets) at once: the bytes are read as one
+# little-endian integer and every septet k is moved up by k bits, in 8 mask-and-shift steps
+# (by 128, 64, ..., 1 bits), so that each septet ends up in a byte of its own
+_SEPTET_CHUNK = 224
+_SEPTET_STEPS = []
+for _step in (128, 64, 32, 16, 8, 4, 2, 1):
+    _mask = 0
+    for _k in range(256):
+        if _k & _step:
+            # septet k has already moved by the higher bits of k
+            _mask |= 0x7F << (7 * _k + (_k & ~((_step << 1) - 1)))
+    _SEPTET_STEPS.append((_step, _mask))
+del _step, _mask, _k
+
+
+def unpackSeptets(raw):
+    """unpackSeptets(raw)
+
+        raw    : bytes (or a buffer like memoryview) of 7-bit packed septets
+        result : bytes with one septet per byte
+    """
+    septets = []
+    for off in range(0, len(raw), _SEPTET_CHUNK):
+        part = raw[off:off + _SEPTET_CHUNK]
+        count = len(part) + len(part) // 7
+        x = _fromLittleEndian(part)
+        for step, mask in _SEPTET_STEPS:
+            x = (x & ~mask) | ((x & mask) << step)
+        septets.append(_toLittleEndian(x & ((1 << 8 * count) - 1), count))
+    return b"".join(septets)
+
+
+if hasattr(int, "from_bytes"):
+    def _fromLittleEndian(data):
+        return int.from_bytes(data, "little")
+
+    def _toLittleEndian(x, count):
+        return x.to_bytes(count, "little")
+else:
+    def _fromLittleEndian(data):
+        return int(hexlify(bytearray(data)[::-1]), 16) if len(data) else 0
+
+    def _toLittleEndian(x, count):
+        return unhexlify("%0*x" % (2 * count, x))[::-1]
+
+
+def septetsToText(septets):
+    """ converts bytes of septets with the GSM 3.38 table """
+    text = septets.translate(_GSM7_TABLE)
+    return text if bytes is str else text.decode("latin-1")
+
+
+def parseFCI(data):
+    """parseFCI(data)
+
+        data   : hexadecimal string of the GET RESPONSE after a SELECT
+        result : dict with "fileId", "type" (FILE_TYPE_*), "size" and "fci" (data), for EFs also
+                 "structure" (EF_STRUCTURE_*), "recLen", "recNum" (0 for transparent EFs),
+                 "invalidated" and "access", the dict of the access condition levels (ACCESS_*)
+                 of "read", "update", "increase", "rehabilitate" and "invalidate"
+    """
+    fci = bytearray(unhexlify(data))
+    if len(fci) < 7:
+        raise ValueError("file control information of %d bytes" % len(fci))
+    info = {"fileId": "%02X%02X" % (fci[4], fci[5]), "type": fci[6], "size": (fci[2] << 8) | fci[3],
+            "fci": data.upper()}
+    if fci[6] != FILE_TYPE_EF:
+        return info
+    if len(fci) < 13:
+        raise ValueError("EF control information of %d bytes" % len(fci))
+    structure = fci[13] if len(fci) > 13 else EF_STRUCTURE_TRANSPARENT
+    recLen = fci[14] if len(fci) > 14 and structure != EF_STRUCTURE_TRANSPARENT else 0
+    info.update(structure=structure, recLen=recLen, recNum=info["size"] // recLen if recLen else 0,
+                invalidated=not (fci[11] & 0x01),
+                access={"read": fci[8] >> 4, "update": fci[8] & 0x0F, "increase": fci[9] >> 4,
+                        "rehabilitate": fci[10] >> 4, "invalidate": fci[10] & 0x0F})
+    return info
+
 
 class pySIMlib:
-    def __init__(self, dbg=False):
+    def __init__(self, dbg=False, framed=True):
         self.debug = dbg
+        # write/read whole APDU frames instead of one byte per call (serial readers)
+        self.framed = framed
 
         self.state = False
-        self.serialport = None
+        # Transport to the reader, see pySIMtransport
+        self.transport = None
+
+        # baud rate of the open session and the fastest rate the reader can do
+        self.baudrate = DEFAULT_BAUDRATE
+        self.maxBaudrate = 115200
+        # parsed answer to reset of the card
+        self.atr = None
+
+        # path of the currently selected file, None when it is not known
+        self.currentPath = None
+        # True while nothing but GET RESPONSE was sent after the last SELECT, the record
+        # pointer of the selected EF is then before the first record
+        self.freshSelect = False
+        # number of APDUs sent since the object was created and the seconds spent sending them
+        self.apduCount = 0
+        self.ioTime = 0.0
+        # time.time() when the first APDU was sent
+        self.firstAPDUTime = None
+        # functions called with a dict for every APDU, see addAPDUHook
+        self.apduHooks = []
+        # bytes of commands sent and of data and status words received
+        self.bytesOut = 0
+        self.bytesIn = 0
+
+        # functions called with a progress event dict while files are read, see _progress
+        self.progressListeners = []
+        self._progressState = None
+
+        # optional pySIMcache.CardCache of decoded records, set it before openSession
+        self.cache = None
+        # ICCID of the card in the reader, the cache key
+        self.cardId = None
+        # used EF_SMS records found by the last iterSMS/getSMSbitmap, see getSMSbitmap
+        self.smsBitmap = None
+        # status word of the first READ RECORD of the last record read by _readRecordCached
+        self.recordSW = None
+        # parseFCI of the files selected in this session by tuple(path), see getFileInfo
+        self.fciCache = {}
+        # pySIMphonebook.SlotMap of the phonebook files by file id, see getSlotMap
+        self.slotMaps = {}
 
         self.chv1_enabled = 0
         self.chv1_tries_left = 0
@@ -78,78 +259,48 @@ class pySIMlib:
         self.FILE_EF_FPLMN = "6F7B"
         self.FILE_EF_AD = "6FAD"
 
-    def openSession(self, portname):
+    def openSession(self, portname, baudrate=None):
         """openSession(portname)
 
-            portname : string of serila port name
+            portname : string of serila port name, "tcp://host:port" of a remote
+                       reader daemon, "pcsc://[reader]" of a PC/SC reader,
+                       "image://<file>" of a saved card image (see saveImage), an object
+                       with the serial.Serial interface (ex. pySIMvirtual.VirtualSerial)
+                       or a pySIMtransport.Transport
+            baudrate : highest baud rate to negotiate with PPS
+                       (default self.maxBaudrate, 9600 disables PPS)
             result  : if(0) OK else error
         """
-        self.serialport = serial.Serial(port=portname,
-                                        parity=serial.PARITY_EVEN,
-                                        bytesize=serial.EIGHTBITS,
-                                        stopbits=serial.STOPBITS_TWO,
-                                        timeout=1,
-                                        xonxoff=0,
-                                        rtscts=0,
-                                        baudrate=9600)
-        if (not self.serialport):
-            return 1
+        if isinstance(portname, Transport):
+            self.transport = portname
+        else:
+            self.transport = openTransport(portname, baudrate or self.maxBaudrate, self.framed, self.debug)
+        self.currentPath = None
+        self.fciCache = {}
+        self.slotMaps = {}
 
-        # reset it!
-        self.serialport.setRTS(1)
-        self.serialport.setDTR(1)
-        time.sleep(0.01)  # 10ms?
-        self.serialport.flushInput()
-        self.serialport.setRTS(0)
-        self.serialport.setDTR(0)
-
-        ts = self.serialport.read()
-        if ts == None:
-            return 2  # no card?
-        if ord(ts) != 0x3B:
-            return 3  # bad ATR byte
-        # ok got 0x3B
-        if (self.debug): print("TS: 0x%x Direct convention" % ord(ts))
-
-        t0 = chr(0x3B)
-        while ord(t0) == 0x3b:
-            t0 = self.serialport.read()
-
-        if t0 == None:
-            return 2
-        if (self.debug): print("T0: 0x%x" % ord(t0))
-
-        # read interface bytes
-        if (ord(t0) & 0x10):
-            if (self.debug): print("TAi = %x" % ord(self.serialport.read()))
-        if (ord(t0) & 0x20):
-            if (self.debug): print("TBi = %x" % ord(self.serialport.read()))
-        if (ord(t0) & 0x40):
-            if (self.debug): print("TCi = %x" % ord(self.serialport.read()))
-        if (ord(t0) & 0x80):
-            tdi = self.serialport.read()
-            if (self.debug): print("TDi = %x" % ord(tdi))
-
-        for i in range(0, ord(t0) & 0xF):
-            x = self.serialport.read()
-            if (self.debug): print("HI: %x" % ord(x))
-
-        while 1:
-            x = self.serialport.read()
-            if (x == ""):
-                break
-            if (self.debug): print("read: %x" % ord(x))
+        err = self.transport.open()
+        if err:
+            return err
+        self.atr = self.transport.atr
+        self.baudrate = self.transport.baudrate
 
         self.state = True
         self.checkCHV()
+        self.cardId = self.getICCID() if self.cache is not None else None
         return 0
 
     def closeSession(self):
         """closeSession()
         """
-        self.serialport.close()
-        self.serialport = None
+        self._saveCache()
+        self.cardId = None
+        self.transport.close()
+        self.transport = None
         self.state = False
+        self.currentPath = None
+        self.fciCache = {}
+        self.slotMaps = {}
         return 0
 
     def sendAPDU(self, command, checkSW=False, refSW=""):
@@ -161,61 +312,67 @@ class pySIMlib:
                       sw   : string (in hex) of status word (ex. "9000")
         """
         if (self.debug): print("CM: " + command)
-        # send first 5 'header' bytes
-        for i in range(5):
-            s = int(command[i * 2] + command[i * 2 + 1], 16)
-            self.serialport.write(chr(s))
-            # because rx and tx are tied together, we will read an echo
-            self.serialport.read()
-
-        while 1:
-            rep = self.serialport.read()
-            time.sleep(0.001)
-            # check that it is echoing the INS (second byte)
-            if (ord(rep) == int(command[2] + command[3], 16)):
-                if (self.debug): print("RS: OK")
-                break
-            if (ord(rep) != ACK_NULL):
-                if (self.debug): print("RS: BAD %X" % ord(rep))
-                return ("", "")  # bad response
-            if (self.debug): print("RS: NULL")
-
-        data = ''
-        if (len(command) == 10):
-            # read data
-            datalen = int(command[8] + command[9], 16)
-            for i in range(datalen):
-                s = ord(self.serialport.read())
-                hexed = "%02X" % s
-                data += hexed[0]
-                data += hexed[1]
-        else:
-            # time to send command
-            datalen = int(command[8] + command[9], 16)
-            for i in range(datalen):
-                s = int(command[10 + i * 2] + command[11 + i * 2], 16)
-                self.serialport.write(chr(s))
-                # because rx and tx are tied together, we will read an echo
-                self.serialport.read()
-
-        # look for the ack word, but ignore a 0x60
-        while 1:
-            sw1 = self.serialport.read()
-            if (ord(sw1) != ACK_NULL):
-                break
-        sw2 = self.serialport.read()
-        sw = "%02x%02x" % (ord(sw1), ord(sw2))
-        if self.debug: print("SW: " + sw)
+        self.apduCount += 1
+        # forget the selection until the card has answered normally
+        path, self.currentPath = self.currentPath, None
+        start = time.time()
+        if self.firstAPDUTime is None:
+            self.firstAPDUTime = start
+        hooks = self.apduHooks
+        if hooks:
+            self.transport.timings = timings = {"nulls": 0}
+        data, sw = self.transport.transmit(command)
+        end = time.time()
+        self.ioTime += end - start
+        if hooks:
+            self.transport.timings = None
+            self._traceAPDU(command, data, sw, path, start, end, timings)
+        self.bytesOut += len(command) // 2
+        self.bytesIn += len(data) // 2 + len(sw) // 2
+        if sw[:2].upper() in ("90", "91", "9F"):
+            self.currentPath = path
+        ins = command[2:4].upper()
+        if ins != "C0":
+            self.freshSelect = ins == "A4"
 
         if checkSW:
             if sw != refSW:
-                raise RuntimeError("Status words do not match. Result: %s, Expected: %s" % (sw, matchSW))
+                raise RuntimeError("Status words do not match. Result: %s, Expected: %s" % (sw, refSW))
 
         return data, sw
-        if data:
-            return data, sw
-        else:
-            return '', sw
+
+    def addAPDUHook(self, hook):
+        """addAPDUHook(hook)
+
+            hook : function called after every APDU with a dict:
+                   seq, cla, ins, p1, p2, p3 : counter and header bytes
+                   bytesOut, bytesIn         : bytes of the command and of data plus SW
+                   start, duration           : time.time() when it was sent and seconds it took
+                   toProcedure, toSW         : seconds to the first procedure byte and to the SW,
+                                               None when the transport can not tell
+                   nulls                     : NULL procedure bytes (0 when unknown)
+                   sw, path                  : status word and selected path when it was sent
+
+            see pySIMtrace.APDUTrace. Without hooks sendAPDU does no extra work.
+        """
+        self.apduHooks.append(hook)
+
+    def removeAPDUHook(self, hook):
+        if hook in self.apduHooks:
+            self.apduHooks.remove(hook)
+
+    def _traceAPDU(self, command, data, sw, path, start, end, timings):
+        header = [int(command[i:i + 2], 16) for i in range(0, 10, 2)]
+        event = {"seq": self.apduCount, "cla": header[0], "ins": header[1], "p1": header[2], "p2": header[3],
+                 "p3": header[4], "bytesOut": len(command) // 2, "bytesIn": len(data) // 2 + len(sw) // 2,
+                 "start": start, "duration": end - start, "toProcedure": None, "toSW": None,
+                 "nulls": timings["nulls"], "sw": sw, "path": "/".join(path) if path else None}
+        if "procedure" in timings:
+            event["toProcedure"] = timings["procedure"] - start
+        if "sw" in timings:
+            event["toSW"] = timings["sw"] - start
+        for hook in list(self.apduHooks):
+            hook(event)
 
     def _SELECT(self, fileId):
         rdata, sw = self.sendAPDU("A0A4000002" + fileId)
@@ -270,10 +427,12 @@ class pySIMlib:
         return sw
 
     def _INVALIDATE(self):
+        self._forgetFileInfo()
         rdata, sw = self.sendAPDU("A004000000")
         return sw
 
     def _REHABILITATE(self):
+        self._forgetFileInfo()
         rdata, sw = self.sendAPDU("A044000000")
         return sw
 
@@ -305,12 +464,86 @@ class pySIMlib:
         rdata, sw = self.sendAPDU("A0140000" + lgth)
         return sw
 
-    def setFile(self, dirList):
+    def setFile(self, dirList, force=False):
         """setFile(dirList)
            dirList: list of files 1 or more
+           force:   select the last file even if it is already selected
+                    (GET RESPONSE needs a preceding SELECT)
+           result:  status word of the last SELECT sent, None if none was needed
+
+           Only the SELECTs needed to get from the current path to dirList are sent.
         """
-        for i in dirList:
-            self._SELECT(i)
+        start = self._selectStart(dirList)
+        if force and start == len(dirList):
+            start -= 1
+        sw = None
+        for i in range(start, len(dirList)):
+            sw = self._SELECT(dirList[i])
+            if sw[:2].upper() not in ("90", "9F"):
+                self.currentPath = None
+                return sw
+            self.currentPath = dirList[:i + 1]
+        return sw
+
+    def getFileInfo(self, dirList):
+        """getFileInfo(dirList)
+
+            dirList : path of the file (ex. [FILE_MF, FILE_DF_TELECOM, FILE_EF_ADN])
+            result  : parseFCI of the file, None if it does not exist
+
+            The file is selected and GET RESPONSE sent the first time only, later calls
+            in the same session answer from self.fciCache without an APDU.
+        """
+        key = tuple(dirList)
+        info = self.fciCache.get(key)
+        if info is not None:
+            return info
+        sw = self.setFile(dirList, force=True)
+        if sw is None or sw[:2].upper() != "9F":
+            return None
+        data, sw = self._GET_RESPONSE(sw[2:])
+        if sw != SW_OK:
+            return None
+        info = self.fciCache[key] = parseFCI(data)
+        return info
+
+    def _forgetFileInfo(self):
+        """ drops the cached FCI of the selected file, its status is about to change """
+        if self.currentPath is not None:
+            self.fciCache.pop(tuple(self.currentPath), None)
+
+    def _recordFileInfo(self, fileId):
+        """ returns (recNum, recLen) of a record EF of DF_TELECOM, raises IOError if it is not one """
+        info = self.getFileInfo([self.FILE_MF, self.FILE_DF_TELECOM, fileId])
+        if info is None or not info.get("recLen"):
+            raise IOError("%s is not a record file on this card" % fileId)
+        return info["recNum"], info["recLen"]
+
+    def _selectStart(self, dirList):
+        """ returns the index in dirList of the first file that has to be selected
+        """
+        cur = self.currentPath
+        if not cur or cur[0] != dirList[0]:
+            return 0
+
+        n = 0
+        while n < len(cur) and n < len(dirList) and cur[n] == dirList[n]:
+            n += 1
+        if n == len(cur) == len(dirList):
+            return n
+
+        # SELECT is relative to the current DF, selecting an EF does not change it
+        curDF = cur if self._isDF(cur[-1]) else cur[:-1]
+        if n >= len(curDF):
+            return n  # target is below the current DF
+        if n == len(curDF) - 1 and n < len(dirList) and self._isDF(dirList[n]):
+            return n  # sibling of the current DF
+        if n == len(dirList) and n == len(curDF) - 1:
+            return n - 1  # parent of the current DF
+        return 0
+
+    def _isDF(self, fileId):
+        return fileId[:2].upper() in ("3F", "5F", "7F")
 
     def checkCHV(self):
         """readBasicInfo()
@@ -406,6 +639,67 @@ class pySIMlib:
         data, sw = self._READ_BINARY("0000", "01")
         return data
 
+    def getMetadata(self):
+        readers = [("ICCID", self.getICCID), ("LP", self.getLP), ("IMSI", self.getIMSI),
+                   ("KC", self.getKC), ("HPLMN", self.getHPLMN), ("SST", self.getSST),
+                   ("BCCH", self.getBCCH), ("ACC", self.getACC), ("FPLMN", self.getFPLMN),
+                   ("LOCI", self.getLOCI), ("AD", self.getAD), ("Phase", self.getPhase)]
+        self._startProgress("metadata", len(readers))
+        metadata = {}
+        for i, (key, reader) in enumerate(readers):
+            metadata[key] = reader()
+            self._progress(i + 1)
+        return metadata
+
+    def addProgressListener(self, listener):
+        """addProgressListener(listener)
+
+            listener : function called with a dict for every record read:
+                       operation : name of the file being read (ex. "SMS")
+                       done      : records read so far
+                       total     : number of records
+                       apdus     : APDUs sent and bytes moved for this operation
+                       bytes
+                       apduTime  : measured seconds per APDU
+                       eta       : estimated seconds left, None before the first record
+        """
+        self.progressListeners.append(listener)
+
+    def removeProgressListener(self, listener):
+        if listener in self.progressListeners:
+            self.progressListeners.remove(listener)
+
+    def _startProgress(self, operation, total):
+        self._progressState = (operation, total, self.apduCount, self.bytesOut + self.bytesIn, self.ioTime)
+        self._progress(0)
+
+    def _progress(self, done):
+        if not self.progressListeners:
+            return
+        operation, total, apduStart, bytesStart, ioStart = self._progressState
+        apdus = self.apduCount - apduStart
+        if apdus:
+            apduTime = (self.ioTime - ioStart) / apdus
+        else:
+            apduTime = self.ioTime / self.apduCount if self.apduCount else 0.0
+        eta = None
+        if done:
+            eta = (total - done) * float(apdus) / done * apduTime
+        event = {"operation": operation, "done": done, "total": total, "apdus": apdus,
+                 "bytes": self.bytesOut + self.bytesIn - bytesStart, "apduTime": apduTime, "eta": eta}
+        for listener in list(self.progressListeners):
+            listener(event)
+
+    def saveImage(self, filename):
+        """saveImage(filename)
+
+            filename : file to write a snapshot of every readable file of the card to,
+                       it can be opened later with openSession("image://" + filename)
+            result   : number of files saved
+        """
+        from pySIMimage import acquireImage
+        return acquireImage(self, filename)
+
     def getPINinfo(self):
         return self.chv1_enabled, self.chv1_tries_left
 
@@ -436,33 +730,180 @@ class pySIMlib:
         return 0
 
     def getNumInfo(self, numFile):
-        self.setFile([self.FILE_MF, self.FILE_DF_TELECOM, numFile])
-
-        # Send the get response command, to find out record length
-        data, sw = self._GET_RESPONSE("0F")
-        recLen = int(data[28:30], 16)  # Usually 0x20
+        recNum, recLen = self._recordFileInfo(numFile)  # recLen is usually 0x20
         nameLen = recLen - 14  # Defined GSM 11.11
-        recNum = int(data[4:8], 16) / recLen
         return recNum, recLen, nameLen
 
     def getNums(self, numFile):
+        free_slots = []
+        numbers = dict(self.iterNums(numFile, free_slots))
+        return numbers, free_slots
+
+    def iterNums(self, numFile, freeSlots=None):
+        """iterNums(numFile, freeSlots)
+
+            yields tuple(recNum, (name, number)) for every used record as soon as it is read
+            freeSlots : optional list the numbers of free records are appended to
+
+            Reading the whole file also sets the slot map of numFile (see getSlotMap).
+        """
+        from pySIMphonebook import SlotMap
+
         recNum, recLen, nameLen = self.getNumInfo(numFile)
+        self._startProgress(numFile, recNum)
+
+        path = [self.FILE_MF, self.FILE_DF_TELECOM, numFile]
+        free = []
+        for i, num in self.scanRecords(path, recNum, recLen, lambda data: self.decodeNum(data, nameLen),
+                                       self._numFree, free):
+            yield i, num
+        if freeSlots is not None:
+            freeSlots.extend(free)
+        cyclic = self.getFileInfo(path)["structure"] == EF_STRUCTURE_CYCLIC
+        self.slotMaps[numFile] = SlotMap(recNum, free, cyclic)
+        self._saveCache()
+
+    def _numFree(self, num):
+        """ a record with no name or no number is free """
+        return len(num[0]) == 0 or len(num[1]) == 0
+
+    def getSlotMap(self, numFile):
+        """getSlotMap(numFile)
+
+            result : pySIMphonebook.SlotMap of the used and free records of numFile. The file is read
+                     in full the first time in a session (getNums and iterNums set it too), setNum,
+                     addContact and importContacts keep it up to date without reading again.
+        """
+        slots = self.slotMaps.get(numFile)
+        if slots is None:
+            for i, num in self.iterNums(numFile):
+                pass
+            slots = self.slotMaps[numFile]
+        return slots
 
-        numbers = {}
-        free_slots = []
+    def addContact(self, numFile, name, number):
+        """addContact(numFile, name, number)
+
+            writes a contact to a free record of numFile found in its slot map, so after the
+            first full read no record is read again. LND entries always go to record 1.
+            result : record number written, None if the file is full or the write failed
+        """
+        slots = self.getSlotMap(numFile)
+        recNum, recLen, nameLen = self.getNumInfo(numFile)
+        rec = slots.allocate()
+        if rec is None:
+            return None
+        if self.setNum(numFile, rec, recLen, nameLen, name, number):
+            if not slots.cyclic:
+                slots.release(rec)
+            return None
+        return rec
+
+    def scanRecords(self, path, recNum, recLen, decode, isFree=None, freeSlots=None, cached=True):
+        """scanRecords(path, recNum, recLen, decode, isFree, freeSlots, cached)
+
+            yields tuple(recNum, value) for the used records of a linear fixed EF, the whole
+            file is read. The EF is selected once and read with READ RECORD in NEXT mode,
+            cards that refuse it are read by record number from there on.
+            path      : list of file ids from the MF to the EF
+            decode    : function returning the value of the hex string of a record
+            isFree    : function telling if a value is a free record (None yields every record)
+            freeSlots : optional list the numbers of free records are appended to
+            cached    : False reads past self.cache (when decode is not the one cached for the file)
+        """
+        fileId = path[-1]
+        if self.currentPath != path or not self.freshSelect:
+            # SELECT puts the record pointer before the first record
+            self.setFile(path, force=True)
+        sequential = True
         for i in range(1, recNum + 1):
-            (name, number) = self.getNum(numFile, i, recLen, nameLen)
-            if len(name) != 0 and len(number) != 0:
-                numbers[i] = (name, number)
+            if sequential and self.currentPath != path:
+                # something else was selected while the caller had the last record
+                sequential = False
+                self.setFile(path)
+            value = self._readRecordCached(fileId, i, recLen, decode, sequential, cached)
+            if sequential and self.recordSW != SW_OK:
+                # an error status forgets the selection
+                sequential = False
+                self.setFile(path)
+                if value is None:
+                    value = self._readRecordCached(fileId, i, recLen, decode, cached=cached)
+            self._progress(i)
+            if isFree is not None and isFree(value):
+                if freeSlots is not None:
+                    freeSlots.append(i)
             else:
-                free_slots = list(range(i, recNum))
+                yield i, value
+
+    def findContact(self, numFile, prefix, backward=False, seekType=2, seek=True):
+        """findContact(numFile, prefix, backward, seekType, seek)
+
+            finds the records of numFile whose name starts with prefix. The card searches
+            with SEEK and only the matching records are read.
+            backward : search from the last record to the first
+            seekType : 2 gets the number of every match with GET RESPONSE, 1 saves that APDU
+                       but the card does not tell where the match is, so every result is
+                       (None, (name, number)) and can not be used to update or delete the
+                       contact; use the default type 2 when the record number is needed
+            seek     : False reads every record and compares on the host, as is done when
+                       the card rejects SEEK
+            result   : list of tuple(recNum, (name, number)) in search order
+        """
+        recNum, recLen, nameLen = self.getNumInfo(numFile)
+        pattern = self.ASCII_2_GSM3_38(prefix)
+        if seek and 0 < len(pattern) <= nameLen:
+            found = self._seekContacts(numFile, recNum, recLen, nameLen, hexlify(pattern).upper(), backward, seekType)
+            if found is not None:
+                return found
+
+        found = [(i, num) for i, num in self.iterNums(numFile) if num[0].startswith(prefix)]
+        if backward:
+            found.reverse()
+        return found
+
+    def _seekContacts(self, numFile, recNum, recLen, nameLen, pattern, backward, seekType):
+        """ returns the matches of a SEEK search or None if the card does not support it.
+            A SEEK that fails after some matches also gives None, findContact then scans
+            the whole file on the host.
+        """
+        path = [self.FILE_MF, self.FILE_DF_TELECOM, numFile]
+        decode = lambda data: self.decodeNum(data, nameLen)
+        found = []
+        # P2: type in the high nibble (0 type 1, 1 type 2), mode in the low nibble:
+        # 0/1 from the first/last record, 2/3 to the next/previous match after the record pointer
+        typeNibble = "1" if seekType == 2 else "0"
+        mode = "1" if backward else "0"
+        while len(found) < recNum:
+            self.setFile(path)
+            data, sw = self._SEEK(typeNibble + mode, "%02X" % (len(pattern) // 2), pattern)
+            sw = sw.upper()
+            if sw == "9404":
+                # pattern not found, the selection did not change
+                self.currentPath = path
                 break
-        return numbers, free_slots
+            if typeNibble == "1":
+                if sw[:2] != "9F":
+                    return None  # SEEK is not supported
+                data, sw = self._GET_RESPONSE("01")
+                rec = int(data, 16)
+                if rec < 1 or rec > recNum or rec in [r for r, num in found]:
+                    break
+                found.append((rec, self._readRecordCached(numFile, rec, recLen, decode)))
+            else:
+                if sw != SW_OK:
+                    return None
+                # the record pointer is on the match
+                data, sw = self._READ_RECORD("00", "04", "%02X" % recLen)
+                found.append((None, decode(data)))
+            mode = "3" if backward else "2"
+        return found
 
     def getNum(self, numFile, recNum, recLen, nameLen):
         self.setFile([self.FILE_MF, self.FILE_DF_TELECOM, numFile])
-        data, sw = self._READ_RECORD("%02X" % recNum, "04", "%02X" % recLen)
+        return self._readRecordCached(numFile, recNum, recLen, lambda data: self.decodeNum(data, nameLen))
 
+    def decodeNum(self, data, nameLen):
+        """ returns tuple(name, number) of the hex string of a phonebook record """
         # Find the end of the name
         name = ""
         number = ""
@@ -482,48 +923,251 @@ class pySIMlib:
         return (name, number)
 
     def setNum(self, numFile, recNum, recLen, nameLen, name='', number=''):
+        """setNum(numFile, recNum, recLen, nameLen, name, number)
+
+            writes record recNum of numFile, an empty name or number frees it. LND is cyclic,
+            its entries are always written to record 1.
+            result : if(0) OK else error
+        """
         self.setFile([self.FILE_MF, self.FILE_DF_TELECOM, numFile])
 
-        if not name:
-            data = "FF" * recLen
-        else:
-            GSMnumber = self.String_2_GSMPhoneNumber(number)
-            data = "%s%s%sFFFF" % (
-                self.padString(hexlify(self.ASCII_2_GSM3_38(name)), nameLen << 1, "F"), "%02X" % (len(GSMnumber) / 2),
-                self.padString(GSMnumber, 22, 'F'))
+        data = self.encodeNum(name, number, recLen, nameLen)
 
         if (numFile == self.FILE_EF_ADN):
             sw = self._UPDATE_RECORD("%02X" % recNum, "04", "%02X" % recLen, data)
-            return 0
+            self._invalidateCache(numFile, recNum)
         elif (numFile == self.FILE_EF_FDN):
             return 1
         elif (numFile == self.FILE_EF_LND):
             sw = self._UPDATE_RECORD("00", "03", "%02X" % recLen, data)
-            return 0
+            # writing a cyclic file moves every record
+            self._invalidateCache(numFile)
+        else:
+            return 1
+        if sw != SW_OK:
+            return 1
+        slots = self.slotMaps.get(numFile)
+        if slots is not None:
+            slots.written(recNum, not self._numFree((name, number)))
+        return 0
 
-    def getSMSinfo(self):
-        self.setFile([self.FILE_MF, self.FILE_DF_TELECOM, self.FILE_EF_SMS])
+    def importContacts(self, numFile, contacts, replace=False):
+        """importContacts(numFile, contacts, replace)
+
+            writes many contacts to a linear fixed phonebook file (ADN) in one pass: the file is
+            selected once, read once in NEXT mode, and the UPDATE RECORDs are sent back to back.
+            Records that already hold the same bytes are not written.
+            contacts : list of (name, number), see pySIMphonebook.readContacts
+            replace  : True writes the contacts to records 1, 2, ... and frees the records after them
+                       (the same phonebook on every card), False keeps the contacts on the card,
+                       leaves out the ones it already has and writes the others to free records
+            result   : dict with "written", "unchanged" (records), "duplicates" (contacts already on
+                       the card), "noSlot" and "invalid" (lists of contacts that were not written;
+                       invalid ones have no name, no number, more than 20 digits or characters other
+                       than 0-9, '*' and '#' after an optional leading '+')
+        """
+        from pySIMphonebook import SlotMap
 
-        # Send the get response command, to find out record length
-        data, sw = self._GET_RESPONSE("0F")
+        if numFile == self.FILE_EF_LND:
+            raise ValueError("LND is cyclic, its records can not be written by number")
+        recNum, recLen, nameLen = self.getNumInfo(numFile)
+        path = [self.FILE_MF, self.FILE_DF_TELECOM, numFile]
+        result = {"written": 0, "unchanged": 0, "duplicates": 0, "noSlot": [], "invalid": []}
+
+        encoded = []
+        for name, number in contacts:
+            digits = number[1:] if number.startswith("+") else number
+            if not name or not digits or len(digits) > 20 or digits.strip("0123456789*#"):
+                result["invalid"].append((name, number))
+                continue
+            # characters outside the GSM 3.38 alphabet become '?'
+            gsmName = ""
+            for c in name[:nameLen]:
+                try:
+                    self.ASCII_2_GSM3_38(c)
+                    gsmName += c
+                except KeyError:
+                    gsmName += "?"
+            encoded.append(((name, number), self.encodeNum(gsmName, number, recLen, nameLen).upper()))
+
+        self._startProgress(numFile, recNum)
+        current = dict(self.scanRecords(path, recNum, recLen, lambda data: data.upper(), cached=False))
+        # free as iterNums and the slot map see it
+        isFree = lambda data: self._numFree(self.decodeNum(data, nameLen))
+
+        target = {}
+        if replace:
+            for i in range(1, recNum + 1):
+                target[i] = encoded[i - 1][1] if i <= len(encoded) else "FF" * recLen
+            result["noSlot"] = [contact for contact, data in encoded[recNum:]]
+        else:
+            onCard = set([data for data in current.values()])
+            free = [i for i in range(1, recNum + 1) if isFree(current[i])]
+            for contact, data in encoded:
+                if data in onCard:
+                    result["duplicates"] += 1
+                elif free:
+                    target[free.pop(0)] = data
+                    onCard.add(data)
+                else:
+                    result["noSlot"].append(contact)
+
+        writes = [(i, data) for i, data in sorted(target.items()) if current[i] != data]
+        result["unchanged"] = len(target) - len(writes)
+        self._startProgress("import", len(writes))
+        try:
+            for done, (i, data) in enumerate(writes):
+                self.setFile(path)
+                sw = self._UPDATE_RECORD("%02X" % i, "04", "%02X" % recLen, data)
+                if sw != SW_OK:
+                    raise IOError("record %d of %s was not written (%s)" % (i, numFile, sw))
+                current[i] = data
+                result["written"] += 1
+                self._progress(done + 1)
+        finally:
+            if result["written"]:
+                self._invalidateCache(numFile)
+            # the scan read every record, the slot map comes for free
+            free = [i for i, data in current.items() if isFree(data)]
+            self.slotMaps[numFile] = SlotMap(recNum, free)
+        return result
+
+    def encodeNum(self, name, number, recLen, nameLen):
+        """ returns the hex string of a phonebook record, an empty name gives a free record
+        """
+        if not name:
+            return "FF" * recLen
+        GSMnumber = self.String_2_GSMPhoneNumber(number)
+        return "%s%s%sFFFF" % (
+            self.padString(hexlify(self.ASCII_2_GSM3_38(name)), nameLen << 1, "F"), "%02X" % (len(GSMnumber) / 2),
+            self.padString(GSMnumber, 22, 'F'))
 
-        recLen = int(data[28:30], 16)  # Should be 0xB0 (176)
-        recNum = int(data[4:8], 16) / recLen
-        return recNum, recLen
+    def getSMSinfo(self):
+        return self._recordFileInfo(self.FILE_EF_SMS)  # recLen should be 0xB0 (176)
 
     def getSMSs(self):
+        return dict(self.iterSMS())
+
+    def iterSMS(self, prescan="read"):
+        """iterSMS(prescan)
+
+            yields tuple(recNum, sms) for every SMS record as soon as it is read,
+            sms is "" for free records
+            prescan : method of getSMSbitmap used to find the used records first,
+                      only those are read in full (None reads every record)
+        """
         recNum, recLen = self.getSMSinfo()
+        self._startProgress("SMS", recNum)
+        bitmap = self._smsBitmap(recNum, prescan) if prescan else None
 
-        smss = {}
+        smsBitmap = []
+        if bitmap is None:
+            records = self.scanRecords([self.FILE_MF, self.FILE_DF_TELECOM, self.FILE_EF_SMS], recNum, recLen,
+                                       self.decodeSMS)
+        else:
+            records = self._readUsedSMS(bitmap, recLen)
+        for i, sms in records:
+            smsBitmap.append(sms != "")
+            yield i, sms
+        self.smsBitmap = smsBitmap
+        self._saveCache()
+
+    def _readUsedSMS(self, bitmap, recLen):
+        for i in range(1, len(bitmap) + 1):
+            sms = self.getSMS(i, recLen) if bitmap[i - 1] else ""
+            self._progress(i)
+            yield i, sms
+
+    def iterMessages(self, prescan="read"):
+        """iterMessages(prescan)
+
+            yields tuple(recNum, message) for every used SMS record, like iterSMS, but the
+            parts of a concatenated message are joined and yielded once the last one is read
+            (recNum is the record of the first part). Messages with parts missing on the card
+            come at the end.
+        """
+        from pySIMsms import SMSIndex
+        index = SMSIndex()
+        for recNum, sms in self.iterSMS(prescan):
+            for message in index.add(recNum, sms):
+                yield message
+        for message in index.flush():
+            yield message
+
+    # status bytes of used SMS records: read, unread, sent, to be sent
+    SMS_STATUS_USED = ("01", "03", "05", "07")
+
+    def getSMSbitmap(self, method="read"):
+        """getSMSbitmap(method)
+
+            method : "read" reads the first two bytes of every record,
+                     "seek" finds the used records with SEEK, a few APDUs on a mostly empty card
+                     (deleted records with data left in them are not found, use "read" for those)
+            result : list of booleans, True for used records (index 0 is record 1)
+
+            Falls back to "read" when the card has no SEEK and to reading whole records
+            when it refuses partial reads.
+        """
+        recNum, recLen = self.getSMSinfo()
+        bitmap = self._smsBitmap(recNum, method)
+        if bitmap is None:
+            bitmap = [sms != "" for i, sms in self.iterSMS(prescan=None)]
+        self.smsBitmap = bitmap
+        return bitmap
+
+    def _smsBitmap(self, recNum, method):
+        """ returns the occupancy of EF_SMS or None if the card can not tell without reading whole records """
+        self.setFile([self.FILE_MF, self.FILE_DF_TELECOM, self.FILE_EF_SMS])
+        if method == "seek":
+            bitmap = self._seekSMSbitmap(recNum)
+            if bitmap is not None:
+                return bitmap
+
+        bitmap = []
+        if not self.freshSelect:
+            # SELECT puts the record pointer before the first record
+            self.setFile([self.FILE_MF, self.FILE_DF_TELECOM, self.FILE_EF_SMS], force=True)
+        sequential = True
         for i in range(1, recNum + 1):
-            smss[i] = self.getSMS(i, recLen)
-        return smss
+            # same test as getSMS: status byte of a used record or an SMSC left in a deleted one
+            if sequential:
+                data, sw = self._READ_RECORD("00", "02", "02")
+                sequential = sw == SW_OK
+                if sw[:2] == "67":
+                    return None  # no partial reads in any mode
+                if not sequential:
+                    self.setFile([self.FILE_MF, self.FILE_DF_TELECOM, self.FILE_EF_SMS])
+            if not sequential:
+                data, sw = self._READ_RECORD("%02X" % i, "04", "02")
+            if sw != SW_OK:
+                return None
+            bitmap.append(bool(int(data[0:2], 16) & 1) or data[2:4] != 'FF')
+        return bitmap
+
+    def _seekSMSbitmap(self, recNum):
+        bitmap = [False] * recNum
+        for status in self.SMS_STATUS_USED:
+            mode = "10"  # type 2 (record number is returned), from the beginning
+            while True:
+                data, sw = self._SEEK(mode, "01", status)
+                if sw.upper() == "9404":
+                    break  # pattern not found
+                if sw.upper() != "9F01":
+                    return None  # SEEK is not supported
+                data, sw = self._GET_RESPONSE("01")
+                rec = int(data, 16)
+                if rec < 1 or rec > recNum or bitmap[rec - 1]:
+                    break
+                bitmap[rec - 1] = True
+                mode = "12"  # next occurrence after the record pointer
+        return bitmap
 
     def getSMS(self, recNum, recLen):
         self.setFile([self.FILE_MF, self.FILE_DF_TELECOM, self.FILE_EF_SMS])
+        return self._readRecordCached(self.FILE_EF_SMS, recNum, recLen, self.decodeSMS)
 
-        data, sw = self._READ_RECORD("%02X" % recNum, "04", "%02X" % recLen)
-
+    def decodeSMS(self, data):
+        """ returns the SMS of the hex string of an EF_SMS record, "" for a free record """
         # See if SMS record is used
         status = int(data[0:2], 16)
         if status & 1 or data[2:4] != 'FF':
@@ -531,46 +1175,80 @@ class pySIMlib:
         else:
             return ""
 
-    def smsFromData(self, data):
-        rawMessage = data
+    # bytes of a record compared with the cache, the rest is read only when they changed.
+    # The first 32 bytes of an SMS record hold its status, SMSC, sender, DCS and time stamp.
+    CACHE_FINGERPRINT_LEN = {"6F3C": 32}
 
-        status = int(data[0:2], 16)
+    def _readRecordCached(self, fileId, recNum, recLen, decode, sequential=False, cached=True):
+        """_readRecordCached(fileId, recNum, recLen, decode, sequential, cached)
 
-        i = int(data[2:4], 16) << 1
-        smsc = self.GSMPhoneNumber_2_String(data[4:4 + i], replaceTonNPI=1)
-        data = data[4 + i:]
-
-        val = int(data[0:2], 16)
-        mti = (val >> 6) & 3
-        mms = (val >> 5) & 1
-        sri = (val >> 4) & 1
-        udhi = (val >> 3) & 1
-        rp = (val >> 2) & 1
-        data = data[2:]
-
-        i = int(data[:2], 16)
-        j = 4 + i + (i % 2)
-        number = self.GSMPhoneNumber_2_String(data[2:j], replaceTonNPI=1)
-        data = data[j:]
-
-        pid = int(data[:2], 16)
-        dcs = int(data[2:4], 16)
-
-        timestamp = self.convertTimestamp(data[4:18])
-
-        udl = int(data[18:20], 16)  # it's meaning is dependant upon dcs value
-        if ((dcs >> 2) & 3) == 0:  # 7-bit, Default alphabet
-            i = ((udl * 7) / 8) << 1
-            if (udl * 7) % 8:
-                i += 2
-            message = self.GSM7bit_2_Ascii(data[20:20 + i])
-        elif ((dcs >> 2) & 3) == 1:  # 8-bit data, binary
-            message = "ERROR: Don't understand 8-bit binary messages"
-        elif ((dcs >> 2) & 3) == 2:  # 16-bit, UCS2 oh hell!  :)
-            message = "ERROR: Don't understand 16-bit UCS2 messages"
+            reads record recNum of the selected file through self.cache
+            decode     : function returning the value of the hex string of the whole record
+            sequential : read the record after the record pointer (NEXT mode), recNum is only
+                         the cache key. The status word is left in self.recordSW.
+            cached     : False reads the record without the cache
+            result     : decoded record, None if the card refused a sequential read
+        """
+        # the first read moves the record pointer, further reads of the record are CURRENT mode
+        first = ("00", "02") if sequential else ("%02X" % recNum, "04")
+        again = ("00", "04") if sequential else first
+        if not cached or self.cache is None or self.cardId is None:
+            data, sw = self._READ_RECORD(first[0], first[1], "%02X" % recLen)
+            self.recordSW = sw
+            if sequential and sw != SW_OK:
+                return None
+            return decode(data)
+
+        fpLen = min(recLen, self.CACHE_FINGERPRINT_LEN.get(fileId, recLen))
+        fpLen = self.cache.fingerprintLength(self.cardId, fileId, fpLen)
+        data = None
+        if fpLen < recLen and self.cache.fingerprint(self.cardId, fileId, recNum) is not None:
+            fingerprint, sw = self._READ_RECORD(first[0], first[1], "%02X" % fpLen)
+            self.recordSW = sw
+            if sw[:2] == "67":
+                # the card only reads whole records, they are the fingerprint from now on
+                self.cache.setFingerprintLength(self.cardId, fileId, recLen)
+                value = self._readRecordCached(fileId, recNum, recLen, decode)
+                self.recordSW = sw
+                return value
         else:
-            message = "ERROR: Don't understand this message format"
-        return status, timestamp, number, message
+            data, sw = self._READ_RECORD(first[0], first[1], "%02X" % recLen)
+            self.recordSW = sw
+            fingerprint = data[:fpLen << 1]
+        if sequential and sw != SW_OK:
+            return None
+
+        value = self.cache.lookup(self.cardId, fileId, recNum, fingerprint)
+        if value is not None:
+            return value
+        if data is None:
+            data, sw = self._READ_RECORD(again[0], again[1], "%02X" % recLen)
+        value = decode(data)
+        if sw == SW_OK:
+            self.cache.store(self.cardId, fileId, recNum, data[:fpLen << 1], value)
+        return value
+
+    def _invalidateCache(self, fileId, recNum=None):
+        if self.cache is not None and self.cardId is not None:
+            self.cache.invalidate(self.cardId, fileId, recNum)
+            self.cache.save(self.cardId)
+
+    def _saveCache(self):
+        if self.cache is not None and self.cardId is not None:
+            self.cache.save(self.cardId)
+
+    def smsFromData(self, data):
+        """smsFromData(data)
+
+            data   : hex string of an EF_SMS record
+            result : pySIMsms.SMSMessage, the tuple (status, timestamp, number, message) with the
+                     other fields of the PDU as attributes
+        """
+        from pySIMsms import SMSMessage, decodePDU
+        try:
+            return decodePDU(unhexlify(data))
+        except ValueError as e:
+            return SMSMessage(int(data[0:2], 16), "", "", "ERROR: %s" % e)
 
     def _ASCII2PIN(self, pin):
         """ converts a PIN code string to a hex string with padding
@@ -581,9 +1259,7 @@ class pySIMlib:
 
             Return a hex string of the PIN with FF padding.
         """
-        from binascii import hexlify
-
-        return hexlify(pin) + (8 - len(pin)) * 'FF'
+        return "".join(["%02X" % ord(c) for c in pin]) + (8 - len(pin)) * 'FF'
 
     def swapNibbles(hexString, paddingNibble='F'):
         """ converts a string in a buffer with swap of each character
@@ -626,6 +1302,8 @@ class pySIMlib:
             phoneString = phoneString[1:]
         else:
             res = "81"
+        # BCD digits A and B are '*' and '#' (GSM 11.11 10.5.1)
+        phoneString = phoneString.replace("*", "A").replace("#", "B")
 
         if len(phoneString) % 2:
             phoneString += "F"
@@ -662,7 +1340,7 @@ class pySIMlib:
         if res and res[-1].upper() == 'F':
             res = res[:-1]
 
-        return res
+        return res.upper().replace("A", "*").replace("B", "#")
 
     def ASCII_2_GSM3_38(self, sName):
         """ converts an ascii name string to a GSM 3.38 name string
@@ -741,57 +1419,15 @@ class pySIMlib:
             sample : "\x00\x01\x02\x04\x05\x06Pascal"
             	     is converted to "@$Pascal"
         """
-        dic_GSM_3_38_toAscii = {0x00: '@',  # @ At symbol
-                                0x01: '',  #  Britain pound symbol
-                                0x02: '$',  # $ Dollar symbol
-                                0x03: chr(0xA5),  #  Yen symbol
-                                0x04: '',  #  e accent grave
-                                0x05: '',  #  e accent aigu
-                                0x06: '',  #  u accent grave
-                                0x07: chr(0xEC),  #  i accent grave
-                                0x08: chr(0xF2),  #  o accent grave
-                                0x09: chr(0xC7),  #  C majuscule cedille
-                                0x0A: chr(0x0A),  # LF Line Feed
-                                0x0B: chr(0xD8),  #  O majuscule barr
-                                0x0C: chr(0xF8),  #  o minuscule barr
-                                0x0D: chr(0x0D),  # CR Carriage Return
-                                0x0E: chr(0xC5),  #  Angstroem majuscule
-                                0x0F: chr(0xE5),  #  Angstroem minuscule
-                                0x11: '_',  # underscore
-                                0x1C: chr(0xC6),  #  majuscule ae
-                                0x1D: chr(0xE6),  #  minuscule ae
-                                0x1E: chr(0xDF),  #  s dur allemand
-                                0x1F: chr(0xC9),  #  majuscule 
-
-                                0x20: ' ',
-                                0x21: '!',
-                                0x22: '\"',  # guillemet
-                                0x23: '#',
-                                0x24: '',  #  carr
-
-                                0x40: chr(0xA1),  #  point d'exclamation renvers
-                                0x5B: chr(0xC4),  #  majuscule A trema
-                                0x5C: chr(0xD6),  #  majuscule O trema
-                                0x5D: chr(0xD1),  #  majuscule N tilda espagnol
-                                0x5E: chr(0xDC),  #  majuscule U trema
-                                0x5F: chr(0xA7),  #  signe paragraphe
-                                0x60: chr(0xBF),  #  point interrogation renvers
-                                0x7B: chr(0xE4),  #  minuscule a trema
-                                0x7C: chr(0xF6),  #  minuscule o trema
-                                0x7D: chr(0xF1),  #  minuscule n tilda espagnol
-                                0x7E: chr(0xFC),  #  minuscule u trema
-                                0x7F: ''  # a accent grave
-                                }
 
         sName = ""
-        for i in gsmName:
-            c = ord(i)
+        for c in bytearray(gsmName):
             if c == 0xFF:  # End of name reached, treat an NULL character
                 break
-            elif dic_GSM_3_38_toAscii.has_key(c):
-                sName += dic_GSM_3_38_toAscii[c]
+            elif c in GSM_3_38_TO_ASCII:
+                sName += GSM_3_38_TO_ASCII[c]
             else:
-                sName += i
+                sName += chr(c)
         return sName
 
     def padString(self, s, length, padding="F"):
@@ -799,23 +1435,21 @@ class pySIMlib:
         return s + padding * l
 
     def GSM7bit_2_Ascii(self, data):
-        i = 0
-        mask = 0x7F
-        last = 0
-        res = []
-        for c in unhexlify(data):
-            val = ((ord(c) & mask) << i) + (last >> (8 - i))
-            res.append(chr(val))
-
-            i += 1
-            mask >>= 1
-            last = ord(c)
-            if i % 7 == 0:
-                res.append(chr(last >> 1))
-                i = 0
-                mask = 0x7F
-                last = 0
-        return self.GSM3_38_2_ASCII(''.join(res))
+        """ unpacks the hex string of 7-bit packed septets and converts them with the GSM 3.38 table
+
+            Every whole septet in the data is returned, the unused bits of the last byte are
+            ignored (a message of 7n + 7 septets comes back with a trailing '@').
+        """
+        return septetsToText(unpackSeptets(unhexlify(data)))
+
+    def GSM7bit_2_AsciiBatch(self, dataList):
+        """GSM7bit_2_AsciiBatch(dataList)
+
+            dataList : list of hex strings of packed septets
+            result   : list of decoded strings, the same as GSM7bit_2_Ascii gives for each
+        """
+        decode = self.GSM7bit_2_Ascii
+        return [decode(data) for data in dataList]
 
     def convertTimestamp(self, ts):
         # 2050107034146B
@@ -837,4 +1471,177 @@ class pySIMlib:
         self.timetuple[5] = int(ts[10]) + int(ts[11]) * 10
         self.timetuple[6] = calendar.weekday(self.timetuple[0], self.timetuple[1], self.timetuple[2])
 
-        return time.asctime(self.timetuple)
+        return time.asctime(tuple(self.timetuple))
+
+
+DUMP_SECTIONS = ("metadata", "contacts", "sms")
+
+
+def dumpCard(sim, what=DUMP_SECTIONS):
+    """dumpCard(sim, what)
+
+        sim    : pySIMlib with an open session (and CHV1 verified)
+        what   : sections to read, any of "metadata", "contacts", "sms"
+        result : dict with the keys of the GUI export (metadata, contacts, free_slots, smss)
+    """
+    data = {}
+    if "metadata" in what:
+        data["metadata"] = sim.getMetadata()
+    if "contacts" in what:
+        numbers = []
+        free_slots = []
+        for numFile in (sim.FILE_EF_ADN, sim.FILE_EF_FDN, sim.FILE_EF_LND):
+            slots = free_slots if numFile == sim.FILE_EF_ADN else None
+            numbers.extend([contact for recNum, contact in sim.iterNums(numFile, slots)])
+        data["contacts"] = numbers
+        data["free_slots"] = free_slots
+    if "sms" in what:
+        data["smss"] = sim.getSMSs()
+    return data
+
+
+def _jsonData(data):
+    """ data with the byte strings of Python 2 as text, pySIMlib reads them as latin-1 (see GSM3_38_2_ASCII) """
+    if isinstance(data, dict):
+        return dict([(_jsonData(key), _jsonData(value)) for key, value in data.items()])
+    if isinstance(data, (list, tuple)):
+        return [_jsonData(value) for value in data]
+    if bytes is str and isinstance(data, bytes):
+        return data.decode("latin-1")
+    return data
+
+
+def writeJSON(data, filename=None):
+    """writeJSON(data, filename)
+
+        writes data (ex. of dumpCard) as UTF-8 JSON to the file, to stdout if filename is None.
+        On Python 2 the names and metadata are latin-1 byte strings while decoded SMS texts
+        are unicode, both end up as the same JSON strings.
+    """
+    import json
+    import sys
+
+    text = json.dumps(_jsonData(data), ensure_ascii=False)
+    if isinstance(text, bytes):
+        text = text.decode("ascii")  # nothing but numbers
+    if filename is None:
+        sys.stdout.write(text.encode("utf-8") if bytes is str else text)
+        return
+    with io.open(filename, "w", encoding="utf-8") as outfile:
+        outfile.write(text)
+
+
+def importFile(args):
+    """ the import command of main """
+    import sys
+    from pySIMphonebook import readContacts
+
+    contacts = readContacts(args.file)
+    sim = pySIMlib()
+    err = sim.openSession(args.port, args.baudrate)
+    if err:
+        print("Could not open %s (error %d)" % (args.port, err), file=sys.stderr)
+        return 1
+    try:
+        if sim.chv1_enabled:
+            if not args.pin:
+                print("The card needs a PIN, use --pin", file=sys.stderr)
+                return 2
+            if not sim.verPIN(args.pin):
+                print("Wrong PIN, %d tries left" % sim.chv1_tries_left, file=sys.stderr)
+                return 3
+        start = time.time()
+        result = sim.importContacts(sim.FILE_EF_ADN, contacts, args.replace)
+    finally:
+        sim.closeSession()
+    print("%d contacts: %d records written, %d unchanged, %d already on the card, %d without a free record, "
+          "%d invalid, %d APDUs in %.1f s" % (len(contacts), result["written"], result["unchanged"],
+                                               result["duplicates"], len(result["noSlot"]), len(result["invalid"]),
+                                               sim.apduCount, time.time() - start))
+    return 0
+
+
+def main(argv):
+    """ command line interface, python -m pySIMlib dump|import --port <port> [--pin <pin>] ...
+
+        Qt is never imported, it runs on hosts without a display.
+    """
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(prog="python -m pySIMlib", description="Reads SIM cards without the GUI.")
+    commands = parser.add_subparsers(dest="command")
+    # optional by default on Python 3, a missing command is a usage error as on Python 2
+    commands.required = True
+    card = argparse.ArgumentParser(add_help=False)
+    card.add_argument("--port", required=True, help="serial port, tcp://host:port, pcsc://[reader] or image://file")
+    card.add_argument("--baudrate", type=int, help="highest baud rate to negotiate")
+    card.add_argument("--pin", help="CHV1, needed when it is enabled on the card")
+    dump = commands.add_parser("dump", parents=[card], help="export metadata, contacts and messages as JSON")
+    dump.add_argument("--what", default=",".join(DUMP_SECTIONS),
+                      help="comma separated sections to read (default %(default)s)")
+    dump.add_argument("--out", help="JSON file to write (default standard output)")
+    dump.add_argument("--timing", action="store_true",
+                      help="print the time from import to the first APDU and to the end on standard error")
+    dump.add_argument("--trace", metavar="FILE",
+                      help="record every APDU to FILE (Chrome trace for *.json, else JSON lines) "
+                           "and print a summary per INS on standard error")
+    load = commands.add_parser("import", parents=[card], help="write the contacts of a CSV or vCard file to ADN")
+    load.add_argument("file", help="CSV file (name and number columns) or vCard file (.vcf)")
+    load.add_argument("--replace", action="store_true",
+                      help="write the contacts to the first records and free the rest (the same phonebook on "
+                           "every card) instead of adding them to free records")
+    args = parser.parse_args(argv[1:])
+
+    if args.command == "import":
+        return importFile(args)
+
+    what = [section.strip() for section in args.what.split(",") if section.strip()]
+    for section in what:
+        if section not in DUMP_SECTIONS:
+            parser.error("unknown section %s, use %s" % (section, ",".join(DUMP_SECTIONS)))
+
+    sim = pySIMlib()
+    trace = None
+    if args.trace:
+        from pySIMtrace import APDUTrace
+        trace = APDUTrace()
+        sim.addAPDUHook(trace)
+    err = sim.openSession(args.port, args.baudrate)
+    if err:
+        print("Could not open %s (error %d)" % (args.port, err), file=sys.stderr)
+        return 1
+    try:
+        if sim.chv1_enabled:
+            if not args.pin:
+                print("The card needs a PIN, use --pin", file=sys.stderr)
+                return 2
+            if not sim.verPIN(args.pin):
+                print("Wrong PIN, %d tries left" % sim.chv1_tries_left, file=sys.stderr)
+                return 3
+        data = dumpCard(sim, what)
+    finally:
+        sim.closeSession()
+    end = time.time()
+
+    writeJSON(data, args.out)
+    if not args.out:
+        print()
+
+    if args.timing:
+        first = (sim.firstAPDUTime - IMPORT_START) * 1000 if sim.firstAPDUTime else 0
+        print("first APDU %.1f ms after import, done after %.1f ms, %d APDUs, %.1f ms I/O" %
+              (first, (end - IMPORT_START) * 1000, sim.apduCount, sim.ioTime * 1000), file=sys.stderr)
+    if trace is not None:
+        if args.trace.endswith(".json"):
+            trace.writeChromeTrace(args.trace)
+        else:
+            trace.writeJSONLines(args.trace)
+        print(trace.formatSummary(), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+
+    sys.exit(main(sys.argv))
@@ -0,0 +1,212 @@
+from __future__ import print_function
+
+import csv
+import io
+import quopri
+import re
+import sys
+
+# CSV header names of the name and the number column, compared in lower case
+NAME_COLUMNS = ("name", "full name", "display name", "fn", "ime")
+NUMBER_COLUMNS = ("number", "phone", "phone number", "mobile", "mobile phone", "tel", "telephone", "telefon")
+
+
+def normalizeNumber(number):
+    """ keeps the digits of a phone number, and a leading + ("+386 (40) 123-456" is "+38640123456") """
+    number = number.strip()
+    digits = re.sub(r"[^0-9*#]", "", number)
+    return str("+" + digits if number.startswith("+") else digits)
+
+
+def _text(value):
+    """ names as pySIMlib handles them: latin-1 byte strings on Python 2 """
+    if sys.version_info[0] < 3 and isinstance(value, unicode):
+        return value.encode("latin-1", "replace")
+    return value
+
+
+def readCSV(filename):
+    """readCSV(filename)
+
+        reads (name, number) from a CSV file (UTF-8, any delimiter the csv sniffer finds). A header row
+        names the columns (see NAME_COLUMNS, NUMBER_COLUMNS), without one the first two columns are used.
+        result : list of (name, number)
+    """
+    with io.open(filename, encoding="utf-8-sig", newline="") as infile:
+        text = infile.read()
+    if sys.version_info[0] < 3:
+        # the Python 2 csv module only reads byte strings
+        lines = [line.encode("utf-8") for line in text.splitlines(True)]
+    else:
+        lines = text.splitlines(True)
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    rows = [row for row in csv.reader(lines, dialect) if any([cell.strip() for cell in row])]
+    if sys.version_info[0] < 3:
+        rows = [[cell.decode("utf-8") for cell in row] for row in rows]
+    if not rows:
+        return []
+
+    nameCol, numberCol = 0, 1
+    header = [cell.strip().lower() for cell in rows[0]]
+    names = [i for i, cell in enumerate(header) if cell in NAME_COLUMNS]
+    numbers = [i for i, cell in enumerate(header) if cell in NUMBER_COLUMNS]
+    if names or numbers:
+        nameCol = names[0] if names else nameCol
+        numberCol = numbers[0] if numbers else numberCol
+        rows = rows[1:]
+
+    contacts = []
+    for row in rows:
+        if len(row) > max(nameCol, numberCol):
+            contacts.append((_text(row[nameCol].strip()), normalizeNumber(row[numberCol])))
+    return contacts
+
+
+def _unfold(text):
+    """ joins the continuation lines of a vCard (lines starting with a space or a tab) """
+    lines = []
+    for line in text.splitlines():
+        if lines and line[:1] in (" ", "\t"):
+            lines[-1] += line[1:]
+        elif lines and lines[-1].endswith("=") and "QUOTED-PRINTABLE" in lines[-1].upper():
+            # vCard 2.1 soft line break of a quoted-printable value
+            lines[-1] = lines[-1][:-1] + line
+        else:
+            lines.append(line)
+    return lines
+
+
+def _value(params, value):
+    if [p for p in params if p.upper() in ("ENCODING=QUOTED-PRINTABLE", "QUOTED-PRINTABLE")]:
+        value = quopri.decodestring(value.encode("utf-8")).decode("utf-8", "replace")
+    return value.replace("\\,", ",").replace("\\;", ";").strip()
+
+
+def readVCard(filename):
+    """readVCard(filename)
+
+        reads the contacts of a vCard file (versions 2.1, 3.0 and 4.0): the name is FN, or N when
+        there is no FN, the number is the preferred TEL (else the first one). Cards without
+        a number are left out.
+        result : list of (name, number)
+    """
+    with io.open(filename, encoding="utf-8-sig", errors="replace") as infile:
+        lines = _unfold(infile.read())
+
+    contacts = []
+    card = None
+    for line in lines:
+        if ":" not in line:
+            continue
+        key, value = line.split(":", 1)
+        params = key.split(";")
+        prop = params[0].split(".")[-1].upper()  # "item1.TEL" is TEL
+        if prop == "BEGIN" and value.strip().upper() == "VCARD":
+            card = {"tel": []}
+        elif card is None:
+            continue
+        elif prop == "END":
+            name = card.get("fn") or card.get("n")
+            numbers = sorted(card["tel"], key=lambda tel: not tel[0])
+            if name and numbers:
+                contacts.append((_text(name), normalizeNumber(numbers[0][1])))
+            card = None
+        elif prop == "FN":
+            card["fn"] = _value(params[1:], value)
+        elif prop == "N":
+            parts = [p.strip() for p in _value(params[1:], value).split(";")]
+            # family; given; additional; prefix; suffix
+            card["n"] = " ".join([p for p in parts[1:2] + parts[:1] if p])
+        elif prop == "TEL":
+            preferred = "PREF" in key.upper()
+            card["tel"].append((preferred, _value(params[1:], value).replace("tel:", "")))
+    return contacts
+
+
+def readContacts(filename):
+    """ reads a .vcf/.vcard file with readVCard, anything else with readCSV """
+    if filename.lower().endswith((".vcf", ".vcard")):
+        return readVCard(filename)
+    return readCSV(filename)
+
+
+class SlotMap:
+    """ which records of a phonebook EF are used, built from one full scan (see pySIMlib.getSlotMap)
+
+        Records of a linear fixed file (ADN, FDN) are allocated and freed in O(1): a bitmap holds
+        the used records, a stack the free ones (entries that were used in the meantime are
+        skipped when they come up). A cyclic file (LND) is always written at record 1 and the
+        other records move down one, the oldest falls off the end. The bitmap is then a ring
+        whose start moves back one record for every write.
+
+        recNum : number of records of the file
+        free   : numbers of the free records
+        cyclic : True for a cyclic EF
+    """
+
+    def __init__(self, recNum, free, cyclic=False):
+        self.recNum = recNum
+        self.cyclic = cyclic
+        self.used = bytearray([1]) * recNum
+        for rec in set(free):
+            self.used[rec - 1] = 0
+        self.freeCount = recNum - sum(self.used)
+        self._head = 0  # index in used of record 1
+        self._stack = sorted(set(free), reverse=True)
+
+    def _index(self, rec):
+        if not 1 <= rec <= self.recNum:
+            raise ValueError("record %d out of 1 - %d" % (rec, self.recNum))
+        return (self._head + rec - 1) % self.recNum
+
+    def isFree(self, rec):
+        return not self.used[self._index(rec)]
+
+    def allocate(self):
+        """allocate()
+
+            result : record the next entry is written to, None if a linear file is full.
+                     The record of a linear file is marked used, a cyclic file always
+                     gives 1 and changes when the write is reported with written().
+        """
+        if self.cyclic:
+            return 1
+        while self._stack:
+            rec = self._stack.pop()
+            if not self.used[rec - 1]:
+                self.used[rec - 1] = 1
+                self.freeCount -= 1
+                return rec
+        return None
+
+    def release(self, rec):
+        """ gives back a record of a linear file, ex. an allocated one that could not be written """
+        if self.cyclic:
+            raise ValueError("records of a cyclic file can not be freed")
+        self.written(rec, False)
+
+    def written(self, rec, used):
+        """written(rec, used)
+
+            keeps the map in step with an UPDATE RECORD of record rec, used is False
+            when a free (empty) record was written. Cyclic files ignore rec.
+        """
+        if self.cyclic:
+            self._head = (self._head - 1) % self.recNum
+            i = self._head  # the oldest record becomes record 1
+        else:
+            i = self._index(rec)
+        if self.used[i] and not used:
+            self.freeCount += 1
+            if not self.cyclic:
+                self._stack.append(rec)
+        elif used and not self.used[i]:
+            self.freeCount -= 1
+        self.used[i] = 1 if used else 0
+
+    def freeSlots(self):
+        """ result : sorted list of the free records """
+        return [rec for rec in range(1, self.recNum + 1) if self.isFree(rec)]
@@ -0,0 +1,301 @@
+from __future__ import print_function
+
+import calendar
+import time
+from binascii import hexlify
+
+from pySIMlib import septetsToText, unpackSeptets
+
+# TP-MTI of the first octet
+MTI_DELIVER = 0
+MTI_SUBMIT = 1
+MTI_STATUS_REPORT = 2
+
+# information element identifiers of the user data header
+IEI_CONCAT_8BIT = 0x00
+IEI_CONCAT_16BIT = 0x08
+
+# BCD digits of address fields, 0xF is the filler
+BCD_DIGITS = "0123456789ABCDE"
+
+# bytes of TP-VP by the validity period format bits (b4 b3) of an SMS-SUBMIT
+VP_LENGTH = {0x00: 0, 0x10: 1, 0x08: 7, 0x18: 7}
+
+if bytes is str:
+    def _octets(record):
+        # memoryview items are 1 character strings on Python 2, a bytearray gives ints
+        return record if isinstance(record, bytearray) else bytearray(record)
+
+    def _bytes(view):
+        return bytes(bytearray(view))
+
+    def _text(septets):
+        # septetsToText gives latin-1 byte strings, message texts are unicode like the UCS2 ones
+        return septetsToText(septets).decode("latin-1")
+else:
+    def _octets(record):
+        return memoryview(record)
+
+    def _bytes(view):
+        return bytes(view)
+
+    _text = septetsToText
+
+
+class SMSMessage(tuple):
+    """ decoded SMS, the tuple (status, timestamp, number, text) pySIMlib.getSMS always returned
+
+        The other fields are attributes:
+        smsc         : number of the service centre
+        mti          : MTI_DELIVER, MTI_SUBMIT or MTI_STATUS_REPORT
+        pid, dcs     : protocol identifier and data coding scheme
+        alphabet     : "7bit", "8bit" or "ucs2"
+        messageClass : 0 - 3, None if the DCS has none
+        udh          : list of (IEI, bytes) of the user data header
+        concat       : tuple(reference, parts, part) of a concatenated message, None otherwise
+        data         : user data after the header, the text of 8-bit messages is its hex string
+        records      : record numbers the message was read from
+        missing      : part numbers not found on the card (only assembled messages have any)
+    """
+
+    def __new__(cls, status, timestamp, number, text, **fields):
+        self = tuple.__new__(cls, (status, timestamp, number, text))
+        self.smsc = ""
+        self.mti = MTI_DELIVER
+        self.pid = 0
+        self.dcs = 0
+        self.alphabet = "7bit"
+        self.messageClass = None
+        self.udh = []
+        self.concat = None
+        self.data = b""
+        self.records = []
+        self.missing = []
+        self.__dict__.update(fields)
+        return self
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+    status = property(lambda self: self[0])
+    timestamp = property(lambda self: self[1])
+    number = property(lambda self: self[2])
+    text = property(lambda self: self[3])
+
+
+def dcsInfo(dcs):
+    """dcsInfo(dcs)
+
+        result : tuple(alphabet, message class, compressed) of a data coding scheme (GSM 03.38 section 4),
+                 reserved coding groups are read as the default alphabet
+    """
+    group = dcs >> 4
+    if group <= 0x07:  # general data coding, 01xx is marked for automatic deletion
+        alphabet = ("7bit", "8bit", "ucs2", "7bit")[(dcs >> 2) & 3]
+        return alphabet, dcs & 3 if dcs & 0x10 else None, bool(dcs & 0x20)
+    if group in (0x0C, 0x0D):  # message waiting indication, discard or store
+        return "7bit", None, False
+    if group == 0x0E:  # message waiting indication, store, UCS2
+        return "ucs2", None, False
+    if group == 0x0F:  # data coding / message class
+        return "8bit" if dcs & 0x04 else "7bit", dcs & 3, False
+    return "7bit", None, False
+
+
+def decodeBCD(view, start, stop):
+    digits = []
+    for i in range(start, stop):
+        b = view[i]
+        for nibble in (b & 0x0F, b >> 4):
+            if nibble == 0x0F:
+                return "".join(digits)
+            digits.append(BCD_DIGITS[nibble])
+    return "".join(digits)
+
+
+def decodeAddress(view, pos):
+    """ returns (address, position after it) of an originating or destination address """
+    length = view[pos]
+    toa = view[pos + 1]
+    end = pos + 2 + (length + 1) // 2
+    if end > len(view):
+        raise ValueError("address runs past the end of the record")
+    if (toa & 0x70) == 0x50:  # alphanumeric, 7-bit packed
+        address = _text(unpackSeptets(view[pos + 2:end])[:length * 4 // 7])
+    else:
+        address = decodeBCD(view, pos + 2, end)
+        if (toa & 0x70) == 0x10:
+            address = "+" + address
+    return address, end
+
+
+def decodeTimestamp(view, pos):
+    """ returns the service centre time stamp as time.asctime, "" if it is not a valid date """
+    fields = [(view[i] & 0x0F) * 10 + (view[i] >> 4) for i in range(pos, pos + 6)]
+    # hopefully no one uses this after 2079 ;)
+    fields[0] += 1900 if fields[0] >= 80 else 2000
+    try:
+        weekday = calendar.weekday(fields[0], fields[1], fields[2])
+        return time.asctime(tuple(fields) + (weekday, 0, 0))
+    except ValueError:
+        return ""
+
+
+def decodeUDH(view):
+    """ returns the list of (IEI, bytes) of a user data header and the concatenation info """
+    elements = []
+    concat = None
+    pos, end = 1, min(1 + view[0], len(view))
+    while pos + 2 <= end:
+        iei, length = view[pos], view[pos + 1]
+        value = view[pos + 2:pos + 2 + length]
+        elements.append((iei, _bytes(value)))
+        if iei == IEI_CONCAT_8BIT and length == 3:
+            concat = (value[0], value[1], value[2])
+        elif iei == IEI_CONCAT_16BIT and length == 4:
+            concat = ((value[0] << 8) | value[1], value[2], value[3])
+        pos += 2 + length
+    return elements, concat
+
+
+def decodePDU(record):
+    """decodePDU(record)
+
+        record : raw EF_SMS record (bytes, bytearray or memoryview): status byte, SMSC address, TPDU
+        result : SMSMessage
+
+        On Python 3 the fields are read in place through a memoryview, Python 2 copies the record
+        into a bytearray once. The text is unicode on Python 2 (str on Python 3) whatever the
+        alphabet. Raises ValueError when the record is cut short.
+    """
+    try:
+        return _decodePDU(_octets(record))
+    except IndexError:
+        raise ValueError("SMS record cut short")
+
+
+def _decodePDU(view):
+    if len(view) < 3:
+        raise ValueError("SMS record of %d bytes" % len(view))
+    status = view[0]
+
+    smscLen = view[1]
+    smsc = ""
+    pos = 2
+    if 0 < smscLen < 0xFF:
+        pos = 2 + smscLen
+        smsc = decodeBCD(view, 3, pos)
+        if (view[2] & 0x70) == 0x10:
+            smsc = "+" + smsc
+
+    first = view[pos]
+    mti = first & 3
+    fields = dict(smsc=smsc, mti=mti)
+    if mti == MTI_DELIVER:
+        number, pos = decodeAddress(view, pos + 1)
+        pid, dcs = view[pos], view[pos + 1]
+        timestamp = decodeTimestamp(view, pos + 2)
+        pos += 9
+    elif mti == MTI_SUBMIT:
+        number, pos = decodeAddress(view, pos + 2)  # after the message reference
+        pid, dcs = view[pos], view[pos + 1]
+        timestamp = ""
+        pos += 2 + VP_LENGTH[first & 0x18]
+    else:
+        return SMSMessage(status, "", "", "ERROR: Don't understand this message type", **fields)
+    if pos >= len(view):
+        raise ValueError("user data runs past the end of the record")
+
+    alphabet, messageClass, compressed = dcsInfo(dcs)
+    fields.update(pid=pid, dcs=dcs, alphabet=alphabet, messageClass=messageClass)
+    udl = view[pos]
+    # the length is in septets for the default alphabet, in octets otherwise
+    udLen = (udl * 7 + 7) // 8 if alphabet == "7bit" else udl
+    ud = view[pos + 1:min(len(view), pos + 1 + udLen)]
+
+    headerLen = 0
+    if first & 0x40 and len(ud):  # TP-UDHI
+        headerLen = 1 + ud[0]
+        fields["udh"], fields["concat"] = decodeUDH(ud)
+
+    if compressed:
+        text = "ERROR: Don't understand compressed messages"
+    elif alphabet == "7bit":
+        # the header is padded with fill bits up to a septet boundary
+        text = _text(unpackSeptets(ud)[(headerLen * 8 + 6) // 7:udl])
+    else:
+        fields["data"] = data = _bytes(ud[headerLen:])
+        if alphabet == "ucs2":
+            text = data.decode("utf-16-be", "replace")
+        else:
+            text = hexlify(data).upper().decode("ascii")
+    return SMSMessage(status, timestamp, number, text, **fields)
+
+
+class SMSIndex:
+    """ reassembles concatenated messages read record by record
+
+        Parts are kept by (sender, reference, number of parts) until the
+        last one arrives, so they may be stored in any order on the card.
+
+        for recNum, sms in sim.iterSMS(): for recNum, message in index.add(recNum, sms): ...
+        for recNum, message in index.flush(): ...  (messages with parts missing)
+    """
+
+    def __init__(self):
+        self.groups = {}
+
+    def add(self, recNum, sms):
+        """add(recNum, sms)
+
+            result : list of (recNum, message) complete now, recNum is the record of the first part
+        """
+        if not sms:
+            return []
+        concat = getattr(sms, "concat", None)
+        if concat is None or concat[1] < 2:
+            return [(recNum, sms)]
+        key = (sms[2], concat[0], concat[1])
+        done = []
+        group = self.groups.setdefault(key, {})
+        if concat[2] in group:
+            # the reference was used again for a newer message
+            done.append(self._assemble(key, self.groups.pop(key)))
+            group = self.groups[key] = {}
+        group[concat[2]] = (recNum, sms)
+        if len(group) == concat[1]:
+            done.append(self._assemble(key, self.groups.pop(key)))
+        return done
+
+    def flush(self):
+        """ returns the (recNum, message) of the incomplete messages, the missing parts are left out """
+        done = [self._assemble(key, group) for key, group in self.groups.items()]
+        self.groups = {}
+        done.sort(key=lambda item: item[0])
+        return done
+
+    def _assemble(self, key, group):
+        number, reference, parts = key
+        seqs = sorted(group)
+        recNum, first = group[seqs[0]]
+        records = [group[seq][0] for seq in seqs]
+        text = "".join([group[seq][1][3] for seq in seqs])
+        fields = dict(first.__dict__, records=records, concat=(reference, parts, None),
+                      missing=[seq for seq in range(1, parts + 1) if seq not in group],
+                      data=b"".join([group[seq][1].data for seq in seqs]))
+        return min(records), SMSMessage(first[0], first[1], number, text, **fields)
+
+
+def assembleSMS(smss):
+    """assembleSMS(smss)
+
+        smss   : dict or list of (recNum, sms) as returned by pySIMlib.getSMSs
+        result : list of (recNum, message) with the parts of concatenated messages joined
+    """
+    index = SMSIndex()
+    messages = []
+    for recNum, sms in sorted(dict(smss).items()):
+        messages.extend(index.add(recNum, sms))
+    messages.extend(index.flush())
+    messages.sort(key=lambda item: item[0])
+    return messages
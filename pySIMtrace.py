@@ -0,0 +1,116 @@
+from __future__ import print_function
+
+import json
+
+# GSM 11.11 instruction names
+INS_NAMES = {0xA4: "SELECT", 0xF2: "STATUS", 0xB0: "READ BINARY", 0xD6: "UPDATE BINARY",
+             0xB2: "READ RECORD", 0xDC: "UPDATE RECORD", 0xA2: "SEEK", 0x32: "INCREASE",
+             0x20: "VERIFY CHV", 0x24: "CHANGE CHV", 0x26: "DISABLE CHV", 0x28: "ENABLE CHV",
+             0x2C: "UNBLOCK CHV", 0x04: "INVALIDATE", 0x44: "REHABILITATE", 0x88: "RUN GSM ALGORITHM",
+             0xFA: "SLEEP", 0xC0: "GET RESPONSE", 0x10: "TERMINAL PROFILE", 0xC2: "ENVELOPE",
+             0x12: "FETCH", 0x14: "TERMINAL RESPONSE"}
+
+# upper bounds of the latency histogram buckets in milliseconds
+HISTOGRAM_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+
+
+def insName(ins):
+    return INS_NAMES.get(ins, "INS %02X" % ins)
+
+
+class APDUTrace:
+    """ APDU hook that keeps the events of pySIMlib.addAPDUHook
+
+        sim.addAPDUHook(trace)  ...  trace.writeChromeTrace("trace.json")
+
+        maxEvents : oldest events are dropped beyond this many (None keeps all)
+    """
+
+    def __init__(self, maxEvents=None):
+        self.maxEvents = maxEvents
+        self.events = []
+
+    def __call__(self, event):
+        self.events.append(event)
+        if self.maxEvents is not None and len(self.events) > self.maxEvents:
+            del self.events[0]
+
+    def clear(self):
+        self.events = []
+
+    def writeJSONLines(self, filename):
+        """ one JSON object per APDU and line """
+        with open(filename, "w") as outfile:
+            for event in self.events:
+                event = dict(event, name=insName(event["ins"]))
+                outfile.write(json.dumps(event, sort_keys=True) + "\n")
+
+    def chromeTrace(self):
+        """ events in the Chrome trace event format (chrome://tracing, Perfetto)
+
+            Every APDU is a complete event. When the transport reported the SW time,
+            the time between the first procedure byte and the SW is nested in it
+            as "card" (the card working on the command).
+        """
+        origin = self.events[0]["start"] if self.events else 0
+        traceEvents = []
+        for event in self.events:
+            ts = (event["start"] - origin) * 1e6
+            args = dict([(key, event[key]) for key in ("seq", "p1", "p2", "p3", "bytesOut", "bytesIn", "nulls",
+                                                       "sw", "path")])
+            traceEvents.append({"name": insName(event["ins"]), "cat": "apdu", "ph": "X", "ts": ts,
+                                "dur": event["duration"] * 1e6, "pid": 1, "tid": 1, "args": args})
+            if event["toProcedure"] is not None and event["toSW"] is not None:
+                traceEvents.append({"name": "card", "cat": "card", "ph": "X",
+                                    "ts": ts + event["toProcedure"] * 1e6,
+                                    "dur": (event["toSW"] - event["toProcedure"]) * 1e6, "pid": 1, "tid": 1})
+        return {"traceEvents": traceEvents, "displayTimeUnit": "ms"}
+
+    def writeChromeTrace(self, filename):
+        with open(filename, "w") as outfile:
+            json.dump(self.chromeTrace(), outfile)
+
+    def summary(self):
+        """ result : dict INS name -> dict with count, total/mean/max seconds, bytes, NULL bytes,
+                     mean seconds to the SW (None if unknown) and a histogram of the durations
+        """
+        result = {}
+        for event in self.events:
+            name = insName(event["ins"])
+            s = result.get(name)
+            if s is None:
+                s = result[name] = {"count": 0, "total": 0.0, "max": 0.0, "bytesOut": 0, "bytesIn": 0, "nulls": 0,
+                                    "toSW": 0.0, "swCount": 0, "histogram": [0] * (len(HISTOGRAM_BUCKETS) + 1)}
+            s["count"] += 1
+            s["total"] += event["duration"]
+            s["max"] = max(s["max"], event["duration"])
+            s["bytesOut"] += event["bytesOut"]
+            s["bytesIn"] += event["bytesIn"]
+            s["nulls"] += event["nulls"]
+            if event["toSW"] is not None:
+                s["toSW"] += event["toSW"]
+                s["swCount"] += 1
+            ms = event["duration"] * 1000
+            bucket = len([b for b in HISTOGRAM_BUCKETS if ms > b])
+            s["histogram"][bucket] += 1
+        for s in result.values():
+            s["mean"] = s["total"] / s["count"]
+            s["meanToSW"] = s["toSW"] / s["swCount"] if s["swCount"] else None
+            del s["toSW"], s["swCount"]
+        return result
+
+    def formatSummary(self):
+        summary = self.summary()
+        labels = ["<=%d" % b for b in HISTOGRAM_BUCKETS] + [">%d" % HISTOGRAM_BUCKETS[-1]]
+        lines = ["%-18s %6s %9s %8s %8s %9s %8s %6s" % ("INS", "count", "total ms", "mean ms", "max ms",
+                                                       "to SW ms", "bytes", "NULLs")]
+        for name, s in sorted(summary.items(), key=lambda item: -item[1]["total"]):
+            toSW = "%9.2f" % (s["meanToSW"] * 1000) if s["meanToSW"] is not None else "%9s" % "-"
+            lines.append("%-18s %6d %9.1f %8.2f %8.2f %s %8d %6d" % (name, s["count"], s["total"] * 1000,
+                                                                   s["mean"] * 1000, s["max"] * 1000, toSW,
+                                                                   s["bytesOut"] + s["bytesIn"], s["nulls"]))
+            width = max(s["histogram"])
+            for label, n in zip(labels, s["histogram"]):
+                if n:
+                    lines.append("    %6s ms %6d %s" % (label, n, "#" * max(1, n * 40 // width)))
+        return "\n".join(lines)
@@ -0,0 +1,659 @@
+from __future__ import print_function
+
+import socket
+import threading
+import time
+from binascii import hexlify, unhexlify
+
+try:
+    SerialError = 0
+    import serial
+except ImportError:
+    SerialError = 1
+    import traceback
+
+    traceback.print_exc()
+
+try:
+    from smartcard.System import readers as pcscReaders
+except ImportError:
+    pcscReaders = None
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+ACK_NULL = 0x60
+
+DEFAULT_BAUDRATE = 9600
+
+# ISO 7816-3 clock rate conversion factors (Fi) and baud rate adjustment factors (Di)
+FI_TABLE = (372, 372, 558, 744, 1116, 1488, 1860, 0, 0, 512, 768, 1024, 1536, 2048, 0, 0)
+DI_TABLE = (0, 1, 2, 4, 8, 16, 32, 64, 12, 20, 0, 0, 0, 0, 0, 0)
+
+
+class ATR:
+    """ ISO 7816-3 answer to reset
+
+        raw        : string of all ATR bytes
+        interface  : list of dicts with the 'TA', 'TB', 'TC' and 'TD' bytes of every group
+        protocols  : offered protocols in order (T=0 when TD1 is absent)
+        fi, di     : Fi/Di indexes from TA1, F and D the corresponding factors
+        ta2        : TA2 byte, None unless the card is in specific mode
+        guardTime  : extra guard time N from TC1
+        historical : string of historical bytes
+        tck        : check byte, None when only T=0 is offered
+    """
+
+    def __init__(self):
+        self.raw = ""
+        self.interface = []
+        self.protocols = [0]
+        self.ta1 = None
+        self.ta2 = None
+        self.fi = 1
+        self.di = 1
+        self.F = 372
+        self.D = 1
+        self.guardTime = 0
+        self.historical = ""
+        self.tck = None
+
+    def checkTCK(self):
+        """ true if there is no TCK or the XOR of T0 up to TCK is zero
+        """
+        if self.tck is None:
+            return True
+        x = 0
+        for c in self.raw[1:]:
+            x ^= ord(c)
+        return x == 0
+
+    def __str__(self):
+        return hexlify(self.raw).upper()
+
+
+def readATR(read, ts=None):
+    """readATR(read, ts)
+
+        read   : function(n) returning up to n bytes (ex. serial.Serial.read)
+        ts     : TS byte if it was already read
+        result : ATR object
+
+        Reads exactly the bytes announced by T0 and the TDi chain, so the time
+        needed is bounded by the length of the ATR and not by the read timeout.
+        Raises ValueError when the ATR is cut short.
+    """
+
+    def readExactly(n):
+        data = read(n) if n else ""
+        if len(data) != n:
+            raise ValueError("ATR too short")
+        return data
+
+    atr = ATR()
+    atr.raw = ts if ts else readExactly(1)
+    t0 = ord(readExactly(1))
+    atr.raw += chr(t0)
+
+    y = t0 >> 4
+    protocols = []
+    while y:
+        names = [name for bit, name in ((1, 'TA'), (2, 'TB'), (4, 'TC'), (8, 'TD')) if y & bit]
+        group = readExactly(len(names))
+        atr.raw += group
+        atr.interface.append(dict(zip(names, [ord(c) for c in group])))
+        y = 0
+        if 'TD' in atr.interface[-1]:
+            td = atr.interface[-1]['TD']
+            protocols.append(td & 0x0F)
+            y = td >> 4
+    # T=15 only announces global interface bytes
+    if [p for p in protocols if p != 15]:
+        atr.protocols = [p for p in protocols if p != 15]
+
+    atr.historical = readExactly(t0 & 0x0F)
+    atr.raw += atr.historical
+    # TCK is present if any protocol other than T=0 is offered
+    if [p for p in protocols if p != 0]:
+        atr.tck = ord(readExactly(1))
+        atr.raw += chr(atr.tck)
+
+    if atr.interface:
+        first = atr.interface[0]
+        if 'TA' in first:
+            atr.ta1 = first['TA']
+            atr.fi, atr.di = atr.ta1 >> 4, atr.ta1 & 0x0F
+            atr.F, atr.D = FI_TABLE[atr.fi], DI_TABLE[atr.di]
+        if 'TC' in first:
+            atr.guardTime = first['TC']
+    if len(atr.interface) > 1 and 'TA' in atr.interface[1]:
+        atr.ta2 = atr.interface[1]['TA']
+    return atr
+
+
+def parseATR(raw):
+    """parseATR(raw)
+
+        raw    : string of ATR bytes
+        result : ATR object
+    """
+    pos = [0]
+
+    def read(n):
+        data = raw[pos[0]:pos[0] + n]
+        pos[0] += n
+        return data
+
+    return readATR(read)
+
+
+class Transport:
+    """ Reader interface used by pySIMlib
+
+        open()            : resets the card, result : if(0) OK else error
+        close()           : releases the reader
+        transmit(command) : command as a string of hexadecimal characters,
+                            result tuple(data, sw) like pySIMlib.sendAPDU
+        atr               : ATR object of the card (None if unknown)
+        baudrate          : speed of the link to the card (None if the reader handles it)
+        timings           : dict set by pySIMlib while an APDU is traced, None otherwise.
+                            Transports that see the procedure bytes fill in the time.time()
+                            of the first one ('procedure'), of the status word ('sw') and
+                            the number of NULL bytes ('nulls').
+    """
+
+    atr = None
+    baudrate = None
+    timings = None
+
+    def open(self):
+        return 0
+
+    def close(self):
+        pass
+
+    def transmit(self, command):
+        raise NotImplementedError
+
+
+class SerialTransport(Transport):
+    """ Phoenix-style reader on a serial port with RX and TX tied together
+
+        port        : string of serial port name or an object with the serial.Serial interface
+        maxBaudrate : highest baud rate to negotiate with PPS (9600 disables PPS), open
+                      fails with 4 when a card in specific mode needs a faster one
+        framed      : write/read whole APDU frames instead of one byte per call
+        timeout     : seconds to wait for the card before a read gives up
+    """
+
+    def __init__(self, port, maxBaudrate=115200, framed=True, debug=False, timeout=1):
+        self.port = port
+        self.maxBaudrate = maxBaudrate
+        self.framed = framed
+        self.debug = debug
+        self.timeout = timeout
+        self.serialport = port if hasattr(port, "read") else None
+        self.baudrate = DEFAULT_BAUDRATE
+        self.atr = None
+
+    def open(self):
+        if self.serialport is None and hasattr(self.port, "read"):
+            self.serialport = self.port
+        elif self.serialport is None:
+            self.serialport = serial.Serial(port=self.port,
+                                            parity=serial.PARITY_EVEN,
+                                            bytesize=serial.EIGHTBITS,
+                                            stopbits=serial.STOPBITS_TWO,
+                                            timeout=self.timeout,
+                                            xonxoff=0,
+                                            rtscts=0,
+                                            baudrate=DEFAULT_BAUDRATE)
+        if (not self.serialport):
+            return 1
+
+        err = self._resetCard()
+        if err:
+            return err
+
+        if self.atr.ta2 is not None and not self.atr.ta2 & 0x10:
+            return self._specificMode()
+        params = self._selectPPS(self.maxBaudrate)
+        if params and not self._PPS(*params):
+            # card did not accept the PPS request, reset it and stay at the default rate
+            if (self.debug): print("PPS rejected, falling back to %d baud" % DEFAULT_BAUDRATE)
+            err = self._resetCard()
+            if err:
+                return err
+        return 0
+
+    def close(self):
+        self.serialport.close()
+        self.serialport = None
+
+    def transmit(self, command):
+        if not self.framed:
+            return self._sendAPDUbytewise(command)
+        return self._sendAPDUframed(command)
+
+    def _resetCard(self):
+        """ resets the card at the default baud rate and reads its ATR
+        """
+        self.serialport.baudrate = DEFAULT_BAUDRATE
+        self.baudrate = DEFAULT_BAUDRATE
+        self.atr = None
+
+        # reset it!
+        self.serialport.setRTS(1)
+        self.serialport.setDTR(1)
+        time.sleep(0.01)  # 10ms?
+        self.serialport.flushInput()
+        self.serialport.setRTS(0)
+        self.serialport.setDTR(0)
+
+        ts = self.serialport.read()
+        if not ts:
+            return 2  # no card?
+        if ord(ts) != 0x3B:
+            return 3  # bad ATR byte
+        # ok got 0x3B
+        if (self.debug): print("TS: 0x%x Direct convention" % ord(ts))
+
+        try:
+            self.atr = readATR(self.serialport.read, ts)
+        except ValueError as e:
+            if (self.debug): print("ATR: %s" % e)
+            return 2
+        if (self.debug): print("ATR: %s" % self.atr)
+        return 0
+
+    def _specificMode(self):
+        """ switches the port to the Fi/Di of TA1, a card in specific mode (TA2 bit 5 = 0)
+            uses them right after the reset
+
+            result : 0 or 4 when the reader can not use that baud rate
+        """
+        if not self.atr.F or not self.atr.D:
+            return 4
+        rate = DEFAULT_BAUDRATE * 372 * self.atr.D // self.atr.F
+        if (self.debug): print("TA2 present (specific mode), %d baud" % rate)
+        if rate > self.maxBaudrate:
+            return 4
+        if rate != self.baudrate:
+            try:
+                self.serialport.baudrate = rate
+            except (ValueError, IOError):
+                return 4
+        self.baudrate = rate
+        return 0
+
+    def _selectPPS(self, maxBaudrate):
+        """ picks the fastest Fi/Di pair allowed by TA1 whose baud rate the reader supports
+
+            result : tuple(PPS1, baudrate) or None when the default rate should be kept
+        """
+        if self.atr.ta1 is None:
+            return None
+        # TA2 means specific mode, ISO 7816-3 does not allow a PPS exchange then;
+        # with bit 5 set the parameters are implicit and the default rate is kept
+        if self.atr.ta2 is not None:
+            return None
+        fi, di = self.atr.fi, self.atr.di
+        if not FI_TABLE[fi] or not DI_TABLE[di]:
+            return None
+
+        best = None
+        for d, dval in enumerate(DI_TABLE):
+            if not dval or dval > DI_TABLE[di]:
+                continue
+            rate = DEFAULT_BAUDRATE * 372 * dval // FI_TABLE[fi]
+            if DEFAULT_BAUDRATE < rate <= maxBaudrate and (not best or rate > best[1]):
+                best = ((fi << 4) | d, rate)
+        return best
+
+    def _PPS(self, pps1, rate):
+        """ sends a PPS request for pps1 and switches the port to rate if the card accepts it
+        """
+        request = [0xFF, 0x10 | self.atr.protocols[0], pps1]
+        request.append(request[0] ^ request[1] ^ request[2])
+        request = "".join([chr(c) for c in request])
+        if (self.debug): print("PPS: " + hexlify(request))
+
+        self.serialport.write(request)
+        # because rx and tx are tied together, we will read an echo
+        self.serialport.read(len(request))
+        response = self.serialport.read(len(request))
+        if (self.debug): print("PPS response: " + hexlify(response))
+        if response != request:
+            return False
+
+        self.serialport.baudrate = rate
+        self.baudrate = rate
+        return True
+
+
+    def _sendAPDUframed(self, command):
+        """ sends the header and the data body as single buffers and reads
+            the echo and the response body with one sized read each
+        """
+        timings = self.timings
+        header = unhexlify(command[:10])
+        self.serialport.write(header)
+        # because rx and tx are tied together, we will read an echo
+        if self.serialport.read(5) != header:
+            if (self.debug): print("RS: BAD ECHO")
+            return ("", "")
+
+        ins = ord(header[1])
+        while 1:
+            rep = self.serialport.read()
+            if (rep == ""):
+                if (self.debug): print("RS: TIMEOUT")
+                return ("", "")
+            if timings is not None and "procedure" not in timings:
+                timings["procedure"] = time.time()
+            # check that it is echoing the INS (second byte)
+            if (ord(rep) == ins):
+                if (self.debug): print("RS: OK")
+                break
+            if (ord(rep) & 0xF0) in (0x60, 0x90) and ord(rep) != ACK_NULL:
+                # the card refused the command and sent SW1 instead of the INS
+                sw2 = self.serialport.read()
+                if (sw2 == ""):
+                    return ("", "")
+                if timings is not None:
+                    timings["sw"] = time.time()
+                if (self.debug): print("SW: %02x%02x" % (ord(rep), ord(sw2)))
+                return "", "%02x%02x" % (ord(rep), ord(sw2))
+            if (ord(rep) != ACK_NULL):
+                if (self.debug): print("RS: BAD %X" % ord(rep))
+                return ("", "")  # bad response
+            if timings is not None:
+                timings["nulls"] += 1
+            if (self.debug): print("RS: NULL")
+
+        data = ''
+        datalen = ord(header[4])
+        if (len(command) == 10):
+            # read data
+            data = hexlify(self.serialport.read(datalen)).upper()
+        else:
+            # time to send command
+            body = unhexlify(command[10:10 + datalen * 2])
+            self.serialport.write(body)
+            # because rx and tx are tied together, we will read an echo
+            self.serialport.read(datalen)
+
+        # look for the ack word, but ignore a 0x60
+        while 1:
+            sw1 = self.serialport.read()
+            if (sw1 == "" or ord(sw1) != ACK_NULL):
+                break
+            if timings is not None:
+                timings["nulls"] += 1
+        sw2 = self.serialport.read()
+        if (sw1 == "" or sw2 == ""):
+            if (self.debug): print("SW: TIMEOUT")
+            return (data, "")
+        if timings is not None:
+            timings["sw"] = time.time()
+        sw = "%02x%02x" % (ord(sw1), ord(sw2))
+        if self.debug: print("SW: " + sw)
+        return data, sw
+
+    def _sendAPDUbytewise(self, command):
+        """ original transport: every byte is written, echoed and read with
+            its own call. Kept for readers that can not handle whole frames.
+        """
+        # send first 5 'header' bytes
+        for i in range(5):
+            s = int(command[i * 2] + command[i * 2 + 1], 16)
+            self.serialport.write(chr(s))
+            # because rx and tx are tied together, we will read an echo
+            self.serialport.read()
+
+        while 1:
+            rep = self.serialport.read()
+            time.sleep(0.001)
+            # check that it is echoing the INS (second byte)
+            if (ord(rep) == int(command[2] + command[3], 16)):
+                if (self.debug): print("RS: OK")
+                break
+            if (ord(rep) != ACK_NULL):
+                if (self.debug): print("RS: BAD %X" % ord(rep))
+                return ("", "")  # bad response
+            if (self.debug): print("RS: NULL")
+
+        data = ''
+        if (len(command) == 10):
+            # read data
+            datalen = int(command[8] + command[9], 16)
+            for i in range(datalen):
+                s = ord(self.serialport.read())
+                hexed = "%02X" % s
+                data += hexed[0]
+                data += hexed[1]
+        else:
+            # time to send command
+            datalen = int(command[8] + command[9], 16)
+            for i in range(datalen):
+                s = int(command[10 + i * 2] + command[11 + i * 2], 16)
+                self.serialport.write(chr(s))
+                # because rx and tx are tied together, we will read an echo
+                self.serialport.read()
+
+        # look for the ack word, but ignore a 0x60
+        while 1:
+            sw1 = self.serialport.read()
+            if (ord(sw1) != ACK_NULL):
+                break
+        sw2 = self.serialport.read()
+        sw = "%02x%02x" % (ord(sw1), ord(sw2))
+        if self.debug: print("SW: " + sw)
+        return data, sw
+
+
+class PCSCTransport(Transport):
+    """ APDU-level reader through PC/SC (CCID readers), needs pyscard
+
+        reader : index or part of the name of the reader, the first one by default
+    """
+
+    def __init__(self, reader=None, debug=False):
+        self.reader = reader
+        self.debug = debug
+        self.connection = None
+        self.atr = None
+        self.baudrate = None
+
+    def open(self):
+        if pcscReaders is None:
+            raise RuntimeError("PC/SC needs the pyscard package")
+        readers = pcscReaders()
+        if not readers:
+            return 1
+        reader = readers[0]
+        if self.reader is not None:
+            if str(self.reader).isdigit():
+                reader = readers[int(self.reader)]
+            else:
+                reader = [r for r in readers if str(self.reader) in str(r)][0]
+        if (self.debug): print("PC/SC reader: %s" % reader)
+
+        self.connection = reader.createConnection()
+        try:
+            self.connection.connect()
+        except Exception as e:
+            if (self.debug): print("PC/SC: %s" % e)
+            return 2  # no card?
+        try:
+            self.atr = parseATR("".join([chr(b) for b in self.connection.getATR()]))
+        except ValueError:
+            self.atr = None
+        return 0
+
+    def close(self):
+        self.connection.disconnect()
+        self.connection = None
+
+    def transmit(self, command):
+        data, sw1, sw2 = self.connection.transmit([ord(c) for c in unhexlify(command)])
+        return "".join(["%02X" % b for b in data]), "%02x%02x" % (sw1, sw2)
+
+
+# error code of a remote request that raised (ex. a missing serial port)
+REMOTE_ERROR = 1
+
+
+def remoteError(answer):
+    """remoteError(answer)
+
+        answer : split ERR line of a TransportServer
+        result : its error code, REMOTE_ERROR when there is no numeric one
+    """
+    if len(answer) > 1 and answer[1].isdigit() and int(answer[1]):
+        return int(answer[1])
+    return REMOTE_ERROR
+
+
+class TCPTransport(Transport):
+    """ forwards APDUs to a remote reader daemon (see TransportServer)
+
+        Line protocol, one request and one answer per line:
+            RESET        -> OK <ATR in hex> <baud rate>   or   ERR <error code> [text]
+            APDU <hex>   -> OK <sw or -> <data in hex>
+    """
+
+    def __init__(self, host, port, timeout=10, debug=False):
+        self.address = (host, port)
+        self.timeout = timeout
+        self.debug = debug
+        self.sock = None
+        self.stream = None
+        self.atr = None
+        self.baudrate = None
+
+    def _request(self, line):
+        if (self.debug): print("TCP: " + line)
+        self.stream.write((line + "\n").encode("ascii"))
+        self.stream.flush()
+        answer = str(self.stream.readline().decode("ascii").rstrip("\r\n"))
+        if (self.debug): print("TCP: " + answer)
+        if not answer:
+            raise IOError("remote reader closed the connection")
+        return answer.split(" ")
+
+    def open(self):
+        # opened again while polling for a card (pySIMbatch), the old connection is closed first
+        self.close()
+        self.sock = socket.create_connection(self.address, self.timeout)
+        self.stream = self.sock.makefile("rwb")
+        try:
+            answer = self._request("RESET")
+        except Exception:
+            self.close()
+            raise
+        if answer[0] != "OK":
+            self.close()
+            return remoteError(answer)
+        self.atr = parseATR(unhexlify(answer[1])) if answer[1] != "-" else None
+        self.baudrate = int(answer[2]) if answer[2] != "-" else None
+        return 0
+
+    def close(self):
+        if self.sock is None:
+            return
+        self.stream.close()
+        self.sock.close()
+        self.stream = None
+        self.sock = None
+
+    def transmit(self, command):
+        answer = self._request("APDU " + command)
+        if answer[0] != "OK":
+            raise IOError("remote reader: " + " ".join(answer[1:]))
+        return answer[2], "" if answer[1] == "-" else answer[1]
+
+
+class TransportServer(socketserver.ThreadingTCPServer):
+    """ reader daemon that serves a local transport to TCPTransport clients
+
+        server = TransportServer(SerialTransport("/dev/ttyUSB0"), ("localhost", 7816))
+        server.serve_forever()
+
+        Clients are served one request at a time, the reader is shared.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, transport, address):
+        socketserver.ThreadingTCPServer.__init__(self, address, _TransportHandler)
+        self.transport = transport
+        self.lock = threading.Lock()
+
+
+class _TransportHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        while 1:
+            line = str(self.rfile.readline().decode("ascii").strip())
+            if not line:
+                break
+            request = line.split(" ")
+            with server.lock:
+                try:
+                    if request[0] == "RESET":
+                        err = server.transport.open()
+                        if err:
+                            answer = "ERR %d" % err
+                        else:
+                            atr = server.transport.atr
+                            answer = "OK %s %s" % (str(atr) if atr else "-", server.transport.baudrate or "-")
+                    elif request[0] == "APDU" and len(request) == 2:
+                        data, sw = server.transport.transmit(request[1])
+                        answer = "OK %s %s" % (sw or "-", data)
+                    else:
+                        answer = "ERR %d unknown request" % REMOTE_ERROR
+                except Exception as e:
+                    answer = "ERR %d %s" % (REMOTE_ERROR, " ".join(str(e).split()))
+            self.wfile.write((answer + "\n").encode("ascii", "replace"))
+
+
+def openTransport(portname, maxBaudrate=115200, framed=True, debug=False, timeout=None):
+    """openTransport(portname)
+
+        portname : "tcp://host:port" of a remote reader daemon,
+                   "pcsc://" or "pcsc://<reader index or name>" of a PC/SC reader,
+                   "image://<file>" of a card image saved with pySIMlib.saveImage,
+                   anything else is a serial port name or a serial.Serial-like object
+        timeout  : seconds before a read from the reader gives up (default of the transport)
+        result   : Transport
+    """
+    if hasattr(portname, "startswith") and portname.startswith("tcp://"):
+        host, port = portname[6:].rsplit(":", 1)
+        if timeout is not None:
+            return TCPTransport(host, int(port), timeout=timeout, debug=debug)
+        return TCPTransport(host, int(port), debug=debug)
+    if hasattr(portname, "startswith") and portname.startswith("pcsc://"):
+        return PCSCTransport(portname[7:] or None, debug=debug)
+    if hasattr(portname, "startswith") and portname.startswith("image://"):
+        from pySIMimage import ImageTransport
+        return ImageTransport(portname[8:])
+    if timeout is not None:
+        return SerialTransport(portname, maxBaudrate, framed, debug, timeout)
+    return SerialTransport(portname, maxBaudrate, framed, debug)
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) < 2:
+        print("usage: python pySIMtransport.py <port> [listen address] [listen port]")
+        sys.exit(1)
+    host = sys.argv[2] if len(sys.argv) > 2 else "localhost"
+    port = int(sys.argv[3]) if len(sys.argv) > 3 else 7816
+    server = TransportServer(openTransport(sys.argv[1]), (host, port))
+    print("Serving %s on %s:%d" % (sys.argv[1], host, port))
+    server.serve_forever()
@@ -0,0 +1,584 @@
+from __future__ import print_function
+
+import time
+from binascii import hexlify, unhexlify
+
+from pySIMlib import pySIMlib
+from pySIMtransport import ACK_NULL, DEFAULT_BAUDRATE, DI_TABLE, FI_TABLE, Transport, parseATR
+
+EF_TRANSPARENT = 0
+EF_LINEAR_FIXED = 1
+EF_CYCLIC = 3
+
+# INS codes of commands where the card sends the data body (case 2)
+OUTGOING_INS = (0xB0, 0xB2, 0xC0, 0xF2, 0x12)
+
+
+class VirtualDF:
+    def __init__(self, fid, children=()):
+        self.fid = fid
+        self.parent = None
+        self.children = {}
+        for child in children:
+            self.add(child)
+
+    def add(self, child):
+        child.parent = self
+        self.children[child.fid] = child
+        return child
+
+
+class VirtualEF:
+    def __init__(self, fid, data="", records=None, recLen=0, structure=EF_TRANSPARENT, chv=True):
+        """ transparent EF with 'data' or record EF with a list of 'records' of 'recLen' bytes
+
+            chv : reading and updating need CHV1 (if it is enabled)
+        """
+        self.fid = fid
+        self.parent = None
+        self.data = data
+        self.records = records if records is not None else []
+        self.recLen = recLen
+        self.structure = structure
+        self.chv = chv
+
+    def size(self):
+        if self.structure == EF_TRANSPARENT:
+            return len(self.data)
+        return len(self.records) * self.recLen
+
+
+class VirtualCard:
+    """ GSM 11.11 card working on whole APDUs
+
+        root    : VirtualDF of the MF
+        atr     : string of ATR bytes
+        pin     : CHV1 as ASCII digits
+    """
+
+    def __init__(self, root, atr="\x3B\x13\x94\x00\x00\x00", pin="1234", pinEnabled=True, strictLength=False):
+        self.root = root
+        self.atr = atr
+        self.pin = pin
+        self.pinEnabled = pinEnabled
+        self.pinTries = 3
+        # refuse READ/UPDATE RECORD with a P3 different from the record length (6700)
+        self.strictLength = strictLength
+        self.seekSupported = True
+        self.reset()
+
+    def reset(self):
+        self.currentDF = self.root
+        self.currentEF = None
+        self.recordPointer = 0
+        self.response = ""
+        self.pinVerified = False
+
+    def process(self, apdu):
+        """process(apdu)
+
+            apdu   : string of command bytes
+            result : tuple(data, sw) with data as a string of bytes and sw as an int
+        """
+        cla, ins, p1, p2, p3 = [ord(c) for c in apdu[:5]]
+        body = apdu[5:]
+        if cla != 0xA0:
+            return "", 0x6E00
+        handler = {0xA4: self._select, 0xF2: self._status, 0xB0: self._readBinary,
+                   0xD6: self._updateBinary, 0xB2: self._readRecord, 0xDC: self._updateRecord,
+                   0xA2: self._seek, 0xC0: self._getResponse, 0x20: self._verifyCHV,
+                   0x24: self._changeCHV, 0x26: self._disableCHV, 0x28: self._enableCHV}.get(ins)
+        if handler is None:
+            return "", 0x6D00
+        return handler(p1, p2, p3, body)
+
+    def _find(self, fid):
+        df = self.currentDF
+        if fid == self.root.fid:
+            return self.root
+        if fid == df.fid:
+            return df
+        if fid in df.children:
+            return df.children[fid]
+        if df.parent is not None:
+            if fid == df.parent.fid:
+                return df.parent
+            sibling = df.parent.children.get(fid)
+            if isinstance(sibling, VirtualDF):
+                return sibling
+        return None
+
+    def _fileResponse(self, f):
+        fid = unhexlify(f.fid)
+        if isinstance(f, VirtualDF):
+            efs = len([c for c in f.children.values() if isinstance(c, VirtualEF)])
+            dfs = len(f.children) - efs
+            chv1 = (0x80 | self.pinTries) if self.pin else 0
+            data = "\x00\x00\xFF\xFF" + fid + ("\x01" if f is self.root else "\x02")
+            data += "\x00" * 5 + "\x09"
+            data += chr(0x00 if self.pinEnabled else 0x80) + chr(dfs) + chr(efs) + "\x04\x00"
+            data += chr(chv1) + "\x8A" + "\x83\x8A"
+            return data
+        size = f.size()
+        data = "\x00\x00" + chr(size >> 8) + chr(size & 0xFF) + fid + "\x04"
+        data += "\x40" if f.structure == EF_CYCLIC else "\x00"
+        data += ("\x11\xF4\x44" if f.chv else "\x0F\xF4\x44") + "\x01\x02"
+        data += chr(f.structure) + chr(f.recLen)
+        return data
+
+    def _select(self, p1, p2, p3, body):
+        f = self._find(hexlify(body).upper())
+        if f is None:
+            return "", 0x9404
+        if isinstance(f, VirtualDF):
+            self.currentDF = f
+            self.currentEF = None
+        else:
+            self.currentEF = f
+            self.recordPointer = 0
+        self.response = self._fileResponse(f)
+        return "", 0x9F00 | len(self.response)
+
+    def _status(self, p1, p2, p3, body):
+        return self._fileResponse(self.currentDF)[:p3], 0x9000
+
+    def _getResponse(self, p1, p2, p3, body):
+        if not self.response or p3 > len(self.response):
+            return "", 0x6F00
+        data, self.response = self.response[:p3], ""
+        return data, 0x9000
+
+    def _checkEF(self, structures):
+        ef = self.currentEF
+        if ef is None:
+            return 0x9400
+        if ef.structure not in structures:
+            return 0x9408
+        if ef.chv and self.pinEnabled and not self.pinVerified:
+            return 0x9804
+        return 0
+
+    def _readBinary(self, p1, p2, p3, body):
+        sw = self._checkEF((EF_TRANSPARENT,))
+        if sw:
+            return "", sw
+        off = (p1 << 8) | p2
+        if off + p3 > len(self.currentEF.data):
+            return "", 0x6700
+        return self.currentEF.data[off:off + p3], 0x9000
+
+    def _updateBinary(self, p1, p2, p3, body):
+        sw = self._checkEF((EF_TRANSPARENT,))
+        if sw:
+            return "", sw
+        off = (p1 << 8) | p2
+        ef = self.currentEF
+        if off + p3 > len(ef.data):
+            return "", 0x6700
+        ef.data = ef.data[:off] + body + ef.data[off + p3:]
+        return "", 0x9000
+
+    def _recordIndex(self, p1, p2):
+        """ record number addressed by P1/P2, moves the record pointer; 0 when out of range """
+        ef = self.currentEF
+        n = len(ef.records)
+        if p2 == 0x04:
+            rec = p1 if p1 else self.recordPointer
+        elif p2 == 0x02:
+            rec = self.recordPointer + 1
+            if ef.structure == EF_CYCLIC and rec > n:
+                rec = 1
+        elif p2 == 0x03:
+            rec = self.recordPointer - 1 if self.recordPointer else n
+            if ef.structure == EF_CYCLIC and rec < 1:
+                rec = n
+        else:
+            return 0
+        if rec < 1 or rec > n:
+            return 0
+        if p2 != 0x04 or not p1:
+            self.recordPointer = rec
+        return rec
+
+    def _readRecord(self, p1, p2, p3, body):
+        sw = self._checkEF((EF_LINEAR_FIXED, EF_CYCLIC))
+        if sw:
+            return "", sw
+        ef = self.currentEF
+        if p3 > ef.recLen or (self.strictLength and p3 != ef.recLen):
+            return "", 0x6700 | ef.recLen
+        rec = self._recordIndex(p1, p2)
+        if not rec:
+            return "", 0x9402
+        return ef.records[rec - 1][:p3], 0x9000
+
+    def _updateRecord(self, p1, p2, p3, body):
+        sw = self._checkEF((EF_LINEAR_FIXED, EF_CYCLIC))
+        if sw:
+            return "", sw
+        ef = self.currentEF
+        if p3 != ef.recLen:
+            return "", 0x6700 | ef.recLen
+        if ef.structure == EF_CYCLIC:
+            if p2 != 0x03:
+                return "", 0x6B00
+            # the oldest record is overwritten and becomes record 1
+            ef.records = [body] + ef.records[:-1]
+            self.recordPointer = 1
+            return "", 0x9000
+        rec = self._recordIndex(p1, p2)
+        if not rec:
+            return "", 0x9402
+        ef.records[rec - 1] = body
+        return "", 0x9000
+
+    def _seek(self, p1, p2, p3, body):
+        if not self.seekSupported:
+            return "", 0x6D00
+        sw = self._checkEF((EF_LINEAR_FIXED, EF_CYCLIC))
+        if sw:
+            return "", sw
+        ef = self.currentEF
+        seekType, mode = p2 >> 4, p2 & 0x0F
+        n = len(ef.records)
+        if mode == 0:
+            order = range(1, n + 1)
+        elif mode == 1:
+            order = range(n, 0, -1)
+        elif mode == 2:
+            order = range(self.recordPointer + 1, n + 1)
+        elif mode == 3:
+            order = range((self.recordPointer or n + 1) - 1, 0, -1)
+        else:
+            return "", 0x6B00
+        for rec in order:
+            if ef.records[rec - 1].startswith(body):
+                self.recordPointer = rec
+                if seekType == 1:
+                    self.response = chr(rec)
+                    return "", 0x9F01
+                return "", 0x9000
+        return "", 0x9404
+
+    def _pinBlock(self, pin):
+        return pin + "\xFF" * (8 - len(pin))
+
+    def _checkPIN(self, data):
+        if not self.pinTries:
+            return 0x9840
+        if data != self._pinBlock(self.pin):
+            self.pinTries -= 1
+            return 0x9804 if self.pinTries else 0x9840
+        self.pinTries = 3
+        self.pinVerified = True
+        return 0x9000
+
+    def _verifyCHV(self, p1, p2, p3, body):
+        return "", self._checkPIN(body)
+
+    def _changeCHV(self, p1, p2, p3, body):
+        sw = self._checkPIN(body[:8])
+        if sw == 0x9000:
+            self.pin = body[8:].rstrip("\xFF")
+        return "", sw
+
+    def _disableCHV(self, p1, p2, p3, body):
+        sw = self._checkPIN(body)
+        if sw == 0x9000:
+            self.pinEnabled = False
+        return "", sw
+
+    def _enableCHV(self, p1, p2, p3, body):
+        sw = self._checkPIN(body)
+        if sw == 0x9000:
+            self.pinEnabled = True
+        return "", sw
+
+
+class VirtualSerial:
+    """ Stand-in for serial.Serial with tied RX/TX lines and a VirtualCard behind it.
+
+        Can be passed to pySIMlib.openSession instead of a port name. A reset with
+        RTS/DTR sends the ATR, PPS requests are answered, and every APDU goes
+        through the T=0 byte protocol (echo, procedure bytes, SW1/SW2).
+
+        latency  : seconds every read/write call costs (USB round trip)
+        byteTime : seconds every byte on the wire costs, by default 12 bit times
+                   at the card baud rate (start, 8 data, parity, 2 stop)
+        nulls    : number of ACK_NULL procedure bytes the card sends before the INS
+        sleep    : function used to wait, None only adds the time to 'elapsed'
+
+        'elapsed' is the modelled time spent so far, 'bytesWritten' and 'bytesRead'
+        count the bytes that went over the port.
+    """
+
+    def __init__(self, card, latency=0.0, byteTime=None, nulls=0, sleep=time.sleep, timeout=1):
+        self.card = card
+        self.latency = latency
+        self.byteTime = byteTime
+        self.nulls = nulls
+        self.sleep = sleep
+        self.timeout = timeout
+        self.baudrate = DEFAULT_BAUDRATE
+        self.cardBaudrate = DEFAULT_BAUDRATE
+        self.elapsed = 0.0
+        self.calls = 0
+        self.bytesWritten = 0
+        self.bytesRead = 0
+        self.rx = ""
+        self.tx = ""
+        self.pending = 0
+        self.rts = 0
+        self.afterATR = False
+
+    def _wait(self, nbytes):
+        self.calls += 1
+        if self.byteTime is None:
+            delay = self.latency + nbytes * 12.0 / self.cardBaudrate
+        else:
+            delay = self.latency + nbytes * self.byteTime
+        self.elapsed += delay
+        if self.sleep and delay:
+            self.sleep(delay)
+
+    def setRTS(self, level):
+        if self.rts and not level:
+            # end of reset
+            self.card.reset()
+            self.cardBaudrate = DEFAULT_BAUDRATE
+            self.rx += self.card.atr
+            self.tx = ""
+            self.pending = 0
+            self.afterATR = True
+        self.rts = level
+
+    def setDTR(self, level):
+        pass
+
+    def flushInput(self):
+        self.rx = ""
+
+    def close(self):
+        pass
+
+    def write(self, data):
+        self._wait(len(data))
+        self.bytesWritten += len(data)
+        # because rx and tx are tied together, everything comes back
+        self.rx += data
+        if self.baudrate != self.cardBaudrate:
+            # the card can not make sense of bytes sent at a different rate
+            return len(data)
+        self.tx += data
+        if self.afterATR and self.tx[:1] == "\xFF":
+            if len(self.tx) >= 4:
+                self._pps(self.tx[:4])
+                self.tx = self.tx[4:]
+            return len(data)
+        self.afterATR = False
+        while self.tx:
+            if self.pending:
+                if len(self.tx) < self.pending:
+                    break
+                self._answer(self.header + self.tx[:self.pending], False)
+                self.tx = self.tx[self.pending:]
+                self.pending = 0
+            elif len(self.tx) >= 5:
+                self.header, self.tx = self.tx[:5], self.tx[5:]
+                ins, p3 = ord(self.header[1]), ord(self.header[4])
+                if ins in OUTGOING_INS or not p3:
+                    self._answer(self.header, True)
+                else:
+                    self.rx += chr(ACK_NULL) * self.nulls + chr(ins)
+                    self.pending = p3
+            else:
+                break
+        return len(data)
+
+    def _answer(self, apdu, outgoing):
+        data, sw = self.card.process(apdu)
+        if outgoing:
+            if sw != 0x9000:
+                # errors are reported instead of the procedure byte
+                self.rx += chr(ACK_NULL) * self.nulls + chr(sw >> 8) + chr(sw & 0xFF)
+                return
+            self.rx += chr(ACK_NULL) * self.nulls + apdu[1] + data
+        self.rx += chr(sw >> 8) + chr(sw & 0xFF)
+
+    def _pps(self, request):
+        self.afterATR = False
+        pps1 = ord(request[2])
+        fi, di = pps1 >> 4, pps1 & 0x0F
+        ta1 = ord(self.card.atr[2]) if ord(self.card.atr[1]) & 0x10 else 0x11
+        if (ord(request[1]) & 0xF0) != 0x10 or not FI_TABLE[fi] or not DI_TABLE[di] \
+                or fi != ta1 >> 4 or DI_TABLE[di] > DI_TABLE[ta1 & 0x0F]:
+            return
+        self.rx += request
+        self.cardBaudrate = DEFAULT_BAUDRATE * 372 * DI_TABLE[di] // FI_TABLE[fi]
+
+    def read(self, size=1):
+        data, self.rx = self.rx[:size], self.rx[size:]
+        self._wait(len(data))
+        self.bytesRead += len(data)
+        if len(data) < size:
+            # a real port blocks until the timeout runs out
+            self.elapsed += self.timeout
+            if self.sleep:
+                self.sleep(self.timeout)
+        return data
+
+
+class VirtualTransport(Transport):
+    """ APDU-level transport to a VirtualCard, like a PC/SC reader there is no echo
+        and no procedure bytes. Timing is modelled like in VirtualSerial.
+
+        card may be None for an empty reader, see insert and remove.
+    """
+
+    def __init__(self, card, latency=0.0, byteTime=12.0 / DEFAULT_BAUDRATE, sleep=time.sleep):
+        self.card = card
+        self.latency = latency
+        self.byteTime = byteTime
+        self.sleep = sleep
+        self.elapsed = 0.0
+        self.bytesWritten = 0
+        self.bytesRead = 0
+        self.atr = None
+        self.baudrate = None
+
+    def _wait(self, nbytes):
+        delay = 2 * self.latency + nbytes * self.byteTime
+        self.elapsed += delay
+        if self.sleep and delay:
+            self.sleep(delay)
+
+    def insert(self, card):
+        self.card = card
+
+    def remove(self):
+        self.card = None
+
+    def open(self):
+        card = self.card
+        if card is None:
+            return 2  # no card
+        card.reset()
+        self.atr = parseATR(card.atr)
+        return 0
+
+    def transmit(self, command):
+        apdu = unhexlify(command)
+        card = self.card
+        if card is None:
+            # like a serial reader without a card, nothing comes back
+            self._wait(len(apdu))
+            return "", ""
+        data, sw = card.process(apdu)
+        self.bytesWritten += len(apdu)
+        self.bytesRead += len(data) + 2
+        self._wait(len(apdu) + len(data) + 2)
+        return hexlify(data).upper(), "%04x" % sw
+
+
+def encodeSMS(number, message, timestamp="81010112000000", status=1, smsc="+38641000000", alphabet="7bit",
+              concat=None):
+    """ builds a 176 byte SMS-DELIVER record
+
+        timestamp : YYMMDDhhmmsszz as decimal digits
+        alphabet  : "7bit" (default alphabet), "8bit" (message is the binary data) or "ucs2"
+        concat    : tuple(reference, parts, part) of a concatenated message, sent in the user data header
+    """
+    lib = pySIMlib()
+    smscHex = lib.String_2_GSMPhoneNumber(smsc)
+    digits = number.lstrip("+")
+    numberHex = lib.String_2_GSMPhoneNumber(number)
+    ts = "".join([timestamp[i + 1] + timestamp[i] for i in range(0, 14, 2)])
+
+    udh = []
+    if concat is not None:
+        udh = [5, 0x00, 3] + list(concat)
+    if alphabet == "7bit":
+        dcs = 0x00
+        septets = [ord(c) for c in lib.ASCII_2_GSM3_38(message)]
+        # the header is followed by fill bits up to the next septet boundary
+        headerSeptets = (len(udh) * 8 + 6) // 7
+        packed = list(udh)
+        acc, bits = 0, headerSeptets * 7 - len(udh) * 8
+        for s in septets:
+            acc |= s << bits
+            bits += 7
+            while bits >= 8:
+                packed.append(acc & 0xFF)
+                acc >>= 8
+                bits -= 8
+        if bits:
+            packed.append(acc)
+        udl = headerSeptets + len(septets)
+    else:
+        if alphabet == "ucs2":
+            dcs = 0x08
+            body = bytearray(message.encode("utf-16-be"))
+        else:
+            dcs = 0x04
+            body = bytearray(message)
+        packed = udh + list(body)
+        udl = len(packed)
+
+    first = 0x44 if udh else 0x04  # SMS-DELIVER, no more messages to send, UDHI
+    pdu = "%02X" % status + "%02X" % (len(smscHex) // 2) + smscHex
+    pdu += "%02X" % first + "%02X" % len(digits) + numberHex + "00%02X" % dcs + ts
+    pdu += "%02X" % udl + "".join(["%02X" % b for b in packed])
+    return unhexlify(pdu) + b"\xFF" * (176 - len(pdu) // 2)
+
+
+def concatSMS(number, message, timestamp="81010112000000", reference=1, partLen=153):
+    """ splits a long 7-bit message into the (number, message, timestamp, ...) arguments of
+        encodeSMS for the parts of a concatenated message
+    """
+    parts = [message[i:i + partLen] for i in range(0, len(message), partLen)] or [""]
+    return [(number, part, timestamp, 1, "+38641000000", "7bit", (reference, len(parts), i + 1))
+            for i, part in enumerate(parts)]
+
+
+def createCard(contacts=(), smss=(), adnRecords=100, smsRecords=30, fdn=(), lnd=(),
+               pin="1234", pinEnabled=True, iccid="98103200000000000001", imsi="082943011032547698",
+               atr="\x3B\x13\x94\x00\x00\x00", strictLength=False):
+    """ builds a VirtualCard with MF, DF_TELECOM and DF_GSM
+
+        contacts, fdn, lnd : lists of (name, number) written to ADN, FDN and LND
+        smss               : list of (number, message, timestamp) written to EF_SMS
+    """
+    lib = pySIMlib()
+
+    def numRecords(entries, count):
+        records = []
+        for name, number in entries:
+            records.append(unhexlify(lib.encodeNum(name, number, 28, 14)))
+        return records + ["\xFF" * 28] * (count - len(records))
+
+    telecom = VirtualDF(lib.FILE_DF_TELECOM, [
+        VirtualEF(lib.FILE_EF_ADN, records=numRecords(contacts, adnRecords), recLen=28,
+                  structure=EF_LINEAR_FIXED),
+        VirtualEF(lib.FILE_EF_FDN, records=numRecords(fdn, 10), recLen=28, structure=EF_LINEAR_FIXED),
+        VirtualEF(lib.FILE_EF_LND, records=numRecords(lnd, 10), recLen=28, structure=EF_CYCLIC),
+        VirtualEF(lib.FILE_EF_MSISDN, records=numRecords((), 2), recLen=28, structure=EF_LINEAR_FIXED),
+        VirtualEF(lib.FILE_EF_SMS, records=[encodeSMS(*sms) for sms in smss] +
+                                           ["\x00" + "\xFF" * 175] * (smsRecords - len(smss)),
+                  recLen=176, structure=EF_LINEAR_FIXED),
+    ])
+    gsm = VirtualDF(lib.FILE_DF_GSM, [
+        VirtualEF(lib.FILE_EF_LP, "\x01\xFF\xFF\xFF", chv=False),
+        VirtualEF(lib.FILE_EF_IMSI, unhexlify(imsi)),
+        VirtualEF(lib.FILE_EF_KC, "\x01\x23\x45\x67\x89\xAB\xCD\xEF\x07"),
+        VirtualEF(lib.FILE_EF_PHASE, "\x02", chv=False),
+        VirtualEF(lib.FILE_EF_HPLMN, "\x0A"),
+        VirtualEF(lib.FILE_EF_SST, "\xFF\x3F\xFF\xFF"),
+        VirtualEF(lib.FILE_EF_BCCH, "\x00" * 16),
+        VirtualEF(lib.FILE_EF_ACC, "\x00\x02"),
+        VirtualEF(lib.FILE_EF_FPLMN, "\xFF" * 12),
+        VirtualEF(lib.FILE_EF_LOCI, "\xFF" * 4 + "\x92\xF4\x10\x00\x01\xFF\x01"),
+        VirtualEF(lib.FILE_EF_AD, "\x00\x00\x00"),
+        VirtualEF(lib.FILE_EF_SPN, "\x01" + lib.padString("Virtual", 16, "\xFF"), chv=False),
+    ])
+    root = VirtualDF(lib.FILE_MF, [VirtualEF(lib.FILE_EF_ICCID, unhexlify(iccid), chv=False), telecom, gsm])
+    return VirtualCard(root, atr=atr, pin=pin, pinEnabled=pinEnabled, strictLength=strictLength)